@@ -20,8 +20,16 @@ from pathlib import Path
 from PIL import Image
 from tqdm import tqdm
 
-from models.caption import caption_blip
-from models.cls import classify_clip, classify_eva, classify_metaclip
+from models.caption import caption_blip, caption_blip_batch
+from models.cls import classify_cascade, classify_clip, classify_eva, classify_metaclip
+
+CONFIG = {
+    "caption_batch_size": 16,  # captions for pending images are generated in batches and cached before the main loop
+    "cascade": False,  # run clip first, escalate to metaclip and eva only on low-confidence predictions
+    "cascade_stages": ["clip", "metaclip", "eva"],
+    "cascade_min_margin": 0.2,  # top-1 minus top-2 probability
+    "cascade_max_entropy": 0.5,  # normalized entropy in [0;1]
+}
 
 datapath = Path.cwd() / "data" / "hcaptcha" / "cls" / "data"
 outputpath = Path.cwd() / "data" / "hcaptcha" / "cls" / "eval"
@@ -32,6 +40,13 @@ assert outputpath.exists()
 datafiles = list(datapath.glob("*.png"))
 random.shuffle(datafiles)
 
+pending = [file for file in datafiles if not (outputpath / f"{file.stem}.json").exists()]
+for i in tqdm(range(0, len(pending), CONFIG["caption_batch_size"]), desc="captioning"):
+    caption_blip_batch([Image.open(file) for file in pending[i : i + CONFIG["caption_batch_size"]]], batch_size=CONFIG["caption_batch_size"])
+
+statspath = outputpath.parent / "cascade_stats.json"  # per-stage hit rates, accumulated across restarts, kept out of the per-image results
+stats = json.loads(statspath.read_text()) if statspath.exists() else {stage: 0 for stage in CONFIG["cascade_stages"]}
+
 for file in tqdm(datafiles):
     if (outputpath / f"{file.stem}.json").exists():
         print(f"skipping: `{file.stem}.json`")
@@ -40,12 +55,27 @@ for file in tqdm(datafiles):
     img: Image = Image.open(file)
     captions: list[str] = caption_blip(img)
 
-    out = {
-        "captions": captions,
-        "metaclip": classify_metaclip(img, captions),
-        "clip": classify_clip(img, captions),
-        "eva": classify_eva(img, captions),
-    }
+    if CONFIG["cascade"]:
+        probs, stage = classify_cascade(img, captions, CONFIG["cascade_stages"], CONFIG["cascade_min_margin"], CONFIG["cascade_max_entropy"])
+        out = {
+            "captions": captions,
+            "metaclip": probs.get("metaclip"),  # null if the cascade stopped before this stage
+            "clip": probs.get("clip"),
+            "eva": probs.get("eva"),
+            "cascade_stage": stage,
+        }
+
+        stats[stage] = stats.get(stage, 0) + 1
+        statspath.write_text(json.dumps(stats, indent=4))
+        total = sum(stats.values())
+        print(" | ".join(f"{stage}: {count / total:.2%}" for stage, count in stats.items()))
+    else:
+        out = {
+            "captions": captions,
+            "metaclip": classify_metaclip(img, captions),
+            "clip": classify_clip(img, captions),
+            "eva": classify_eva(img, captions),
+        }
 
     with open(outputpath / f"{file.stem}.json", "w") as f:
         json.dump(out, f, indent=4)
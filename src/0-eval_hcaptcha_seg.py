@@ -7,9 +7,10 @@ from PIL import Image
 from safetensors.torch import save_file
 from tqdm import tqdm
 
-from models.caption import caption_blip
+from models.caption import caption_blip, caption_blip_batch
 from models.cls import classify_metaclip
 from models.det import detect_vit
+from models.mask_encoding import pack_masks
 from models.seg import segment_sam1
 
 datapath = Path.cwd() / "data" / "hcaptcha" / "seg" / "data"
@@ -17,6 +18,12 @@ outputpath = Path.cwd() / "data" / "hcaptcha" / "seg" / "eval"
 assert datapath.exists()
 files = [x for x in datapath.iterdir() if x.is_file()]
 
+# captions for pending images are generated in batches and cached before the main loop
+caption_batch_size = 16
+pending = [file for file in files if not (outputpath / f"{file.stem}.safetensors").exists()]
+for i in tqdm(range(0, len(pending), caption_batch_size), desc="captioning"):
+    caption_blip_batch([Image.open(file).convert("RGB") for file in pending[i : i + caption_batch_size]], batch_size=caption_batch_size)
+
 for file in tqdm(files):
     if (outputpath / f"{file.stem}.safetensors").exists():
         print(f"skipping: `{file.stem}.safetensors`")
@@ -51,8 +58,14 @@ for file in tqdm(files):
         "detection_boxes": ensure_contiguous(torch.tensor(boxes, dtype=torch.float32)),
         "detection_scores": ensure_contiguous(torch.tensor(scores, dtype=torch.float32)),
         "detection_labels": ensure_contiguous(torch.tensor([ord(c) for c in "|".join(labels)], dtype=torch.int32)),
-        "segmentation_masks": ensure_contiguous(masks),
     }
+    if len(masks) > 0:
+        # bit-packed along the width, 8x smaller than bool, see: models/mask_encoding.py
+        packed, width = pack_masks(masks.cpu().numpy())
+        data_dict["segmentation_masks_packed"] = ensure_contiguous(torch.from_numpy(packed))
+        data_dict["segmentation_masks_shape"] = torch.tensor(masks.shape, dtype=torch.int64)
+    else:
+        data_dict["segmentation_masks"] = torch.empty(0)
 
     save_file(data_dict, outputpath / f"{file.stem}.safetensors")
     os.system(f"git add . && git commit -m 'autocommit' && git push")
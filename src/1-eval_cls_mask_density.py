@@ -1,5 +1,4 @@
 import csv
-import gc
 import itertools
 import json
 import os
@@ -7,14 +6,14 @@ import random
 from pathlib import Path
 
 import torch
-import torchvision.transforms as transforms
 from datasets import load_dataset
 from PIL import Image
 from tqdm import tqdm
 
 from advx.masks import get_circle_mask, get_diamond_mask, get_knit_mask, get_square_mask, get_word_mask
 from advx.utils import add_overlay
-from metrics.metrics import get_cosine_similarity, get_psnr, get_ssim
+from memory import MemoryMonitor
+from metrics.fused import get_metric_rows, get_perceptual_metrics
 from models.cls import classify_clip
 from utils import get_device
 
@@ -79,6 +78,10 @@ config
 CONFIG = {
     "outpath": Path.cwd() / "data" / "eval" / "eval_cls.csv",
     "subset_size": 5,
+    "metrics": ["cosine_sim", "psnr", "ssim"],  # "ssim" keeps the skimage definition of existing rows, "ssim_gaussian" is the batched variant (see: metrics/fused.py)
+    "memory_every": 50,  # rows between memory snapshots in data/memory/ (see: memory.py)
+    "gc_threshold_mb": 1024,  # rss or device memory growth that triggers a collection
+    "trace_python": False,  # also log the python heap and its top allocation sites, slower
 }
 COMBINATIONS = {
     "mask": ["circle", "square", "diamond", "knit", "word"],
@@ -97,6 +100,7 @@ print(f"total iterations: {len(random_combinations)} * {CONFIG['subset_size']} =
 dataset = load_dataset("visual-layer/imagenet-1k-vl-enriched", split="validation", streaming=True).take(CONFIG["subset_size"]).shuffle(seed=random.randint(0, 1000))
 dataset = list(map(lambda x: (x["image_id"], x["image"].convert("RGB"), x["label"], x["caption_enriched"]), dataset))
 labels = get_imagenet_labels()
+memory = MemoryMonitor(Path(__file__).stem, every=CONFIG["memory_every"], gc_threshold_mb=CONFIG["gc_threshold_mb"], trace_python=CONFIG["trace_python"])
 
 if get_device() == "cuda":
     torch.cuda.empty_cache()
@@ -106,6 +110,7 @@ if get_device() == "cuda":
 for combination in tqdm(random_combinations, total=len(random_combinations)):
     combination = dict(zip(COMBINATIONS.keys(), combination))
 
+    pending = []
     for id, x_image, label_id, caption in dataset:
         entry_id = {
             **combination,
@@ -114,13 +119,21 @@ for combination in tqdm(random_combinations, total=len(random_combinations)):
         if is_cached(CONFIG["outpath"], entry_id):
             print(f"skipping {entry_id}")
             continue
+        pending.append((entry_id, x_image, label_id))
 
-        with torch.no_grad(), torch.amp.autocast(device_type=get_device(disable_mps=True), enabled="cuda" == get_device()):
-            advx_image = get_advx(x_image, label_id, combination)
+    if len(pending) == 0:
+        continue
+
+    x_images = [x_image for _, x_image, _ in pending]
+    with memory.stage("advx"):
+        advx_images = [get_advx(x_image, label_id, combination) for _, x_image, label_id in pending]
 
-            transform = transforms.Compose([transforms.Resize((256, 256)), transforms.Grayscale(num_output_channels=3), transforms.ToTensor()])
-            x: torch.Tensor = transform(x_image).unsqueeze(0)
-            advx_x: torch.Tensor = transform(advx_image).unsqueeze(0)
+    # all perceptual metrics of this combination in one pass, each image is decoded once
+    with memory.stage("metrics"):
+        metric_rows = get_metric_rows(get_perceptual_metrics(x_images, advx_images, CONFIG["metrics"]))
+
+    for (entry_id, x_image, label_id), advx_image, metric_row in zip(pending, advx_images, metric_rows):
+        with torch.no_grad(), torch.amp.autocast(device_type=get_device(disable_mps=True), enabled="cuda" == get_device()):
 
             def get_acc_boolmask(img: Image.Image) -> list[bool]:
                 preds = list(zip(range(len(labels)), classify_clip(img, labels)))
@@ -129,15 +142,14 @@ for combination in tqdm(random_combinations, total=len(random_combinations)):
                 top5_mask = [label_id == key for key in top5_keys]
                 return top5_mask
 
-            x_acc5 = get_acc_boolmask(x_image)
-            advx_acc5 = get_acc_boolmask(advx_image)
+            with memory.stage("inference"):
+                x_acc5 = get_acc_boolmask(x_image)
+                advx_acc5 = get_acc_boolmask(advx_image)
 
         results = {
             **entry_id,
             # semantic similarity
-            "cosine_sim": get_cosine_similarity(x_image, advx_image),
-            "psnr": get_psnr(x, advx_x),
-            "ssim": get_ssim(x, advx_x),
+            **metric_row,
             # accuracy
             "label": get_imagenet_label(label_id),
             "x_acc1": 1 if x_acc5[0] else 0,
@@ -152,5 +164,4 @@ for combination in tqdm(random_combinations, total=len(random_combinations)):
                 writer.writeheader()
             writer.writerow(results)
 
-        torch.cuda.empty_cache()
-        gc.collect()
+        memory.step()
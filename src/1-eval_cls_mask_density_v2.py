@@ -4,18 +4,20 @@ import itertools
 import json
 from pathlib import Path
 
-import lpips
 import open_clip
 import torch
-import torchvision.transforms as transforms
 from datasets import load_dataset
 from PIL import Image
 from tqdm import tqdm
 
 from advx.masks import get_circle_mask, get_diamond_mask, get_knit_mask, get_square_mask, get_word_mask
 from advx.utils import add_overlay
-from metrics.metrics import get_cosine_similarity, get_psnr, get_ssim
-from utils import get_device, set_env
+from memory import MemoryMonitor
+from metrics.fused import get_metric_rows, get_perceptual_metrics
+from models.precision import get_input_dtype, get_precision_device
+from models.shared import load_open_clip
+from tracing import trace
+from utils import append_csv_row, get_worker_shard, set_env
 
 
 def is_cached(path: Path, entry_id: dict) -> bool:
@@ -72,14 +74,20 @@ config
 """
 
 
-device = get_device(disable_mps=False)
 seed = 42
 set_env(seed=seed)
 
 CONFIG = {
     "outpath": Path.cwd() / "data" / "eval" / "eval_cls.csv",
     "subset_size": 100,
+    "precision": "fp32",  # fp32, bf16, int8 (see: 1-eval_cls_precision.py for accuracy report)
+    "shared": False,  # memory-map weights from /dev/shm so parallel copies of this script share one copy (see: models/shared.py)
+    "metrics": ["cosine_sim", "psnr", "ssim", "lpips"],  # computed in one fused pass per combination (see: metrics/fused.py)
+    "memory_every": 50,  # rows between memory snapshots in data/memory/ (see: memory.py)
+    "gc_threshold_mb": 1024,  # rss or device memory growth that triggers a collection
+    "trace_python": False,  # also log the python heap and its top allocation sites, slower
 }
+device = "cpu" if CONFIG["shared"] else get_precision_device(CONFIG["precision"])
 COMBINATIONS = {
     "model": ["vit", "eva02", "eva01", "convnext", "resnet"],
     "mask": ["circle", "square", "diamond", "knit", "word"],
@@ -89,6 +97,8 @@ COMBINATIONS = {
 
 random_combinations = list(itertools.product(*COMBINATIONS.values()))
 random_combinations.sort(key=lambda x: x[0])  # sort list by model to reduce model loading
+worker_id, num_workers = get_worker_shard()
+random_combinations = random_combinations[worker_id::num_workers]
 print(f"total iterations: {len(random_combinations)} * {CONFIG['subset_size']} = {len(random_combinations) * CONFIG['subset_size']}")
 
 
@@ -102,77 +112,84 @@ dataset = load_dataset("visual-layer/imagenet-1k-vl-enriched", split="validation
 dataset = list(map(lambda x: (x["image_id"], x["image"].convert("RGB"), x["label"], x["caption_enriched"]), dataset))
 labels = get_imagenet_labels()
 print("loaded dataset: imagenet-1k-vl-enriched")
-
-
-# perceptual loss
-loss_fn_vgg = lpips.LPIPS(net="vgg")
+memory = MemoryMonitor(Path(__file__).stem, every=CONFIG["memory_every"], gc_threshold_mb=CONFIG["gc_threshold_mb"], trace_python=CONFIG["trace_python"])
 
 
 # models
-def load_model(model_name, pretrained, device, labels):
+def load_model(model_name, pretrained, device, labels, precision="fp32", shared=False):
     # load to cpu first to avoid cuda out of memory
     # see: https://github.com/mlfoundations/open_clip/blob/main/docs/openclip_results.csv
-    model, _, preprocess = open_clip.create_model_and_transforms(model_name, pretrained=pretrained, device="cpu")
-    model = model.to("cpu")
-    model.eval()
+    model, preprocess = load_open_clip(model_name, pretrained, precision, shared)  # no-op if pre-warmed by runner.py
 
     tokenizer = open_clip.get_tokenizer(model_name)
     text = tokenizer(labels).to("cpu")
 
     torch.cuda.empty_cache()
     gc.collect()
-    print(f"loaded model: {model_name}")
+    print(f"loaded model: {model_name} ({precision})")
     return model, preprocess, text
 
 
-model_vit, preprocess_vit, text_vit = load_model("ViT-H-14-378-quickgelu", "dfn5b", device, labels)
-model_eva02, preprocess_eva02, text_eva02 = load_model("EVA02-E-14-plus", "laion2b_s9b_b144k", device, labels)
-model_eva01, preprocess_eva01, text_eva01 = load_model("EVA01-g-14-plus", "merged2b_s11b_b114k", device, labels)
-model_convnext, preprocess_convnext, text_convnext = load_model("convnext_xxlarge", "laion2b_s34b_b82k_augreg_soup", device, labels)
-model_resnet, preprocess_resnet, text_resnet = load_model("RN50x64", "openai", device, labels)
+model_vit, preprocess_vit, text_vit = load_model("ViT-H-14-378-quickgelu", "dfn5b", device, labels, CONFIG["precision"], CONFIG["shared"])
+model_eva02, preprocess_eva02, text_eva02 = load_model("EVA02-E-14-plus", "laion2b_s9b_b144k", device, labels, CONFIG["precision"], CONFIG["shared"])
+model_eva01, preprocess_eva01, text_eva01 = load_model("EVA01-g-14-plus", "merged2b_s11b_b114k", device, labels, CONFIG["precision"], CONFIG["shared"])
+model_convnext, preprocess_convnext, text_convnext = load_model("convnext_xxlarge", "laion2b_s34b_b82k_augreg_soup", device, labels, CONFIG["precision"], CONFIG["shared"])
+model_resnet, preprocess_resnet, text_resnet = load_model("RN50x64", "openai", device, labels, CONFIG["precision"], CONFIG["shared"])
 
 
 for combination in tqdm(random_combinations, total=len(random_combinations)):
     combination = dict(zip(COMBINATIONS.keys(), combination))
 
-    model, preprocess, text, transform = None, None, None, None
+    model, preprocess, text = None, None, None
     if combination["model"] == "vit":
         model, preprocess, text = model_vit, preprocess_vit, text_vit
-        transform = transforms.Compose([transforms.Lambda(lambda x: x.convert("RGB")), transforms.Resize(224), transforms.CenterCrop(224), transforms.ToTensor(), transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
     elif combination["model"] == "eva02":
         model, preprocess, text = model_eva02, preprocess_eva02, text_eva02
-        required_size = 224
-        transform = transforms.Compose([transforms.Lambda(lambda x: x.convert("RGB")), transforms.Resize(224), transforms.CenterCrop(224), transforms.ToTensor(), transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
     elif combination["model"] == "eva01":
         model, preprocess, text = model_eva01, preprocess_eva01, text_eva01
-        transform = transforms.Compose([transforms.Lambda(lambda x: x.convert("RGB")), transforms.Resize(224), transforms.CenterCrop(224), transforms.ToTensor(), transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
     elif combination["model"] == "convnext":
         model, preprocess, text = model_convnext, preprocess_convnext, text_convnext
-        transform = transforms.Compose([transforms.Lambda(lambda x: x.convert("RGB")), transforms.Resize(224), transforms.CenterCrop(224), transforms.ToTensor(), transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
     elif combination["model"] == "resnet":
         model, preprocess, text = model_resnet, preprocess_resnet, text_resnet
-        transform = transforms.Compose([transforms.Lambda(lambda x: x.convert("RGB")), transforms.Resize(448), transforms.CenterCrop(448), transforms.ToTensor(), transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-    assert model is not None and preprocess is not None and text is not None and transform is not None
+    assert model is not None and preprocess is not None and text is not None
     model = model.to(device)
     text = text.to(device)
     print(f"loaded model: {combination['model']}")
 
+    pending = []
     for img_id, image, label_id, caption in dataset:
         entry_ids = {
             **combination,
             "img_id": img_id,
         }
-        if is_cached(CONFIG["outpath"], entry_ids):
+        with trace("csv_lookup"):
+            cached = is_cached(CONFIG["outpath"], entry_ids)
+        if cached:
             print(f"skipping {entry_ids}")
             continue
-        
+        pending.append((entry_ids, image, label_id))
+
+    if len(pending) == 0:
+        continue
+
+    images = [image for _, image, _ in pending]
+    with trace("advx"), memory.stage("advx"):
+        adv_images = [get_advx(image, label_id, combination) for _, image, label_id in pending]
+
+    # all perceptual metrics of this combination in one pass, each image is decoded once
+    # psnr, ssim and lpips are computed on the model's normalized input size, as in every existing row of eval_cls.csv
+    pixel_view = "imagenet_448" if combination["model"] == "resnet" else "imagenet_224"
+    with memory.stage("metrics"):
+        metric_rows = get_metric_rows(get_perceptual_metrics(images, adv_images, CONFIG["metrics"], pixel_view=pixel_view))
+
+    for (entry_ids, image, label_id), adv_image, metric_row in zip(pending, adv_images, metric_rows):
         with torch.no_grad(), torch.amp.autocast(device_type=device, enabled="cuda" == device):
             def get_boolmask(img: Image.Image) -> Image.Image:
                 img = img.convert("RGB")
-                img = preprocess(img).unsqueeze(0).to(device)
+                img = preprocess(img).unsqueeze(0).to(device, dtype=get_input_dtype(model))
 
-                image_features = model.encode_image(img)
-                text_features = model.encode_text(text)
+                image_features = model.encode_image(img).float()
+                text_features = model.encode_text(text).float()
                 image_features /= image_features.norm(dim=-1, keepdim=True)
                 text_features /= text_features.norm(dim=-1, keepdim=True)
                 text_probs = (100.0 * image_features @ text_features.T).softmax(dim=-1)
@@ -185,21 +202,14 @@ for combination in tqdm(random_combinations, total=len(random_combinations)):
                 boolmask = [label_id == key for key in top5_keys]
                 return boolmask
 
-            adv_image = get_advx(image, label_id, combination)
-
-            x_acc5 = get_boolmask(image)
-            advx_acc5 = get_boolmask(adv_image)
-
-            x: torch.Tensor = transform(image).unsqueeze(0)
-            advx_x: torch.Tensor = transform(adv_image).unsqueeze(0)
+            with trace("inference"), memory.stage("inference"):
+                x_acc5 = get_boolmask(image)
+                advx_acc5 = get_boolmask(adv_image)
 
             results = {
                 **entry_ids,
                 # perceptual quality
-                "cosine_sim": get_cosine_similarity(image, adv_image),
-                "psnr": get_psnr(x, advx_x),
-                "ssim": get_ssim(x, advx_x),
-                "lpips": loss_fn_vgg(x, advx_x).item(),
+                **metric_row,
                 # adversarial accuracy disadvantage
                 "x_acc1": 1 if x_acc5[0] else 0,
                 "advx_acc1": 1 if advx_acc5[0] else 0,
@@ -207,11 +217,7 @@ for combination in tqdm(random_combinations, total=len(random_combinations)):
                 "advx_acc5": 1 if any(advx_acc5) else 0,
             }
 
-        with open(CONFIG["outpath"], mode="a") as f:
-            writer = csv.DictWriter(f, fieldnames=results.keys())
-            if CONFIG["outpath"].stat().st_size == 0:
-                writer.writeheader()
-            writer.writerow(results)
+        with trace("csv_write"):
+            append_csv_row(CONFIG["outpath"], results)
 
-        torch.cuda.empty_cache()
-        gc.collect()
+        memory.step()
@@ -13,7 +13,9 @@ from tqdm import tqdm
 
 from advx.masks import get_circle_mask, get_diamond_mask, get_knit_mask, get_square_mask, get_word_mask
 from advx.utils import add_overlay
-from metrics.metrics import get_cosine_similarity, get_fid, get_inception_features, get_kid, get_psnr, get_ssim
+from metrics.fidkid import FeatureStats, get_fid_from_stats, get_kid_subsets
+from metrics.metrics import extract_features, get_cosine_similarity, get_psnr, get_ssim
+from metrics.reference import IMAGENET_DATASET, get_reference
 from models.cls import classify_clip
 
 
@@ -62,6 +64,8 @@ CONFIG = {
     "outpath": Path.cwd() / "data" / "eval" / "eval_cls.csv",
     "fidkidpath": Path.cwd() / "data" / "eval" / "eval_cls_fidkid.csv",
     "subset_size": 5,
+    "seed": 42,  # fixed, every combination is compared on the same clean subset
+    "kid_num_subsets": 100,
 }
 CONFIG["outpath"].unlink(missing_ok=True)
 CONFIG["fidkidpath"].unlink(missing_ok=True)
@@ -78,6 +82,10 @@ eval loop
 """
 
 
+# clean-set inception statistics, computed once and reused by every combination (see: metrics/reference.py)
+reference_stats, reference_sample, reference_ids = get_reference(*IMAGENET_DATASET, CONFIG["subset_size"], CONFIG["seed"])
+reference_ids = set(reference_ids.tolist())
+
 random_combinations = list(itertools.product(*COMBINATIONS.values()))
 random.shuffle(random_combinations)
 print(f"total iterations: {len(random_combinations)} * {CONFIG['subset_size']} = {len(random_combinations) * CONFIG['subset_size']}")
@@ -86,11 +94,11 @@ for i, combination in enumerate(random_combinations):
     print(f">>> iteration {i+1}/{len(random_combinations)}")
     combination = dict(zip(COMBINATIONS.keys(), combination))
 
-    dataset = get_imagenet_generator(size=CONFIG["subset_size"])  # ERROR: using uncomparable subsets
+    dataset = get_imagenet_generator(size=CONFIG["subset_size"], seed=CONFIG["seed"])  # same subset as the reference
     labels = get_imagenet_labels()
 
-    x_features = []
     advx_features = []
+    advx_stats = FeatureStats()
 
     # example subset for this combination --------------------
 
@@ -105,8 +113,10 @@ for i, combination in enumerate(random_combinations):
         x: torch.Tensor = transform(x_image).unsqueeze(0)
         advx_x: torch.Tensor = transform(advx_image).unsqueeze(0)
 
-        x_features.append(get_inception_features(x))
-        advx_features.append(get_inception_features(advx_x))
+        assert id in reference_ids, f"image {id} is not in the reference subset"
+        advx_feature = extract_features([advx_image], backbone="inception")[0].numpy()  # full-resolution rgb, same preprocessing as the reference
+        advx_stats.update(advx_feature)
+        advx_features.append(advx_feature)  # kid still needs the samples
 
         def get_acc_boolmask(img: Image.Image) -> list[bool]:
             preds = list(zip(range(len(labels)), classify_clip(img, labels)))  # most adversarially robust model model based on the RoZ paper
@@ -144,11 +154,13 @@ for i, combination in enumerate(random_combinations):
 
     # get fid/kid for this combination ------------------------
 
+    kid_mean, kid_std = get_kid_subsets(reference_sample, advx_features, CONFIG["subset_size"], CONFIG["kid_num_subsets"])
     with open(CONFIG["fidkidpath"], mode="a") as f:
         metrics = {
             **combination,
-            "fid": get_fid(x_features, x_features),
-            "kid": get_kid(advx_features, advx_features, CONFIG["subset_size"]),
+            "fid": get_fid_from_stats(reference_stats, advx_stats),
+            "kid": kid_mean,
+            "kid_std": kid_std,
         }
         writer = csv.DictWriter(f, fieldnames=metrics.keys())
         if CONFIG["fidkidpath"].stat().st_size == 0:
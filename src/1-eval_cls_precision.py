@@ -0,0 +1,106 @@
+import csv
+import gc
+import json
+import time
+from pathlib import Path
+
+import open_clip
+import torch
+from datasets import load_dataset
+from tqdm import tqdm
+
+from models.precision import PRECISIONS, get_input_dtype, get_model_size_mb, get_precision_device, set_precision
+from utils import set_env
+
+
+def get_imagenet_labels() -> list[str]:
+    datapath = Path.cwd() / "data" / "imagenet_labels.json"
+    data = json.loads(datapath.read_text())
+    return list(data.values())
+
+
+"""
+config
+"""
+
+
+seed = 42
+set_env(seed=seed)
+
+CONFIG = {
+    "outpath": Path.cwd() / "data" / "eval" / "eval_cls_precision.csv",
+    "subset_size": 100,  # fixed calibration subset, same for every precision
+}
+MODELS = [
+    ("vit", "ViT-H-14-378-quickgelu", "dfn5b"),
+    ("eva02", "EVA02-E-14-plus", "laion2b_s9b_b144k"),
+    ("eva01", "EVA01-g-14-plus", "merged2b_s11b_b114k"),
+    ("convnext", "convnext_xxlarge", "laion2b_s34b_b82k_augreg_soup"),
+    ("resnet", "RN50x64", "openai"),
+]
+
+
+"""
+eval loop
+"""
+
+
+dataset = load_dataset("visual-layer/imagenet-1k-vl-enriched", split="validation", streaming=False).take(CONFIG["subset_size"]).shuffle(seed=seed)
+dataset = list(map(lambda x: (x["image_id"], x["image"].convert("RGB"), x["label"]), dataset))
+labels = get_imagenet_labels()
+print("loaded dataset: imagenet-1k-vl-enriched")
+
+
+def get_top5(model, preprocess, text_features, device) -> dict[str, list[int]]:
+    top5 = {}
+    with torch.no_grad():
+        for img_id, image, _ in dataset:
+            img = preprocess(image).unsqueeze(0).to(device, dtype=get_input_dtype(model))
+            image_features = model.encode_image(img).float()
+            image_features /= image_features.norm(dim=-1, keepdim=True)
+            text_probs = (100.0 * image_features @ text_features.T).softmax(dim=-1)
+            top5[img_id] = text_probs[0].topk(5).indices.cpu().tolist()
+    return top5
+
+
+for model_key, model_name, pretrained in tqdm(MODELS):
+    reference = None  # fp32 predictions, first precision in the list
+
+    for precision in PRECISIONS:
+        device = get_precision_device(precision)
+        model, _, preprocess = open_clip.create_model_and_transforms(model_name, pretrained=pretrained, device="cpu")
+        model = set_precision(model, precision).to(device)
+        tokenizer = open_clip.get_tokenizer(model_name)
+
+        with torch.no_grad():
+            text_features = model.encode_text(tokenizer(labels).to(device)).float()
+            text_features /= text_features.norm(dim=-1, keepdim=True)
+
+        time_start = time.time()
+        top5 = get_top5(model, preprocess, text_features, device)
+        time_elapsed = time.time() - time_start
+
+        if reference is None:
+            reference = top5
+
+        results = {
+            "model": model_key,
+            "precision": precision,
+            "size_mb": get_model_size_mb(model),
+            "sec_per_img": time_elapsed / len(dataset),
+            "acc1": sum(top5[img_id][0] == label_id for img_id, _, label_id in dataset) / len(dataset),
+            "acc5": sum(label_id in top5[img_id] for img_id, _, label_id in dataset) / len(dataset),
+            "fp32_agree1": sum(top5[img_id][0] == reference[img_id][0] for img_id, _, _ in dataset) / len(dataset),
+            "fp32_agree5": sum(len(set(top5[img_id]) & set(reference[img_id])) / 5 for img_id, _, _ in dataset) / len(dataset),
+        }
+        print(results)
+
+        with open(CONFIG["outpath"], mode="a") as f:
+            writer = csv.DictWriter(f, fieldnames=results.keys())
+            if CONFIG["outpath"].stat().st_size == 0:
+                writer.writeheader()
+            writer.writerow(results)
+
+        del model
+        torch.cuda.empty_cache()
+        gc.collect()
@@ -0,0 +1,101 @@
+import csv
+import gc
+import itertools
+import json
+import time
+from pathlib import Path
+
+import clip
+import torch
+from datasets import load_dataset
+from tqdm import tqdm
+
+from advx.masks import get_diamond_mask
+from advx.utils import add_overlay
+from models.tome import apply_tome, get_token_count, get_tome_schedule
+from utils import get_device, set_env
+
+
+def get_imagenet_labels() -> list[str]:
+    datapath = Path.cwd() / "data" / "imagenet_labels.json"
+    data = json.loads(datapath.read_text())
+    return list(data.values())
+
+
+"""
+config
+"""
+
+
+seed = 42
+set_env(seed=seed)
+device = get_device(disable_mps=True)
+
+CONFIG = {
+    "outpath": Path.cwd() / "data" / "eval" / "eval_cls_tome.csv",
+    "subset_size": 100,
+}
+COMBINATIONS = {
+    "tome_r": [0, 4, 8, 12, 16, 20, 23],  # tokens merged per layer, 0 = baseline
+    "schedule": ["constant", "decreasing"],
+    "opacity": [0, 160],  # clean and diamond-masked images
+}
+
+
+"""
+eval loop
+"""
+
+
+dataset = load_dataset("visual-layer/imagenet-1k-vl-enriched", split="validation", streaming=False).take(CONFIG["subset_size"]).shuffle(seed=seed)
+dataset = list(map(lambda x: (x["image_id"], x["image"].convert("RGB"), x["label"]), dataset))
+labels = get_imagenet_labels()
+overlay = get_diamond_mask(diamond_count=15, diamonds_per_row=10)
+
+combinations = [dict(zip(COMBINATIONS.keys(), c)) for c in itertools.product(*COMBINATIONS.values())]
+combinations = [c for c in combinations if not (c["tome_r"] == 0 and c["schedule"] != "constant")]
+
+model, preprocess = clip.load("ViT-L/14@336px", device=device)
+model.eval()
+num_tokens = model.visual.positional_embedding.shape[0]  # patches + class token of the loaded model, 577 for ViT-L/14@336px
+with torch.no_grad():
+    text_features = model.encode_text(clip.tokenize(labels).to(device)).float()
+    text_features /= text_features.norm(dim=-1, keepdim=True)
+
+for combination in tqdm(combinations):
+    rs = get_tome_schedule(len(model.visual.transformer.resblocks), combination["tome_r"], combination["schedule"])
+    model = apply_tome(model, rs)
+
+    acc1, acc5 = 0, 0
+    time_elapsed = 0.0
+    with torch.no_grad():
+        for img_id, image, label_id in dataset:
+            if combination["opacity"] > 0:
+                image = add_overlay(image, overlay=overlay, opacity=combination["opacity"]).convert("RGB")
+            img = preprocess(image).unsqueeze(0).to(device)
+
+            time_start = time.time()
+            image_features = model.encode_image(img).float()
+            time_elapsed += time.time() - time_start
+
+            image_features /= image_features.norm(dim=-1, keepdim=True)
+            top5 = (100.0 * image_features @ text_features.T).softmax(dim=-1)[0].topk(5).indices.cpu().tolist()
+            acc1 += int(top5[0] == label_id)
+            acc5 += int(label_id in top5)
+
+    results = {
+        **combination,
+        "final_tokens": get_token_count(num_tokens, rs)[-1],
+        "sec_per_img": time_elapsed / len(dataset),
+        "acc1": acc1 / len(dataset),
+        "acc5": acc5 / len(dataset),
+    }
+    print(results)
+
+    with open(CONFIG["outpath"], mode="a") as f:
+        writer = csv.DictWriter(f, fieldnames=results.keys())
+        if CONFIG["outpath"].stat().st_size == 0:
+            writer.writeheader()
+        writer.writerow(results)
+
+    gc.collect()
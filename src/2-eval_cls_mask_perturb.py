@@ -1,5 +1,4 @@
 import csv
-import gc
 import itertools
 import json
 import os
@@ -17,6 +16,7 @@ from tqdm import tqdm
 from advx.masks import get_diamond_mask
 from advx.perturb import get_fgsm_clipvit_imagenet
 from advx.utils import add_overlay
+from memory import MemoryMonitor
 from metrics.metrics import get_cosine_similarity, get_psnr, get_ssim
 from models.cls import classify_clip
 from utils import get_device
@@ -96,6 +96,9 @@ config
 CONFIG = {
     "outpath": Path.cwd() / "data" / "eval" / "eval_cls.csv",
     "subset_size": 5,  # number of samples per combination
+    "memory_every": 50,  # rows between memory snapshots in data/memory/ (see: memory.py)
+    "gc_threshold_mb": 1024,  # rss or device memory growth that triggers a collection
+    "trace_python": False,  # also log the python heap and its top allocation sites, slower
 }
 COMBINATIONS = {
     # most effective from previous experiments
@@ -119,6 +122,7 @@ print(f"total iterations: {len(random_combinations)} * {CONFIG['subset_size']} =
 dataset = load_dataset("visual-layer/imagenet-1k-vl-enriched", split="validation", streaming=True).take(CONFIG["subset_size"]).shuffle(seed=random.randint(0, 1000))
 dataset = list(map(lambda x: (x["image_id"], x["image"].convert("RGB"), x["label"], x["caption_enriched"]), dataset))
 labels = get_imagenet_labels()
+memory = MemoryMonitor(Path(__file__).stem, every=CONFIG["memory_every"], gc_threshold_mb=CONFIG["gc_threshold_mb"], trace_python=CONFIG["trace_python"])
 
 if get_device() == "cuda":
     torch.cuda.empty_cache()
@@ -141,7 +145,8 @@ for combination in tqdm(random_combinations, total=len(random_combinations)):
             continue
 
         with torch.no_grad(), torch.amp.autocast(device_type=get_device(disable_mps=True), enabled="cuda" == get_device()):
-            advx_image = get_advx(x_image, label_id, combination)
+            with memory.stage("advx"):
+                advx_image = get_advx(x_image, label_id, combination)
 
             transform = transforms.Compose([transforms.Resize((256, 256)), transforms.Grayscale(num_output_channels=3), transforms.ToTensor()])
             x: torch.Tensor = transform(x_image).unsqueeze(0)
@@ -154,15 +159,21 @@ for combination in tqdm(random_combinations, total=len(random_combinations)):
                 top5_mask = [label_id == key for key in top5_keys]
                 return top5_mask
 
-            x_acc5 = get_acc_boolmask(x_image)
-            advx_acc5 = get_acc_boolmask(advx_image)
+            with memory.stage("inference"):
+                x_acc5 = get_acc_boolmask(x_image)
+                advx_acc5 = get_acc_boolmask(advx_image)
+
+        with memory.stage("metrics"):
+            metric_row = {
+                "cosine_sim": get_cosine_similarity(x_image, advx_image),
+                "psnr": get_psnr(x, advx_x),
+                "ssim": get_ssim(x, advx_x),
+            }
 
         results = {
             **entry_id,
             # semantic similarity
-            "cosine_sim": get_cosine_similarity(x_image, advx_image),
-            "psnr": get_psnr(x, advx_x),
-            "ssim": get_ssim(x, advx_x),
+            **metric_row,
             # accuracy
             "label": get_imagenet_label(label_id),
             "x_acc1": 1 if x_acc5[0] else 0,
@@ -177,5 +188,4 @@ for combination in tqdm(random_combinations, total=len(random_combinations)):
                 writer.writeheader()
             writer.writerow(results)
 
-        torch.cuda.empty_cache()
-        gc.collect()
+        memory.step()
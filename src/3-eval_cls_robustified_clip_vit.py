@@ -1,5 +1,4 @@
 import csv
-import gc
 import json
 import os
 from pathlib import Path
@@ -13,6 +12,7 @@ from tqdm import tqdm
 
 from advx.masks import get_diamond_mask
 from advx.utils import add_overlay
+from memory import MemoryMonitor
 from metrics.metrics import get_cosine_similarity, get_psnr, get_ssim
 from models.cls import classify_clip, classify_robustified_clip
 from utils import get_device, set_seed
@@ -58,6 +58,9 @@ device = get_device()
 
 # config
 subset = 5_000
+memory_every = 50  # rows between memory snapshots in data/memory/ (see: memory.py)
+gc_threshold_mb = 1024  # rss or device memory growth that triggers a collection
+trace_python = False  # also log the python heap and its top allocation sites, slower
 
 # data
 outpath = Path.cwd() / "data" / "eval" / "eval_cls.csv"
@@ -65,6 +68,7 @@ dataset = load_dataset("visual-layer/imagenet-1k-vl-enriched", split="validation
 dataset = list(map(lambda x: (x["image_id"], x["image"].convert("RGB"), x["label"], x["caption_enriched"]), dataset))
 overlay = get_diamond_mask(diamond_count=15, diamonds_per_row=10)
 labels = get_imagenet_labels()
+memory = MemoryMonitor(Path(__file__).stem, every=memory_every, gc_threshold_mb=gc_threshold_mb, trace_python=trace_python)
 
 if device == "cuda":
     torch.cuda.empty_cache()
@@ -79,7 +83,8 @@ for id, img, label_id, caption in tqdm(dataset):
         print(f"skipping {entry_id}")
         continue
 
-    adv_img = add_overlay(img.convert("RGB"), overlay=overlay, opacity=160).convert("RGB")
+    with memory.stage("advx"):
+        adv_img = add_overlay(img.convert("RGB"), overlay=overlay, opacity=160).convert("RGB")
     transform = transforms.Compose([transforms.Resize((256, 256)), transforms.Grayscale(num_output_channels=3), transforms.ToTensor()])
     x: torch.Tensor = transform(img).unsqueeze(0)
     advx_x: torch.Tensor = transform(adv_img).unsqueeze(0)
@@ -91,15 +96,21 @@ for id, img, label_id, caption in tqdm(dataset):
         top5_mask = [label_id == key for key in top5_keys]
         return top5_mask
 
-    boolmask = get_acc_boolmask(img, classify_clip)
-    adv_boolmask = get_acc_boolmask(adv_img, classify_robustified_clip)
+    with memory.stage("inference"):
+        boolmask = get_acc_boolmask(img, classify_clip)
+        adv_boolmask = get_acc_boolmask(adv_img, classify_robustified_clip)
+
+    with memory.stage("metrics"):
+        metric_row = {
+            "cosine_sim": get_cosine_similarity(img, adv_img),
+            "psnr": get_psnr(x, advx_x),
+            "ssim": get_ssim(x, advx_x),
+        }
 
     results = {
         **entry_id,
         # semantic similarity
-        "cosine_sim": get_cosine_similarity(img, adv_img),
-        "psnr": get_psnr(x, advx_x),
-        "ssim": get_ssim(x, advx_x),
+        **metric_row,
         # accuracy
         "label": get_imagenet_label(label_id),
         "original_acc1": 1 if boolmask[0] else 0,
@@ -114,5 +125,4 @@ for id, img, label_id, caption in tqdm(dataset):
             writer.writeheader()
         writer.writerow(results)
 
-    torch.cuda.empty_cache()
-    gc.collect()
+    memory.step()
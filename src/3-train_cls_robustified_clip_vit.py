@@ -11,6 +11,7 @@ from tqdm import tqdm
 
 from advx.masks import get_diamond_mask
 from advx.utils import add_overlay
+from models.tome import apply_tome
 from utils import get_device, set_seed
 
 torch.backends.cuda.matmul.allow_tf32 = True
@@ -42,6 +43,7 @@ set_seed(seed=seed)
 num_epochs = 20
 lr = 1e-5
 subset = 10_000
+tome_r = 0  # tokens merged per layer, 0 = off (see: models/tome.py)
 
 # data
 dataset = load_dataset("visual-layer/imagenet-1k-vl-enriched", split="train", streaming=True).take(subset)
@@ -54,6 +56,8 @@ model.train()
 for param in model.parameters():
     param.requires_grad = True
 model = model.float()
+if tome_r > 0:
+    model = apply_tome(model, tome_r)
 optimizer = torch.optim.Adam(model.parameters(), lr=lr)
 if get_device() == "cuda":
     torch.cuda.empty_cache()
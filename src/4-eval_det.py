@@ -1,5 +1,4 @@
 import csv
-import gc
 import itertools
 import json
 import random
@@ -8,14 +7,16 @@ from pathlib import Path
 import torch
 import torchvision.transforms as transforms
 from datasets import load_dataset
-from sklearn.metrics import average_precision_score
+from PIL import Image
 from tqdm import tqdm
 
 from advx.background import get_gradient_background, get_perlin_background, get_random_background, get_zigzag_background
 from advx.masks import get_diamond_mask
-from advx.utils import add_overlay, get_rounded_corners, place_within
-from metrics.metrics import get_cosine_similarity, get_iou, get_psnr, get_ssim
-from models.det import detect_vit
+from advx.utils import add_overlay, get_placed_box, get_rounded_corners, place_within
+from memory import MemoryMonitor
+from metrics.detection import DetectionEvaluator, get_iou_matrix
+from metrics.metrics import get_cosine_similarity, get_psnr, get_ssim
+from models.det import detect_vit, detect_vit_tiled
 from utils import get_device, set_env
 
 
@@ -45,17 +46,38 @@ def get_coco_labels() -> list[str]:
     return list(data.values())
 
 
+def get_cell_placement(background: Image.Image, img: Image.Image, cell: tuple[int, int, int, int], padding_ratio: float) -> tuple[float, tuple[int, int]]:
+    # `inner_ratio` and `inner_position` (center) for `place_within` so that `img` fits into the xyxy cell, keeping its aspect ratio
+    x0, y0, x1, y1 = cell
+    scale = min((x1 - x0) / (1 + padding_ratio) / img.size[0], (y1 - y0) / (1 + padding_ratio) / img.size[1])
+    inner_ratio = (img.size[0] * scale) * (img.size[1] * scale) / (background.size[0] * background.size[1])
+    return inner_ratio, ((x0 + x1) // 2, (y0 + y1) // 2)
+
+
+def get_canvas_boxes(boxes: list[list[float]], img: Image.Image, region: tuple[int, int, int, int]) -> list[list[float]]:
+    # xyxy boxes of the original image -> pixels of the canvas the (resized) image was placed into
+    x0, y0, x1, y1 = region
+    sx, sy = (x1 - x0) / img.size[0], (y1 - y0) / img.size[1]
+    return [[x0 + bx0 * sx, y0 + by0 * sy, x0 + bx1 * sx, y0 + by1 * sy] for bx0, by0, bx1, by1 in boxes]
+
+
 """
 config
 """
 
 
 CONFIG = {
-    "outpath": Path.cwd() / "data" / "eval" / "eval_cls.csv",
+    "outpath": Path.cwd() / "data" / "eval" / "eval_det.csv",  # own file, the classification csvs have a different header
     "sample_size": 5,  # runs per combination
     "background_chunk_size": 3,  # number of images to place on a single background
-    "width_multiplier": 3,
+    "width_multiplier": 3,  # canvas is a grid of (width_multiplier x height_multiplier) cells, each the padded size of an image
     "height_multiplier": 2,
+    "tile_size": 840,  # owlvit-large input size, larger canvases are detected tile by tile
+    "tile_overlap": 0.25,
+    "threshold": 0.1,
+    "memory_every": 50,  # rows between memory snapshots in data/memory/ (see: memory.py)
+    "gc_threshold_mb": 1024,  # rss or device memory growth that triggers a collection
+    "trace_python": False,  # also log the python heap and its top allocation sites, slower
 }
 COMBINATIONS = {
     "background": ["perlin", "zigzag", "gradient", "random"],
@@ -84,6 +106,10 @@ dataset = list(dataset)
 dataset = list(map(lambda x: (x["image_id"], x["image"].convert("RGB"), x["objects"]["category"], x["objects"]["bbox"]), dataset))
 
 chunked_dataset = [dataset[i : i + CONFIG["background_chunk_size"]] for i in range(0, len(dataset), CONFIG["background_chunk_size"])]
+assert CONFIG["background_chunk_size"] <= CONFIG["width_multiplier"] * CONFIG["height_multiplier"], "every image needs its own cell"
+dataset_evaluators = {"x": DetectionEvaluator(), "adv_x": DetectionEvaluator(), "canvas": DetectionEvaluator()}
+coco_labels = get_coco_labels()  # text queries for every detection
+memory = MemoryMonitor(Path(__file__).stem, every=CONFIG["memory_every"], gc_threshold_mb=CONFIG["gc_threshold_mb"], trace_python=CONFIG["trace_python"])
 
 for combination in tqdm(random_combinations, total=total_iters):
     combination = dict(zip(COMBINATIONS.keys(), combination))
@@ -101,9 +127,10 @@ for combination in tqdm(random_combinations, total=total_iters):
 
         # get background
         tmp_img = chunk[0][1]
-        width, height = tmp_img.size
-        width = int(width * (1 + combination["background_padding_ratio"]))
-        height = int(height * (1 + combination["background_padding_ratio"]))
+        cell_width = int(tmp_img.size[0] * (1 + combination["background_padding_ratio"]))
+        cell_height = int(tmp_img.size[1] * (1 + combination["background_padding_ratio"]))
+        width = cell_width * CONFIG["width_multiplier"]
+        height = cell_height * CONFIG["height_multiplier"]
         background = None
         if combination["background"] == "perlin":
             background = get_perlin_background(width=width, height=height)
@@ -115,56 +142,90 @@ for combination in tqdm(random_combinations, total=total_iters):
             background = get_random_background(width=width, height=height)
         assert background is not None
 
-        # place image chunk on background (without collision)
-        for label_id, image, boxes, labels in chunk:
-            get_masked_img = lambda img: add_overlay(img, overlay=get_diamond_mask(diamond_count=15, diamonds_per_row=10), opacity=160)
-            image = get_masked_img(image)
-            image = get_rounded_corners(image, fraction=combination["rounded_corner_opacity"])
-
-            background = place_within(background, image, inner_position=(0, 0))
-
-        background.show()
-
-        exit()
-
-        for label_id, image, boxes, labels in chunk:
+        # place image chunk on background (without collision), one random grid cell per image
+        cells = random.sample(range(CONFIG["width_multiplier"] * CONFIG["height_multiplier"]), len(chunk))
+        regions = []  # where images were placed, everything else is background
+        adv_images = []
+        canvas_gt_boxes, canvas_gt_labels = [], []
+        for (image_id, image, boxes, labels), cell in zip(chunk, cells):
+            with memory.stage("advx"):
+                get_masked_img = lambda img: add_overlay(img, overlay=get_diamond_mask(diamond_count=15, diamonds_per_row=10), opacity=160)
+                adv_image = get_masked_img(image).convert("RGB")  # same size as the original, ground truth boxes stay valid
+                adv_images.append(adv_image)
+                placed = get_rounded_corners(adv_image.convert("RGBA"), fraction=combination["rounded_corner_opacity"])
+
+                col, row = cell % CONFIG["width_multiplier"], cell // CONFIG["width_multiplier"]
+                cell_box = (col * cell_width, row * cell_height, (col + 1) * cell_width, (row + 1) * cell_height)
+                inner_ratio, inner_position = get_cell_placement(background, placed, cell_box, combination["background_padding_ratio"])
+                region = get_placed_box(background, placed, inner_ratio=inner_ratio, inner_position=inner_position)
+                background = place_within(background, placed, inner_ratio=inner_ratio, inner_position=inner_position)
+
+                regions.append(region)
+                canvas_gt_boxes.extend(get_canvas_boxes(boxes, image, region))
+                canvas_gt_labels.extend(get_coco_label(label) for label in labels)
+
+        # tiled detection on the whole canvas, scored against the ground truth of every placed image
+        with memory.stage("canvas_inference"):
+            canvas_detections = detect_vit_tiled(background.convert("RGB"), coco_labels, CONFIG["threshold"], tile_size=CONFIG["tile_size"], overlap=CONFIG["tile_overlap"], regions=regions)
+        canvas_boxes, canvas_probs, canvas_labels = canvas_detections.to_lists()[0]
+        canvas_evaluator = DetectionEvaluator()
+        canvas_evaluator.add(canvas_boxes, canvas_probs, canvas_labels, canvas_gt_boxes, canvas_gt_labels)
+        dataset_evaluators["canvas"].add(canvas_boxes, canvas_probs, canvas_labels, canvas_gt_boxes, canvas_gt_labels)
+        canvas_ap = canvas_evaluator.summarize()
+
+        for (image_id, image, boxes, labels), adv_image in zip(chunk, adv_images):
             with torch.no_grad(), torch.amp.autocast(device_type=get_device(disable_mps=True), enabled="cuda" == get_device()):
-                # try to place multiple images on a single background
-                # show result
-
                 transform = transforms.Compose([transforms.Resize((256, 256)), transforms.Grayscale(num_output_channels=3), transforms.ToTensor()])
                 x: torch.Tensor = transform(image).unsqueeze(0)
                 advx_x: torch.Tensor = transform(adv_image).unsqueeze(0)
 
-                def filter_detections(probs, boxes, labels, min_prob=0.5, max_prob=0.95):
-                    filtered = [(prob, box, label) for prob, box, label in zip(probs, boxes, labels) if min_prob <= prob <= max_prob]
-                    if not filtered:
-                        return [], [], []
-                    return map(list, zip(*filtered))
-
                 # also consider: clip grid https://www.pinecone.io/learn/series/image-search/zero-shot-object-detection-clip/#Zero-Shot-CLIP
                 # this would allow us to use the robustified model from the previous step for detection as well
-                x_boxes, x_probs, x_labels = detect_vit(image)
-                adv_x_boxes, adv_x_probs, adv_x_labels = detect_vit(adv_image)
-
-                x_probs_50_95, x_boxes_50_95, x_labels_50_95 = filter_detections(x_probs, x_boxes, x_labels)
-                adv_x_probs_50_95, adv_x_boxes_50_95, adv_x_labels_50_95 = filter_detections(adv_x_probs, adv_x_boxes, adv_x_labels)
+                with memory.stage("inference"):
+                    x_boxes, x_probs, x_labels = detect_vit(image, coco_labels, CONFIG["threshold"])
+                    adv_x_boxes, adv_x_probs, adv_x_labels = detect_vit(adv_image, coco_labels, CONFIG["threshold"])
+
+            def get_ap(pred_boxes, pred_probs, pred_labels, dataset_evaluator: DetectionEvaluator) -> dict[str, float]:
+                # per-sample scores for the csv, the dataset-wide evaluator accumulates the same matches
+                gt_labels = [get_coco_label(label) for label in labels]
+                evaluator = DetectionEvaluator()
+                evaluator.add(pred_boxes, pred_probs, pred_labels, boxes, gt_labels)
+                dataset_evaluator.add(pred_boxes, pred_probs, pred_labels, boxes, gt_labels)
+                return evaluator.summarize()
+
+            x_ap = get_ap(x_boxes, x_probs, x_labels, dataset_evaluators["x"])
+            adv_x_ap = get_ap(adv_x_boxes, adv_x_probs, adv_x_labels, dataset_evaluators["adv_x"])
+
+            with memory.stage("metrics"):
+                metric_row = {
+                    "cosine_sim": get_cosine_similarity(image, adv_image),
+                    "psnr": get_psnr(x, advx_x),
+                    "ssim": get_ssim(x, advx_x),
+                }
 
             results = {
                 **ids,
+                "img_id": image_id,
                 # semantic similarity
-                "cosine_sim": get_cosine_similarity(image, adv_image),
-                "psnr": get_psnr(x, advx_x),
-                "ssim": get_ssim(x, advx_x),
+                **metric_row,
                 # accuracy
-                "ground_truth_labels": labels,  # compute based on where images are placed in background
-                "ground_truth_boxes": boxes,  # compute based on where images are placed in background
-                "ap_x": average_precision_score([1 if label in labels else 0 for label in x_labels], x_probs) if len(x_labels) > 0 else 0.0,
-                "ap_adv_x": average_precision_score([1 if label in labels else 0 for label in adv_x_labels], adv_x_probs) if len(adv_x_labels) > 0 else 0.0,
-                "ap_x_50_95": average_precision_score([1 if label in labels else 0 for label in x_labels_50_95], x_probs_50_95) if len(x_labels_50_95) > 0 else 0.0,
-                "ap_adv_x_50_95": average_precision_score([1 if label in labels else 0 for label in adv_x_labels_50_95], adv_x_probs_50_95) if len(adv_x_labels_50_95) > 0 else 0.0,
-                "iou_x": max([get_iou(box, box_) for box in boxes for box_ in x_boxes]) if len(x_boxes) > 0 else 0.0,
-                "iou_adv_x": max([get_iou(box, box_) for box in boxes for box_ in adv_x_boxes]) if len(adv_x_boxes) > 0 else 0.0,
+                "ground_truth_labels": labels,  # coco category ids
+                "ground_truth_boxes": boxes,  # xyxy in pixels of the original image, the masked image has the same size
+                "ap_x": x_ap["ap"],
+                "ap_adv_x": adv_x_ap["ap"],
+                "ap50_x": x_ap["ap50"],
+                "ap50_adv_x": adv_x_ap["ap50"],
+                "ap75_x": x_ap["ap75"],
+                "ap75_adv_x": adv_x_ap["ap75"],
+                "recall_x": x_ap["recall"],
+                "recall_adv_x": adv_x_ap["recall"],
+                "iou_x": float(get_iou_matrix(boxes, x_boxes).max()) if len(x_boxes) > 0 and len(boxes) > 0 else 0.0,
+                "iou_adv_x": float(get_iou_matrix(boxes, adv_x_boxes).max()) if len(adv_x_boxes) > 0 and len(boxes) > 0 else 0.0,
+                # tiled detection on the canvas with every image of the chunk, same value for each row of the sample
+                "ap_canvas": canvas_ap["ap"],
+                "ap50_canvas": canvas_ap["ap50"],
+                "ap75_canvas": canvas_ap["ap75"],
+                "recall_canvas": canvas_ap["recall"],
             }
 
             with open(CONFIG["outpath"], mode="a") as f:
@@ -173,5 +234,8 @@ for combination in tqdm(random_combinations, total=total_iters):
                     writer.writeheader()
                 writer.writerow(results)
 
-            torch.cuda.empty_cache()
-            gc.collect()
+            memory.step()
+
+
+for key, evaluator in dataset_evaluators.items():
+    print(f"{key}: {evaluator.summarize()}")
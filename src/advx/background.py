@@ -6,7 +6,13 @@ import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 
+try:
+    from .utils import traced
+except ImportError:
+    from utils import traced
 
+
+@traced()
 def get_perlin_background(
     width=1000,
     height=700,
@@ -45,6 +51,7 @@ def get_perlin_background(
     return img
 
 
+@traced()
 def get_zigzag_background(
     width=1000,
     height=700,
@@ -97,6 +104,7 @@ def get_zigzag_background(
     return img
 
 
+@traced()
 def get_gradient_background(
     width=1000,
     height=700,
@@ -120,6 +128,7 @@ def get_gradient_background(
     return img
 
 
+@traced()
 def get_random_background(
     width=1000,
     height=700,
@@ -6,7 +6,13 @@ import cairo
 import numpy as np
 from PIL import Image
 
+try:
+    from .utils import traced
+except ImportError:
+    from utils import traced
 
+
+@traced()
 def get_circle_mask(
     width: int = 1000,
     height: int = 1000,
@@ -49,6 +55,7 @@ def get_circle_mask(
     return Image.frombuffer("RGBA", (width, height), surface.get_data(), "raw", "BGRA", 0, 1)
 
 
+@traced()
 def get_square_mask(
     width: int = 1000,
     height: int = 1000,
@@ -90,6 +97,7 @@ def get_square_mask(
     return Image.frombuffer("RGBA", (width, height), surface.get_data(), "raw", "BGRA", 0, 1)
 
 
+@traced()
 def get_word_mask(
     width: int = 1000,
     height: int = 1000,
@@ -140,6 +148,7 @@ def get_word_mask(
     return Image.fromarray(np.ndarray(shape=(height, width, 4), dtype=np.uint8, buffer=surface.get_data()), "RGBA")
 
 
+@traced()
 def get_knit_mask(
     width: int = 1000,
     height: int = 1000,
@@ -168,6 +177,7 @@ def get_knit_mask(
     return Image.frombuffer("RGBA", (width, height), surface.get_data(), "raw", "BGRA", 0, 1)
 
 
+@traced()
 def get_diamond_mask(
     width: int = 1000,
     height: int = 1000,
@@ -8,13 +8,17 @@ import torchvision.models as models
 import torchvision.transforms as transforms
 from PIL import Image
 
-from utils import get_device
+try:
+    from .utils import get_device, traced
+except ImportError:
+    from utils import get_device, traced
 
 """
 attacks
 """
 
 
+@traced()
 def get_fgsm_resnet_imagenet(image: Image.Image, target: int, epsilon: float, debug: bool = False) -> Image.Image:
     model = models.resnet18(pretrained=True)
     model.eval()
@@ -69,10 +73,15 @@ def get_fgsm_resnet_imagenet(image: Image.Image, target: int, epsilon: float, de
     return transforms.ToPILImage()(perturbed_data.squeeze(0))
 
 
-def get_fgsm_clipvit_imagenet(image: Image.Image, target_idx: int, labels: list, epsilon: float, debug: bool = False) -> Image.Image:
+@traced()
+def get_fgsm_clipvit_imagenet(image: Image.Image, target_idx: int, labels: list, epsilon: float, debug: bool = False, tome_r: int = 0) -> Image.Image:
     device = get_device(disable_mps=True)
     model, preprocess = clip.load("ViT-L/14@336px", device=device)
     model.eval()
+    if tome_r > 0:
+        from models.tome import apply_tome
+
+        model = apply_tome(model, tome_r)  # merging is differentiable, gradients flow back to all patches
 
     # enable gradients for model parameters
     for param in model.parameters():
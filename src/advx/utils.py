@@ -1,8 +1,17 @@
+import sys
+from pathlib import Path
+
 import numpy as np
 import requests
 import torch
 from PIL import Image
 
+try:
+    from tracing import traced
+except ImportError:
+    sys.path.append(str(Path(__file__).resolve().parents[1]))  # run as a script from this directory, `tracing` lives in src/
+    from tracing import traced
+
 
 def get_device(disable_mps=False) -> str:
     if torch.backends.mps.is_available() and not disable_mps:
@@ -13,29 +22,41 @@ def get_device(disable_mps=False) -> str:
         return "cpu"
 
 
-def place_within(
+def get_placed_box(
     background: Image.Image,
     inner: Image.Image,
     inner_ratio: float = 0.25,
     inner_position: tuple[int, int] = (-1, -1),
-):
+) -> tuple[int, int, int, int]:
+    # xyxy box that `place_within` pastes `inner` into, not clipped to the background
     target_area = inner_ratio * background.size[0] * background.size[1]
     aspect_ratio = inner.size[0] / inner.size[1]
 
     new_height = int(np.sqrt(target_area / aspect_ratio))
     new_width = int(aspect_ratio * new_height)
 
-    inner_resized = inner.resize((new_width, new_height), Image.LANCZOS)
-
     paste_position = (inner_position[0] if inner_position[0] >= 0 else (background.size[0] - new_width) // 2, inner_position[1] if inner_position[1] >= 0 else (background.size[1] - new_height) // 2)
 
     paste_position = (paste_position[0] - new_width // 2, paste_position[1] - new_height // 2)
+    return paste_position[0], paste_position[1], paste_position[0] + new_width, paste_position[1] + new_height
+
+
+@traced()
+def place_within(
+    background: Image.Image,
+    inner: Image.Image,
+    inner_ratio: float = 0.25,
+    inner_position: tuple[int, int] = (-1, -1),
+):
+    x0, y0, x1, y1 = get_placed_box(background, inner, inner_ratio, inner_position)
+    inner_resized = inner.resize((x1 - x0, y1 - y0), Image.LANCZOS)
 
     result = background.copy()
-    result.paste(inner_resized, paste_position, inner_resized)
+    result.paste(inner_resized, (x0, y0), inner_resized)
     return result
 
 
+@traced()
 def add_overlay(background: Image.Image, overlay: Image.Image, opacity: int) -> Image.Image:
     # opacity range: 0 (transparent) to 255 (opaque)
     overlay = overlay.resize(background.size)
@@ -46,6 +67,7 @@ def add_overlay(background: Image.Image, overlay: Image.Image, opacity: int) ->
     return result
 
 
+@traced()
 def get_rounded_corners(
     img: Image.Image,
     fraction: float = 0.49,  # range: 0 ; 0.49
@@ -0,0 +1,161 @@
+"""
+memory accounting for long sweeps: rss, python heap (tracemalloc) and torch allocator stats, per pipeline stage and every N iterations,
+appended as json lines to `data/memory/<name>-<pid>.jsonl`.
+garbage collection (and `torch.cuda.empty_cache`) only runs once rss or the accelerator's reserved memory has grown by `gc_threshold_mb`
+since the last collection, device memory never shows up in rss.
+
+usage:
+
+memory = MemoryMonitor("1-eval_cls_mask_density_v2", every=50, gc_threshold_mb=1024)
+for row in rows:
+    with memory.stage("inference"):
+        ...
+    memory.step()  # instead of `torch.cuda.empty_cache(); gc.collect()`
+"""
+
+import contextlib
+import gc
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from pathlib import Path
+from typing import Optional
+
+MEMORY_DIR = Path.cwd() / "data" / "memory"
+MB = 1024**2
+
+
+def get_rss_mb() -> float:
+    # current resident set size, falls back to the peak where /proc is unavailable
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / MB
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / MB if sys.platform == "darwin" else peak / 1024  # bytes on macos, kilobytes on linux
+
+
+def get_torch_memory() -> dict[str, float]:
+    # allocator stats of whichever accelerator is in use, empty on cpu
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return {}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        return {
+            "cuda_allocated_mb": torch.cuda.memory_allocated() / MB,
+            "cuda_reserved_mb": torch.cuda.memory_reserved() / MB,
+            "cuda_peak_allocated_mb": torch.cuda.max_memory_allocated() / MB,
+        }
+    if torch.backends.mps.is_available():
+        return {"mps_allocated_mb": torch.mps.current_allocated_memory() / MB}
+    return {}
+
+
+def get_device_reserved_mb() -> float:
+    # memory held by the accelerator's caching allocator, 0 on cpu
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return 0.0
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch.cuda.memory_reserved() / MB
+    if torch.backends.mps.is_available():
+        return torch.mps.driver_allocated_memory() / MB
+    return 0.0
+
+
+def empty_torch_cache() -> None:
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.empty_cache()
+    elif torch.backends.mps.is_available():
+        torch.mps.empty_cache()
+
+
+class MemoryMonitor:
+    def __init__(self, name: str, every: int = 50, gc_threshold_mb: float = 1024.0, trace_python: bool = False, path: Optional[Path] = None):
+        # trace_python: tracemalloc with 1 frame, the python heap and its top allocation sites are then logged too (slower)
+        self.every = every
+        self.gc_threshold_mb = gc_threshold_mb
+        self.path = path if path is not None else MEMORY_DIR / f"{name}-{os.getpid()}.jsonl"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.iteration = 0
+        self.collections = 0
+        self.baseline_mb = get_rss_mb()  # rss and device memory right after the last collection
+        self.device_baseline_mb = get_device_reserved_mb()
+        self.stage_deltas: dict[str, list[tuple[float, float]]] = defaultdict(list)  # (rss, device) growth per stage call
+
+        if trace_python and not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+        self.log({"event": "start", **self.get_snapshot()})
+
+    def log(self, record: dict) -> None:
+        with open(self.path, mode="a") as f:
+            f.write(json.dumps({"time": time.time(), "iteration": self.iteration, **record}) + "\n")
+
+    def get_snapshot(self) -> dict:
+        snapshot = {"rss_mb": get_rss_mb(), **get_torch_memory(), "gc_counts": gc.get_count()}
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics("lineno")[:5]
+            snapshot["python_current_mb"] = current / MB
+            snapshot["python_peak_mb"] = peak / MB
+            snapshot["python_top"] = [{"site": str(stat.traceback[0]), "size_mb": stat.size / MB, "count": stat.count} for stat in top]
+        return snapshot
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        # rss and device memory growth attributed to this stage, aggregated until the next periodic record
+        rss_start, device_start = get_rss_mb(), get_device_reserved_mb()
+        try:
+            yield
+        finally:
+            self.stage_deltas[name].append((get_rss_mb() - rss_start, get_device_reserved_mb() - device_start))
+
+    def maybe_collect(self) -> bool:
+        # tensors held in reference cycles are only freed by gc, their device memory only returned by `empty_cache`
+        rss_mb, device_mb = get_rss_mb(), get_device_reserved_mb()
+        if rss_mb - self.baseline_mb < self.gc_threshold_mb and device_mb - self.device_baseline_mb < self.gc_threshold_mb:
+            return False
+
+        time_start = time.time()
+        collected = gc.collect()
+        empty_torch_cache()
+        self.baseline_mb, self.device_baseline_mb = get_rss_mb(), get_device_reserved_mb()
+        self.collections += 1
+        self.log(
+            {
+                "event": "collect",
+                "rss_before_mb": rss_mb,
+                "rss_after_mb": self.baseline_mb,
+                "device_before_mb": device_mb,
+                "device_after_mb": self.device_baseline_mb,
+                "objects": collected,
+                "seconds": time.time() - time_start,
+            }
+        )
+        return True
+
+    def step(self) -> None:
+        # call once per iteration
+        self.iteration += 1
+        self.maybe_collect()
+        if self.iteration % self.every == 0:
+            stages = {
+                name: {
+                    "count": len(deltas),
+                    "rss_total_delta_mb": sum(rss for rss, _ in deltas),
+                    "rss_max_delta_mb": max(rss for rss, _ in deltas),
+                    "device_total_delta_mb": sum(device for _, device in deltas),
+                    "device_max_delta_mb": max(device for _, device in deltas),
+                }
+                for name, deltas in self.stage_deltas.items()
+            }
+            self.log({"event": "snapshot", **self.get_snapshot(), "collections": self.collections, "stages": stages})
+            self.stage_deltas.clear()
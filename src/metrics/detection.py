@@ -0,0 +1,147 @@
+from collections import defaultdict
+from typing import Hashable
+
+import numpy as np
+
+"""
+detection metrics
+
+coco-style evaluation: detections are greedily matched to ground truth per image and class in descending score order,
+each detection takes the unmatched ground truth box with the highest iou above the threshold.
+precision is interpolated at 101 recall points and averaged over classes and iou thresholds .50:.05:.95.
+boxes are xyxy.
+"""
+
+
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+RECALL_POINTS = np.linspace(0, 1, 101)
+
+
+def get_iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    # (n, 4) x (m, 4) -> (n, m)
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    intersection = wh[..., 0] * wh[..., 1]
+
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros(union.shape, dtype=np.float64), where=union > 0)
+
+
+def match_detections(iou: np.ndarray, iou_thresholds: np.ndarray = IOU_THRESHOLDS) -> np.ndarray:
+    # iou: (d, g) with detections sorted by descending score, returns (t, d) true-positive flags
+    num_thresholds, (num_dets, num_gts) = len(iou_thresholds), iou.shape
+    tp = np.zeros((num_thresholds, num_dets), dtype=bool)
+    if num_dets == 0 or num_gts == 0:
+        return tp
+
+    matched = np.zeros((num_thresholds, num_gts), dtype=bool)
+    for d in range(num_dets):
+        # all thresholds at once: best still unmatched ground truth that clears each threshold
+        candidates = np.where(matched, -1.0, iou[d][None, :])
+        best = candidates.argmax(axis=1)
+        hit = candidates[np.arange(num_thresholds), best] >= iou_thresholds
+        tp[hit, d] = True
+        matched[np.flatnonzero(hit), best[hit]] = True
+    return tp
+
+
+def get_average_precision(tp: np.ndarray, scores: np.ndarray, num_gts: int) -> tuple[np.ndarray, np.ndarray]:
+    # tp: (t, d), returns (t,) average precision and (t,) recall, nan if the class has no ground truth
+    num_thresholds = tp.shape[0]
+    if num_gts == 0:
+        return np.full(num_thresholds, np.nan), np.full(num_thresholds, np.nan)
+    if tp.shape[1] == 0:
+        return np.zeros(num_thresholds), np.zeros(num_thresholds)
+
+    order = np.argsort(-scores, kind="mergesort")
+    tp = tp[:, order]
+    tp_cum = np.cumsum(tp, axis=1)
+    fp_cum = np.cumsum(~tp, axis=1)
+    recall = tp_cum / num_gts
+    precision = tp_cum / (tp_cum + fp_cum)
+    precision = np.maximum.accumulate(precision[:, ::-1], axis=1)[:, ::-1]  # monotone envelope
+
+    ap = np.zeros(num_thresholds)
+    for t in range(num_thresholds):
+        idx = np.searchsorted(recall[t], RECALL_POINTS, side="left")
+        valid = idx < recall.shape[1]
+        ap[t] = np.where(valid, precision[t][np.minimum(idx, recall.shape[1] - 1)], 0).mean()
+    return ap, recall[:, -1]
+
+
+class DetectionEvaluator:
+    # add images one by one (or in any order across a dataset), then summarize once
+    def __init__(self, iou_thresholds: np.ndarray = IOU_THRESHOLDS, max_detections: int = 100):
+        self.iou_thresholds = np.asarray(iou_thresholds)
+        self.max_detections = max_detections
+        self.tps: dict[Hashable, list[np.ndarray]] = defaultdict(list)
+        self.scores: dict[Hashable, list[np.ndarray]] = defaultdict(list)
+        self.num_gts: dict[Hashable, int] = defaultdict(int)
+
+    def add(self, boxes: np.ndarray, scores: np.ndarray, labels: list[Hashable], gt_boxes: np.ndarray, gt_labels: list[Hashable]) -> None:
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        gt_boxes = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)
+        labels, gt_labels = np.asarray(labels), np.asarray(gt_labels)
+
+        keep = np.argsort(-scores, kind="mergesort")[: self.max_detections]
+        boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+
+        for label in set(labels.tolist()) | set(gt_labels.tolist()):
+            det_mask, gt_mask = labels == label, gt_labels == label
+            iou = get_iou_matrix(boxes[det_mask], gt_boxes[gt_mask])
+            self.tps[label].append(match_detections(iou, self.iou_thresholds))
+            self.scores[label].append(scores[det_mask])
+            self.num_gts[label] += int(gt_mask.sum())
+
+    def get_per_class(self) -> dict[Hashable, tuple[np.ndarray, np.ndarray]]:
+        # label -> ((t,) ap, (t,) recall)
+        per_class = {}
+        for label in self.tps:
+            tp = np.concatenate(self.tps[label], axis=1)
+            scores = np.concatenate(self.scores[label])
+            per_class[label] = get_average_precision(tp, scores, self.num_gts[label])
+        return per_class
+
+    def summarize(self) -> dict[str, float]:
+        per_class = self.get_per_class()
+        if len(per_class) == 0:
+            return {"ap": float("nan"), "ap50": float("nan"), "ap75": float("nan"), "recall": float("nan")}
+
+        ap = np.stack([ap for ap, _ in per_class.values()])  # (classes, t), nan rows for classes without ground truth
+        recall = np.stack([recall for _, recall in per_class.values()])
+        t50 = int(np.argmin(np.abs(self.iou_thresholds - 0.5)))
+        t75 = int(np.argmin(np.abs(self.iou_thresholds - 0.75)))
+        with np.errstate(invalid="ignore"):
+            return {
+                "ap": float(np.nanmean(ap)) if not np.isnan(ap).all() else float("nan"),
+                "ap50": float(np.nanmean(ap[:, t50])) if not np.isnan(ap[:, t50]).all() else float("nan"),
+                "ap75": float(np.nanmean(ap[:, t75])) if not np.isnan(ap[:, t75]).all() else float("nan"),
+                "recall": float(np.nanmean(recall)) if not np.isnan(recall).all() else float("nan"),
+            }
+
+
+"""
+example usage
+"""
+
+
+if __name__ == "__main__":
+    gt_boxes = [[10, 10, 50, 50], [60, 60, 100, 120]]
+    gt_labels = ["cat", "dog"]
+    boxes = [[12, 8, 52, 49], [58, 65, 101, 118], [0, 0, 20, 20]]
+    scores = [0.9, 0.8, 0.3]
+    labels = ["cat", "dog", "cat"]
+
+    print(f"iou matrix:\n{get_iou_matrix(boxes, gt_boxes)}")
+
+    evaluator = DetectionEvaluator()
+    for _ in range(3):
+        evaluator.add(boxes, scores, labels, gt_boxes, gt_labels)
+    print(evaluator.summarize())
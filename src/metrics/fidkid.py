@@ -0,0 +1,169 @@
+from typing import Optional
+
+import numpy as np
+
+try:
+    from .utils import traced
+except ImportError:
+    from utils import traced
+
+"""
+fid
+
+running moments of inception features, updated batch by batch with chan's parallel variant of welford's algorithm in float64.
+two accumulators (e.g. from different worker processes) merge with the same update, so features never have to be held in memory.
+"""
+
+
+class FeatureStats:
+    def __init__(self, dim: int = 2048):
+        self.dim = dim
+        self.n = 0
+        self.mean = np.zeros(dim, dtype=np.float64)
+        self.m2 = np.zeros((dim, dim), dtype=np.float64)  # centered scatter matrix, cov = m2 / (n - 1)
+
+    def _combine(self, n: int, mean: np.ndarray, m2: np.ndarray) -> "FeatureStats":
+        if n == 0:
+            return self
+        total = self.n + n
+        delta = mean - self.mean
+        self.m2 += m2 + np.outer(delta, delta) * (self.n * n / total)
+        self.mean += delta * (n / total)
+        self.n = total
+        return self
+
+    def update(self, features: np.ndarray) -> "FeatureStats":
+        # features: (n, dim) or (dim,)
+        features = np.asarray(features, dtype=np.float64).reshape(-1, self.dim)
+        if len(features) == 0:
+            return self
+        mean = features.mean(axis=0)
+        centered = features - mean
+        return self._combine(len(features), mean, centered.T @ centered)
+
+    def merge(self, other: "FeatureStats") -> "FeatureStats":
+        assert self.dim == other.dim
+        return self._combine(other.n, other.mean, other.m2)
+
+    @property
+    def cov(self) -> np.ndarray:
+        assert self.n > 1, "covariance needs at least two samples"
+        return self.m2 / (self.n - 1)
+
+    def to_dict(self) -> dict[str, np.ndarray]:
+        # plain arrays, for `np.savez` or sending between processes
+        return {"n": np.array(self.n), "mean": self.mean, "m2": self.m2}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FeatureStats":
+        stats = cls(dim=len(data["mean"]))
+        stats.n = int(data["n"])
+        stats.mean = np.array(data["mean"], dtype=np.float64)
+        stats.m2 = np.array(data["m2"], dtype=np.float64)
+        return stats
+
+
+def get_sqrtm_psd(sigma: np.ndarray) -> np.ndarray:
+    # symmetric square root of a positive semi-definite matrix
+    eigvals, eigvecs = np.linalg.eigh(sigma)
+    return (eigvecs * np.sqrt(np.clip(eigvals, 0, None))) @ eigvecs.T
+
+
+def get_trace_sqrt_product(sigma1: np.ndarray, sigma2: np.ndarray) -> float:
+    # tr(sqrt(sigma1 @ sigma2)) = sum of sqrt eigenvalues of sqrt(sigma1) @ sigma2 @ sqrt(sigma1), which is symmetric
+    sqrt_sigma1 = get_sqrtm_psd(sigma1)
+    eigvals = np.linalg.eigvalsh(sqrt_sigma1 @ sigma2 @ sqrt_sigma1)
+    return float(np.sqrt(np.clip(eigvals, 0, None)).sum())
+
+
+@traced()
+def get_fid_from_moments(mu1: np.ndarray, sigma1: np.ndarray, mu2: np.ndarray, sigma2: np.ndarray) -> float:
+    # fid = fréchet inception distance
+    ssdiff = float(np.sum((mu1 - mu2) ** 2))
+    return ssdiff + float(np.trace(sigma1) + np.trace(sigma2)) - 2 * get_trace_sqrt_product(sigma1, sigma2)
+
+
+def get_fid_from_stats(real_stats: FeatureStats, fake_stats: FeatureStats) -> float:
+    return get_fid_from_moments(real_stats.mean, real_stats.cov, fake_stats.mean, fake_stats.cov)
+
+
+"""
+kid
+
+unbiased mmd² with the cubic polynomial kernel k(x, y) = (x·y / d + 1)³, averaged over random subsets.
+every kernel matrix is one float32 matmul per row chunk, sums are accumulated in float64.
+"""
+
+
+def get_polynomial_kernel(x: np.ndarray, y: np.ndarray, degree: int = 3, coef0: float = 1.0) -> np.ndarray:
+    # same defaults as `sklearn.metrics.pairwise.polynomial_kernel`
+    gamma = 1.0 / x.shape[1]
+    return (x @ y.T * gamma + coef0) ** degree
+
+
+def get_kernel_sum(x: np.ndarray, y: np.ndarray, chunk_size: int = 1024, exclude_diagonal: bool = False) -> float:
+    # sum over all entries of k(x, y) without materializing more than (chunk_size, len(y)) at once
+    total = 0.0
+    for i in range(0, len(x), chunk_size):
+        kernel = get_polynomial_kernel(x[i : i + chunk_size], y)
+        total += float(kernel.sum(dtype=np.float64))
+        if exclude_diagonal:
+            total -= float(np.trace(kernel[:, i : i + chunk_size], dtype=np.float64))  # x is y, diagonal block of this chunk
+    return total
+
+
+def get_mmd2_unbiased(real: np.ndarray, fake: np.ndarray, chunk_size: int = 1024) -> float:
+    m, n = len(real), len(fake)
+    assert m > 1 and n > 1, "unbiased estimator needs at least two samples per set"
+    k_rr = get_kernel_sum(real, real, chunk_size, exclude_diagonal=True) / (m * (m - 1))
+    k_ff = get_kernel_sum(fake, fake, chunk_size, exclude_diagonal=True) / (n * (n - 1))
+    k_rf = get_kernel_sum(real, fake, chunk_size) / (m * n)
+    return k_rr + k_ff - 2 * k_rf
+
+
+@traced()
+def get_kid_subsets(real_features: np.ndarray, fake_features: np.ndarray, subset_size: int = 1000, num_subsets: int = 100, seed: Optional[int] = 0, chunk_size: int = 1024) -> tuple[float, float]:
+    # kid = kernel inception distance, returns (mean, std) over subsets drawn without replacement
+    real_features = np.asarray(real_features, dtype=np.float32)
+    fake_features = np.asarray(fake_features, dtype=np.float32)
+    subset_size = min(len(real_features), len(fake_features), subset_size)
+    if subset_size == len(real_features) == len(fake_features):
+        num_subsets = 1  # every subset would be the full set
+
+    rng = np.random.default_rng(seed)
+    mmds = []
+    for _ in range(num_subsets):
+        real_subset = real_features[rng.choice(len(real_features), subset_size, replace=False)]
+        fake_subset = fake_features[rng.choice(len(fake_features), subset_size, replace=False)]
+        mmds.append(get_mmd2_unbiased(real_subset, fake_subset, chunk_size))
+    return float(np.mean(mmds)), float(np.std(mmds))
+
+
+"""
+example usage
+"""
+
+
+if __name__ == "__main__":
+    from scipy.linalg import sqrtm
+
+    rng = np.random.default_rng(0)
+    real = rng.normal(size=(512, 64))
+    fake = rng.normal(loc=0.1, size=(512, 64)) @ rng.normal(scale=0.2, size=(64, 64))
+
+    # streamed in batches from two "workers", then merged
+    worker1, worker2 = FeatureStats(dim=64), FeatureStats(dim=64)
+    for batch in np.array_split(real[:300], 7):
+        worker1.update(batch)
+    for batch in np.array_split(real[300:], 5):
+        worker2.update(batch)
+    real_stats = worker1.merge(worker2)
+    fake_stats = FeatureStats(dim=64).update(fake)
+    assert np.allclose(real_stats.cov, np.cov(real, rowvar=False))
+
+    mu1, sigma1, mu2, sigma2 = real.mean(0), np.cov(real, rowvar=False), fake.mean(0), np.cov(fake, rowvar=False)
+    reference = np.sum((mu1 - mu2) ** 2) + np.trace(sigma1 + sigma2 - 2 * sqrtm(sigma1 @ sigma2).real)
+    print(f"fid streamed: {get_fid_from_stats(real_stats, fake_stats):.6f}, scipy sqrtm: {reference:.6f}")
+
+    kid_mean, kid_std = get_kid_subsets(real, fake, subset_size=128, num_subsets=50)
+    print(f"kid: {kid_mean:.6f} ± {kid_std:.6f}")
@@ -0,0 +1,124 @@
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torchvision.transforms import CenterCrop, Compose, Normalize, Resize
+from torchvision.transforms.functional import resize, rgb_to_grayscale, to_tensor
+
+try:
+    from .metrics import BACKBONE_TRANSFORMS, embed_backbone_inputs, get_ssim
+    from .perceptual import get_lpips_batch, get_ms_ssim_batch, get_psnr_batch, get_ssim_batch
+    from .utils import traced
+except ImportError:
+    from perceptual import get_lpips_batch, get_ms_ssim_batch, get_psnr_batch, get_ssim_batch
+
+    from metrics import BACKBONE_TRANSFORMS, embed_backbone_inputs, get_ssim
+    from utils import traced
+
+
+"""
+fused perceptual metrics
+
+each image is decoded to a tensor once, every metric input is derived from that tensor:
+- "pixel": input of psnr, ssim, ssim_gaussian, ms-ssim and lpips, one of `PIXEL_VIEWS`
+- "vit": 224x224 normalized (cosine similarity)
+- "inception": 299x299 normalized (pool features for fid/kid)
+
+pixel views:
+- "gray": 256x256 grayscale as 3 channels, in [0, 1] (1-eval_cls_mask_density.py)
+- "imagenet_224", "imagenet_448": center crop normalized with the imagenet mean/std, the per-model inputs of 1-eval_cls_mask_density_v2.py
+
+"ssim" is skimage's uniform-window ssim, as in every existing csv, "ssim_gaussian" is the batched gaussian-window variant (see: perceptual.py).
+"""
+
+
+METRIC_VIEWS = {
+    "cosine_sim": "vit",
+    "psnr": "pixel",
+    "ssim": "pixel",
+    "ssim_gaussian": "pixel",
+    "ms_ssim": "pixel",
+    "lpips": "pixel",
+    "inception": "inception",
+}
+
+IMAGENET_NORMALIZE = Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+PIXEL_VIEWS = {
+    "gray": lambda base: rgb_to_grayscale(resize(base, [256, 256], antialias=True), num_output_channels=3),
+    "imagenet_224": Compose([Resize(224, antialias=True), CenterCrop(224), IMAGENET_NORMALIZE]),
+    "imagenet_448": Compose([Resize(448, antialias=True), CenterCrop(448), IMAGENET_NORMALIZE]),
+}
+
+
+@traced()
+def get_metric_views(images: list[Image.Image], views: set[str], pixel_view: str = "gray") -> dict[str, torch.Tensor]:
+    out = {view: [] for view in views}
+    for img in images:
+        base = to_tensor(img.convert("RGB"))  # the only pil -> tensor conversion
+        if "pixel" in views:
+            out["pixel"].append(PIXEL_VIEWS[pixel_view](base))
+        for backbone in ["vit", "inception"]:
+            if backbone in views:
+                out[backbone].append(BACKBONE_TRANSFORMS[backbone](base))
+    return {view: torch.stack(tensors) for view, tensors in out.items()}
+
+
+@traced()
+def get_perceptual_metrics(xs: list[Image.Image], advxs: list[Image.Image], metrics: list[str], batch_size: int = 32, pixel_view: str = "gray") -> dict[str, torch.Tensor]:
+    # (n,) per metric for each pair (xs[i], advxs[i]), "inception" returns the (n, 2048) features as "x_inception" / "advx_inception"
+    # `pixel_view` must match the view an existing csv was written with, otherwise its columns mix two definitions
+    assert len(xs) == len(advxs)
+    assert all(metric in METRIC_VIEWS for metric in metrics)
+    assert pixel_view in PIXEL_VIEWS
+    n = len(xs)
+    if n == 0:
+        return {}
+
+    views = get_metric_views(xs + advxs, {METRIC_VIEWS[metric] for metric in metrics}, pixel_view)
+    out = {}
+
+    if "pixel" in views:
+        x, advx = views["pixel"][:n], views["pixel"][n:]
+        if "psnr" in metrics:
+            out["psnr"] = get_psnr_batch(x, advx)
+        if "ssim" in metrics:
+            out["ssim"] = torch.tensor([get_ssim(x_i, advx_i) for x_i, advx_i in zip(x, advx)])
+        if "ssim_gaussian" in metrics:
+            out["ssim_gaussian"] = get_ssim_batch(x, advx)
+        if "ms_ssim" in metrics:
+            out["ms_ssim"] = get_ms_ssim_batch(x, advx)
+        if "lpips" in metrics:
+            out["lpips"] = get_lpips_batch(x, advx, batch_size=batch_size, normalize=pixel_view == "gray").cpu()  # imagenet views are passed as is
+
+    if "cosine_sim" in metrics:
+        features = embed_backbone_inputs(views["vit"], "vit", batch_size)  # clean and adversarial share the same batches
+        out["cosine_sim"] = F.cosine_similarity(features[:n], features[n:])
+
+    if "inception" in metrics:
+        features = embed_backbone_inputs(views["inception"], "inception", batch_size)
+        out["x_inception"], out["advx_inception"] = features[:n], features[n:]
+
+    order = [name for metric in metrics for name in ([f"x_{metric}", f"advx_{metric}"] if metric == "inception" else [metric])]
+    return {name: out[name] for name in order}  # csv columns follow the configured order
+
+
+def get_metric_rows(metrics: dict[str, torch.Tensor]) -> list[dict[str, float]]:
+    # one dict of scalars per pair, for csv rows, feature matrices are left out
+    scalars = {name: values.tolist() for name, values in metrics.items() if values.dim() == 1}
+    n = len(next(iter(scalars.values()))) if scalars else 0
+    return [{name: values[i] for name, values in scalars.items()} for i in range(n)]
+
+
+"""
+example usage
+"""
+
+
+if __name__ == "__main__":
+    import requests
+
+    url = "http://images.cocodataset.org/val2017/000000039769.jpg"
+    image = Image.open(requests.get(url, stream=True).raw).convert("RGB")
+    noisy = Image.fromarray(((to_tensor(image) + 0.05 * torch.randn(3, image.height, image.width)).clamp(0, 1) * 255).byte().permute(1, 2, 0).numpy())
+
+    metrics = get_perceptual_metrics([image, image], [image, noisy], ["cosine_sim", "psnr", "ssim", "ssim_gaussian", "ms_ssim", "lpips"])
+    print(get_metric_rows(metrics))
@@ -1,16 +1,28 @@
+import functools
 import time
-from typing import Callable
+from typing import Callable, Union
 
 import numpy as np
 import requests
 import torch
 from PIL import Image
-from scipy.linalg import sqrtm
 from skimage.metrics import structural_similarity
-from sklearn.metrics.pairwise import polynomial_kernel
 from torchvision.models import inception_v3
 from torchvision.transforms import CenterCrop, Compose, Normalize, Resize
-from transformers import ViTFeatureExtractor, ViTModel
+from torchvision.transforms.functional import to_tensor
+from transformers import ViTModel
+
+try:
+    from .detection import get_iou_matrix
+    from .fidkid import FeatureStats, get_fid_from_stats, get_kid_subsets
+    from .perceptual import get_psnr_batch
+    from .utils import get_device, traced
+except ImportError:
+    from detection import get_iou_matrix
+    from fidkid import FeatureStats, get_fid_from_stats, get_kid_subsets
+    from perceptual import get_psnr_batch
+
+    from utils import get_device, traced
 
 
 def get_time_result(func: Callable, *args):
@@ -21,88 +33,126 @@ def get_time_result(func: Callable, *args):
 
 
 def get_inception_features(x: torch.Tensor) -> np.ndarray:
-    inception = inception_v3(pretrained=True, transform_input=False).eval()
-    inception_transform = Compose([Resize(299), CenterCrop(299), Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-    with torch.no_grad():
-        feature = inception(inception_transform(x)).squeeze().cpu().numpy()
-    return feature
+    return extract_features(x, backbone="inception").squeeze().numpy()
 
 
 def get_psnr(x: torch.Tensor, x_hat: torch.Tensor) -> float:
-    mse = torch.mean((x - x_hat) ** 2)
-    return float(20 * torch.log10(1.0 / torch.sqrt(mse)))
+    # single pair, see: perceptual.py for whole batches
+    return float(get_psnr_batch(x.reshape(1, -1), x_hat.reshape(1, -1))[0])
 
 
+@traced()
 def get_ssim(x: torch.Tensor, x_hat: torch.Tensor) -> float:
     return structural_similarity(np.array(x.squeeze().permute(1, 2, 0).cpu().numpy()), np.array(x_hat.squeeze().permute(1, 2, 0).cpu().numpy()), multichannel=True, channel_axis=2, data_range=1.0)
 
 
 def get_fid(real_features: np.ndarray, fake_features: np.ndarray) -> float:
-    # fid = fréchet inception distance
+    # fid = fréchet inception distance, see: fidkid.py to accumulate features without keeping them
     real_features = np.array(real_features)
     fake_features = np.array(fake_features)
-    mu1, sigma1 = real_features.mean(axis=0), np.cov(real_features, rowvar=False)
-    mu2, sigma2 = fake_features.mean(axis=0), np.cov(fake_features, rowvar=False)
-    ssdiff = np.sum((mu1 - mu2) ** 2)
-    covmean = sqrtm(sigma1.dot(sigma2))
-    if np.iscomplexobj(covmean):  # type: ignore
-        covmean = covmean.real  # type: ignore
-    fid = ssdiff + np.trace(sigma1 + sigma2 - 2 * covmean)  # type: ignore
-    return fid
+    dim = real_features.shape[-1]
+    return get_fid_from_stats(FeatureStats(dim).update(real_features), FeatureStats(dim).update(fake_features))
 
 
 def get_kid(real_features: np.ndarray, fake_features: np.ndarray, subset_size: int) -> float:
-    # kid = kernel inception distance
-    real_features = np.array(real_features)
-    fake_features = np.array(fake_features)
-    n = min(real_features.shape[0], fake_features.shape[0], subset_size)
-    real_subset = real_features[:n]
-    fake_subset = fake_features[:n]
-    mmds = []
-    for i in range(n):
-        mmd = polynomial_kernel(real_subset[i : i + 1], fake_subset).mean()
-        mmd -= polynomial_kernel(real_subset[i : i + 1], real_subset).mean()
-        mmd += polynomial_kernel(fake_subset[i : i + 1], fake_subset).mean()
-        mmds.append(mmd)
-    return float(np.mean(mmds))
+    # kid = kernel inception distance, see: fidkid.py for the std over subsets
+    kid_mean, _ = get_kid_subsets(real_features, fake_features, subset_size)
+    return kid_mean
 
 
 def get_iou(box1: list[float], box2: list[float]) -> float:
-    # iou = intersection over union
-    x1, y1, x2, y2 = box1
-    x1_, y1_, x2_, y2_ = box2
-    xi1, yi1 = max(x1, x1_), max(y1, y1_)
-    xi2, yi2 = min(x2, x2_), min(y2, y2_)
-    intersection = max(0, xi2 - xi1) * max(0, yi2 - yi1)
-    box1_area = (x2 - x1) * (y2 - y1)
-    box2_area = (x2_ - x1_) * (y2_ - y1_)
-    return intersection / (box1_area + box2_area - intersection)
+    # iou = intersection over union, see: detection.py for whole box sets
+    return float(get_iou_matrix([box1], [box2])[0, 0])
 
 
-def get_cosine_similarity(x: Image.Image, y: Image.Image) -> float:
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model_name = "google/vit-base-patch16-224"
-    feature_extractor = ViTFeatureExtractor.from_pretrained(model_name)
-    model = ViTModel.from_pretrained(model_name).to(device)
+def get_cosine_similarity(x: Union[Image.Image, torch.Tensor], y: Union[Image.Image, torch.Tensor]) -> float:
+    xs = x.reshape(-1, *x.shape[-3:]) if isinstance(x, torch.Tensor) else [x]
+    ys = y.reshape(-1, *y.shape[-3:]) if isinstance(y, torch.Tensor) else [y]
+    return get_cosine_similarity_batch(xs, ys).item()
 
-    x = x.convert("RGB")
-    y = y.convert("RGB")
 
-    inputs1 = feature_extractor(images=x, return_tensors="pt")
-    inputs2 = feature_extractor(images=y, return_tensors="pt")
-
-    inputs1 = {k: v.to(device) for k, v in inputs1.items()}
-    inputs2 = {k: v.to(device) for k, v in inputs2.items()}
-
-    with torch.no_grad():
-        outputs1 = model(**inputs1)
-        outputs2 = model(**inputs2)
+"""
+backbones
+"""
 
-    latents1 = outputs1.last_hidden_state[:, 0, :]  # use CLS token as image representation
-    latents2 = outputs2.last_hidden_state[:, 0, :]
 
-    cosine_sim = torch.nn.functional.cosine_similarity(latents1, latents2).item()
-    return cosine_sim
+VIT_MODEL_ID = "google/vit-base-patch16-224"
+BACKBONES = ["vit", "inception"]
+
+Images = Union[list[Image.Image], torch.Tensor]  # pil images or (n, c, h, w) in [0, 1]
+
+BACKBONE_TRANSFORMS = {
+    "vit": Compose([Resize((224, 224), antialias=True), Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])]),  # same as the vit feature extractor
+    "inception": Compose([Resize(299, antialias=True), CenterCrop(299), Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]),
+}
+
+
+@functools.cache
+@traced()
+def load_vit(device: str) -> ViTModel:
+    # loaded once per process, every metric call reuses it
+    model = ViTModel.from_pretrained(VIT_MODEL_ID).to(device)
+    model.eval()
+    return model
+
+
+@functools.cache
+@traced()
+def load_inception(device: str) -> torch.nn.Module:
+    inception = inception_v3(pretrained=True, transform_input=False)
+    inception.fc = torch.nn.Identity()  # 2048-d pool features instead of class logits, as used by fid/kid
+    inception = inception.to(device)
+    inception.eval()
+    return inception
+
+
+def get_backbone_inputs(images: Images, backbone: str) -> torch.Tensor:
+    transform = BACKBONE_TRANSFORMS[backbone]
+    if isinstance(images, torch.Tensor):
+        batch = images if images.dim() == 4 else images.unsqueeze(0)
+        batch = batch.float().expand(-1, 3, -1, -1) if batch.shape[1] == 1 else batch.float()
+        return transform(batch)
+    return torch.stack([transform(to_tensor(img.convert("RGB"))) for img in images])  # resized one by one, sizes may differ
+
+
+@traced()
+def extract_features(images: Images, backbone: str = "vit", batch_size: int = 32) -> torch.Tensor:
+    # (n, d) cpu float, vit: cls token (768), inception: pool features (2048)
+    assert backbone in BACKBONES
+    features = []
+    for i in range(0, len(images), batch_size):
+        features.append(embed_backbone_inputs(get_backbone_inputs(images[i : i + batch_size], backbone), backbone, batch_size))
+    return torch.cat(features)
+
+
+def embed_backbone_inputs(inputs: torch.Tensor, backbone: str, batch_size: int = 32) -> torch.Tensor:
+    # inputs already resized and normalized by `get_backbone_inputs`
+    assert backbone in BACKBONES
+    device = get_device(disable_mps=True)
+    model = load_vit(device) if backbone == "vit" else load_inception(device)
+
+    features = []
+    for i in range(0, len(inputs), batch_size):
+        chunk = inputs[i : i + batch_size].to(device)
+        with torch.no_grad():
+            if backbone == "vit":
+                feats = model(pixel_values=chunk).last_hidden_state[:, 0, :]  # use CLS token as image representation
+            else:
+                feats = model(chunk)
+        features.append(feats.float().cpu())
+    return torch.cat(features)
+
+
+def get_cosine_similarity_batch(xs: Images, ys: Images, batch_size: int = 32) -> torch.Tensor:
+    # (n,) similarity of each pair (xs[i], ys[i]), both sides go through the backbone in the same batches
+    assert len(xs) == len(ys)
+    if isinstance(xs, torch.Tensor) and isinstance(ys, torch.Tensor) and xs.shape[1:] == ys.shape[1:]:
+        features = extract_features(torch.cat([xs, ys]), backbone="vit", batch_size=batch_size)
+    elif isinstance(xs, list) and isinstance(ys, list):
+        features = extract_features(xs + ys, backbone="vit", batch_size=batch_size)
+    else:
+        features = torch.cat([extract_features(xs, backbone="vit", batch_size=batch_size), extract_features(ys, backbone="vit", batch_size=batch_size)])
+    return torch.nn.functional.cosine_similarity(features[: len(xs)], features[len(xs) :])
 
 
 """
@@ -118,3 +168,4 @@ if __name__ == "__main__":
     image2 = Image.open(requests.get(url2, stream=True).raw).convert("RGB")
 
     print(f"cosine similarity: {get_cosine_similarity(image1, image2)}")
+    print(f"batched cosine similarity: {get_cosine_similarity_batch([image1, image2], [image2, image2]).tolist()}")
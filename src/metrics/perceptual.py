@@ -0,0 +1,118 @@
+import functools
+
+import torch
+import torch.nn.functional as F
+
+try:
+    from .utils import traced
+except ImportError:
+    from utils import traced
+
+"""
+batched perceptual metrics
+
+every function takes (n, c, h, w) float tensors in [0, 1] and returns a (n,) vector, one value per pair (x[i], x_hat[i]).
+ssim and ms-ssim use an 11x11 gaussian window (sigma 1.5) applied per channel with a grouped convolution.
+"""
+
+
+MS_SSIM_WEIGHTS = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+
+
+def get_psnr_batch(x: torch.Tensor, x_hat: torch.Tensor, data_range: float = 1.0) -> torch.Tensor:
+    mse = ((x.float() - x_hat.float()) ** 2).flatten(1).mean(dim=1)
+    return 20 * torch.log10(data_range / torch.sqrt(mse))
+
+
+@functools.cache
+def get_gaussian_window(channels: int, size: int = 11, sigma: float = 1.5) -> torch.Tensor:
+    # (c, 1, size, size), one identical kernel per channel for `groups=c`
+    coords = torch.arange(size, dtype=torch.float32) - (size - 1) / 2
+    kernel_1d = torch.exp(-(coords**2) / (2 * sigma**2))
+    kernel_1d /= kernel_1d.sum()
+    kernel_2d = kernel_1d[:, None] @ kernel_1d[None, :]
+    return kernel_2d.expand(channels, 1, size, size).contiguous()
+
+
+def _get_ssim_maps(x: torch.Tensor, y: torch.Tensor, window: torch.Tensor, data_range: float) -> tuple[torch.Tensor, torch.Tensor]:
+    # returns per-pixel ssim and contrast-structure maps, valid region only
+    c1, c2 = (0.01 * data_range) ** 2, (0.03 * data_range) ** 2
+    channels = x.shape[1]
+
+    # all five local statistics in a single grouped convolution
+    stacked = torch.cat([x, y, x * x, y * y, x * y], dim=1)
+    stats = F.conv2d(stacked, window.repeat(5, 1, 1, 1), groups=5 * channels)
+    mu_x, mu_y, xx, yy, xy = stats.split(channels, dim=1)
+
+    sigma_x = xx - mu_x**2
+    sigma_y = yy - mu_y**2
+    sigma_xy = xy - mu_x * mu_y
+
+    cs_map = (2 * sigma_xy + c2) / (sigma_x + sigma_y + c2)
+    ssim_map = ((2 * mu_x * mu_y + c1) / (mu_x**2 + mu_y**2 + c1)) * cs_map
+    return ssim_map, cs_map
+
+
+@traced()
+def get_ssim_batch(x: torch.Tensor, x_hat: torch.Tensor, data_range: float = 1.0, window_size: int = 11, sigma: float = 1.5) -> torch.Tensor:
+    x, x_hat = x.float(), x_hat.float()
+    window = get_gaussian_window(x.shape[1], window_size, sigma).to(x.device)
+    ssim_map, _ = _get_ssim_maps(x, x_hat, window, data_range)
+    return ssim_map.flatten(1).mean(dim=1)
+
+
+@traced()
+def get_ms_ssim_batch(x: torch.Tensor, x_hat: torch.Tensor, data_range: float = 1.0, window_size: int = 11, sigma: float = 1.5) -> torch.Tensor:
+    # 5 scales, the shorter image side must exceed (window_size - 1) * 2 ** 4, i.e. 160 px for the default window
+    x, x_hat = x.float(), x_hat.float()
+    assert min(x.shape[-2:]) > (window_size - 1) * 2 ** (len(MS_SSIM_WEIGHTS) - 1), "image too small for ms-ssim"
+    window = get_gaussian_window(x.shape[1], window_size, sigma).to(x.device)
+    weights = torch.tensor(MS_SSIM_WEIGHTS, device=x.device)
+
+    levels = []
+    for scale in range(len(MS_SSIM_WEIGHTS)):
+        ssim_map, cs_map = _get_ssim_maps(x, x_hat, window, data_range)
+        if scale < len(MS_SSIM_WEIGHTS) - 1:
+            levels.append(cs_map.flatten(1).mean(dim=1))
+            x, x_hat = F.avg_pool2d(x, kernel_size=2), F.avg_pool2d(x_hat, kernel_size=2)
+        else:
+            levels.append(ssim_map.flatten(1).mean(dim=1))
+
+    levels = torch.stack(levels, dim=1).clamp(min=0)  # negative contrast terms would make the fractional powers nan
+    return (levels**weights).prod(dim=1)
+
+
+@functools.cache
+def load_lpips(net: str = "vgg", device: str = "cpu"):
+    import lpips
+
+    loss_fn = lpips.LPIPS(net=net, verbose=False).to(device)
+    loss_fn.eval()
+    return loss_fn
+
+
+@traced()
+def get_lpips_batch(x: torch.Tensor, x_hat: torch.Tensor, net: str = "vgg", batch_size: int = 32, normalize: bool = True) -> torch.Tensor:
+    device = str(x.device)
+    loss_fn = load_lpips(net, device)
+    distances = []
+    with torch.no_grad():
+        for i in range(0, len(x), batch_size):
+            d = loss_fn(x[i : i + batch_size].float(), x_hat[i : i + batch_size].float(), normalize=normalize)  # normalize: [0, 1] -> [-1, 1]
+            distances.append(d.flatten())
+    return torch.cat(distances)
+
+
+"""
+example usage
+"""
+
+
+if __name__ == "__main__":
+    x = torch.rand(8, 3, 256, 256)
+    x_hat = (x + 0.05 * torch.randn_like(x)).clamp(0, 1)
+
+    print(f"psnr: {get_psnr_batch(x, x_hat).tolist()}")
+    print(f"ssim: {get_ssim_batch(x, x_hat).tolist()}")
+    print(f"ms-ssim: {get_ms_ssim_batch(x, x_hat).tolist()}")
+    print(f"lpips: {get_lpips_batch(x, x_hat).tolist()}")
@@ -0,0 +1,119 @@
+"""
+precomputed clean-set reference for fid/kid: inception mean/covariance (as mergeable running moments) and a feature sample for kid,
+computed once per (dataset, split, subset size, seed) and stored as a versioned `.npz`.
+
+usage (from the repository root, references are written to `data/reference/`):
+
+$ PYTHONPATH=src python3 -m metrics.reference --subset-size 1000 --seed 42
+$ make reference subset_size=1000 seed=42
+"""
+
+import argparse
+import time
+from pathlib import Path
+from typing import Generator
+
+import numpy as np
+
+try:
+    from .fidkid import FeatureStats
+    from .metrics import extract_features
+except ImportError:
+    from fidkid import FeatureStats
+
+    from metrics import extract_features
+
+
+REFERENCE_VERSION = 1  # bump when the feature extractor or its preprocessing changes, old files are then rejected
+REFERENCE_DIR = Path.cwd() / "data" / "reference"
+IMAGENET_DATASET = ("visual-layer/imagenet-1k-vl-enriched", "validation")
+
+
+def get_reference_path(dataset: str, split: str, subset_size: int, seed: int) -> Path:
+    name = f"{dataset}--{split}--{subset_size}--{seed}--v{REFERENCE_VERSION}.npz".replace("/", "_")
+    return REFERENCE_DIR / name
+
+
+def get_dataset_images(dataset: str, split: str, subset_size: int, seed: int) -> Generator:
+    # the same subset and order as the eval scripts' generators for the same seed
+    from datasets import load_dataset
+
+    subset = load_dataset(dataset, split=split, streaming=True).take(subset_size).shuffle(seed=seed)  # type: ignore
+    for elem in subset:
+        yield elem["image_id"], elem["image"].convert("RGB")  # type: ignore
+
+
+def compute_reference(dataset: str, split: str, subset_size: int, seed: int, sample_size: int = 1000, batch_size: int = 32) -> dict[str, np.ndarray]:
+    stats = FeatureStats()
+    features, image_ids = [], []
+
+    def flush(batch: list) -> None:
+        batch_features = extract_features(batch, backbone="inception", batch_size=batch_size).numpy()
+        stats.update(batch_features)
+        features.append(batch_features.astype(np.float32))
+
+    batch = []
+    for image_id, image in get_dataset_images(dataset, split, subset_size, seed):
+        image_ids.append(image_id)
+        batch.append(image)
+        if len(batch) == batch_size:
+            flush(batch)
+            batch = []
+    if len(batch) > 0:
+        flush(batch)
+
+    # kid sample: a seeded random subset, all features if the set is small enough
+    features = np.concatenate(features)
+    rng = np.random.default_rng(seed)
+    sample_idx = np.sort(rng.choice(len(features), min(sample_size, len(features)), replace=False))
+
+    return {
+        **stats.to_dict(),
+        "sample": features[sample_idx],
+        "image_ids": np.array(image_ids),
+        "version": np.array(REFERENCE_VERSION),
+    }
+
+
+def save_reference(reference: dict[str, np.ndarray], path: Path) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp.npz")
+    np.savez(tmp_path, **reference)
+    tmp_path.rename(path)  # atomic, a crash never leaves a partial reference behind
+    return path
+
+
+def load_reference(path: Path) -> tuple[FeatureStats, np.ndarray, np.ndarray]:
+    # returns (moments, kid feature sample, image ids)
+    with np.load(path) as data:
+        assert int(data["version"]) == REFERENCE_VERSION, f"stale reference {path}, recompute it"
+        return FeatureStats.from_dict(data), data["sample"], data["image_ids"]
+
+
+def get_reference(dataset: str, split: str, subset_size: int, seed: int, sample_size: int = 1000) -> tuple[FeatureStats, np.ndarray, np.ndarray]:
+    # computes and stores the reference on first use
+    path = get_reference_path(dataset, split, subset_size, seed)
+    if not path.exists():
+        save_reference(compute_reference(dataset, split, subset_size, seed, sample_size), path)
+    return load_reference(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="precompute clean-set inception statistics for fid/kid")
+    parser.add_argument("--dataset", type=str, default=IMAGENET_DATASET[0])
+    parser.add_argument("--split", type=str, default=IMAGENET_DATASET[1])
+    parser.add_argument("--subset-size", type=int, required=True)
+    parser.add_argument("--seed", type=int, required=True)
+    parser.add_argument("--sample-size", type=int, default=1000, help="features kept for kid")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--force", action="store_true", help="recompute even if the reference exists")
+    args = parser.parse_args()
+
+    path = get_reference_path(args.dataset, args.split, args.subset_size, args.seed)
+    if path.exists() and not args.force:
+        print(f"reference exists: {path}")
+    else:
+        time_start = time.time()
+        reference = compute_reference(args.dataset, args.split, args.subset_size, args.seed, args.sample_size, args.batch_size)
+        save_reference(reference, path)
+        print(f"saved reference of {int(reference['n'])} images to {path} in {time.time() - time_start:.1f}s")
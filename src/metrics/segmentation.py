@@ -0,0 +1,169 @@
+import sys
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+try:
+    from models.mask_encoding import POPCOUNT, get_packed_area, get_packed_iou, pack_masks, unpack_masks
+except ImportError:
+    # run as a script from src/metrics
+    sys.path.append(str(Path(__file__).resolve().parents[1]))
+    from models.mask_encoding import POPCOUNT, get_packed_area, get_packed_iou, pack_masks, unpack_masks
+
+try:
+    from .utils import traced
+except ImportError:
+    from utils import traced
+
+"""
+segmentation metrics
+
+masks are (n, h, w) bool, or bit-packed (n, h, ceil(w / 8)) uint8 from `models/mask_encoding.py` together with their width.
+pairwise metrics return (n, m) matrices, aligned metrics return (n,) vectors for pairs (a[i], b[i]).
+an empty mask against an empty mask scores 1 in every metric (iou, dice, boundary f-score).
+dense intersections are one matmul per pixel chunk, so memory stays bounded at any resolution.
+"""
+
+
+def _flatten(masks: np.ndarray) -> np.ndarray:
+    masks = np.asarray(masks, dtype=bool)
+    return masks.reshape(len(masks), -1)
+
+
+def get_intersection_matrix(masks_a: np.ndarray, masks_b: np.ndarray, chunk_size: int = 1 << 20) -> np.ndarray:
+    # (n, h, w) x (m, h, w) -> (n, m) pixel counts, float32 sums are exact below 2 ** 24 pixels per chunk
+    flat_a, flat_b = _flatten(masks_a), _flatten(masks_b)
+    assert flat_a.shape[1] == flat_b.shape[1], "masks must have the same resolution"
+    intersection = np.zeros((len(flat_a), len(flat_b)), dtype=np.int64)
+    for i in range(0, flat_a.shape[1], chunk_size):
+        chunk_a = flat_a[:, i : i + chunk_size].astype(np.float32)
+        chunk_b = flat_b[:, i : i + chunk_size].astype(np.float32)
+        intersection += np.rint(chunk_a @ chunk_b.T).astype(np.int64)
+    return intersection
+
+
+@traced()
+def get_mask_iou_matrix(masks_a: np.ndarray, masks_b: np.ndarray, width: Optional[int] = None, chunk_size: int = 1 << 20) -> np.ndarray:
+    # pass `width` for bit-packed masks, intersections are then computed without unpacking
+    if width is not None:
+        return get_packed_iou(masks_a, masks_b)
+
+    intersection = get_intersection_matrix(masks_a, masks_b, chunk_size)
+    area_a, area_b = _flatten(masks_a).sum(axis=1), _flatten(masks_b).sum(axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.ones(union.shape, dtype=np.float64), where=union > 0)  # empty vs empty is a perfect match
+
+
+def get_dice_matrix(masks_a: np.ndarray, masks_b: np.ndarray, width: Optional[int] = None, chunk_size: int = 1 << 20) -> np.ndarray:
+    # dice = 2 iou / (1 + iou), no second pass over the pixels
+    iou = get_mask_iou_matrix(masks_a, masks_b, width, chunk_size)
+    return 2 * iou / (1 + iou)
+
+
+def get_mask_iou(masks_a: np.ndarray, masks_b: np.ndarray, width: Optional[int] = None) -> np.ndarray:
+    # aligned pairs, (n,)
+    if width is not None:
+        intersection = POPCOUNT[masks_a & masks_b].sum(axis=(-2, -1), dtype=np.int64)
+        area_a, area_b = get_packed_area(masks_a), get_packed_area(masks_b)
+    else:
+        flat_a, flat_b = _flatten(masks_a), _flatten(masks_b)
+        intersection = (flat_a & flat_b).sum(axis=1)
+        area_a, area_b = flat_a.sum(axis=1), flat_b.sum(axis=1)
+    union = area_a + area_b - intersection
+    return np.divide(intersection, union, out=np.ones(union.shape, dtype=np.float64), where=union > 0)  # empty vs empty is a perfect match
+
+
+def get_dice(masks_a: np.ndarray, masks_b: np.ndarray, width: Optional[int] = None) -> np.ndarray:
+    iou = get_mask_iou(masks_a, masks_b, width)
+    return 2 * iou / (1 + iou)
+
+
+"""
+boundaries
+"""
+
+
+def _shift_or(masks: np.ndarray) -> np.ndarray:
+    # 3x3 dilation of (n, h, w) bool by or-ing the 8 shifted copies
+    padded = np.pad(masks, ((0, 0), (1, 1), (1, 1)))
+    h, w = masks.shape[-2:]
+    out = np.zeros_like(masks)
+    for dy in range(3):
+        for dx in range(3):
+            out |= padded[:, dy : dy + h, dx : dx + w]
+    return out
+
+
+def get_boundaries(masks: np.ndarray) -> np.ndarray:
+    # pixels of the mask with at least one background neighbour, image borders count as background
+    masks = np.asarray(masks, dtype=bool)
+    eroded = ~_shift_or(~masks)
+    return masks & ~eroded
+
+
+def dilate(masks: np.ndarray, radius: int) -> np.ndarray:
+    for _ in range(radius):
+        masks = _shift_or(masks)
+    return masks
+
+
+@traced()
+def get_boundary_fscore(pred_masks: np.ndarray, gt_masks: np.ndarray, tolerance: int = 2, width: Optional[int] = None, chunk_size: int = 16) -> np.ndarray:
+    # aligned pairs, (n,), a boundary pixel counts as matched if the other boundary is within `tolerance` pixels (chebyshev)
+    assert len(pred_masks) == len(gt_masks)
+
+    fscores = np.zeros(len(pred_masks), dtype=np.float64)
+    for i in range(0, len(pred_masks), chunk_size):
+        pred_chunk, gt_chunk = pred_masks[i : i + chunk_size], gt_masks[i : i + chunk_size]
+        if width is not None:
+            pred_chunk, gt_chunk = unpack_masks(pred_chunk, width), unpack_masks(gt_chunk, width)  # only one chunk is ever unpacked
+        pred_b, gt_b = get_boundaries(pred_chunk), get_boundaries(gt_chunk)
+
+        pred_len, gt_len = pred_b.sum(axis=(1, 2)), gt_b.sum(axis=(1, 2))
+        precision = np.divide((pred_b & dilate(gt_b, tolerance)).sum(axis=(1, 2)), pred_len, out=np.zeros(len(pred_b)), where=pred_len > 0)
+        recall = np.divide((gt_b & dilate(pred_b, tolerance)).sum(axis=(1, 2)), gt_len, out=np.zeros(len(gt_b)), where=gt_len > 0)
+
+        both_empty = (pred_len == 0) & (gt_len == 0)
+        denom = precision + recall
+        fscores[i : i + chunk_size] = np.where(both_empty, 1.0, np.divide(2 * precision * recall, denom, out=np.zeros(len(denom)), where=denom > 0))
+    return fscores
+
+
+"""
+per image
+"""
+
+
+def get_image_miou(pred_masks: np.ndarray, gt_masks: np.ndarray, width: Optional[int] = None) -> float:
+    # mean over ground-truth masks of the best iou any predicted mask reaches, 0 for missed objects
+    if len(gt_masks) == 0:
+        return float("nan")
+    if len(pred_masks) == 0:
+        return 0.0
+    return float(get_mask_iou_matrix(pred_masks, gt_masks, width).max(axis=0).mean())
+
+
+"""
+example usage
+"""
+
+
+if __name__ == "__main__":
+    # run from `src/`: python3 -m metrics.segmentation
+    gt = np.zeros((2, 240, 320), dtype=bool)
+    gt[0, 50:150, 50:150] = True
+    gt[1, 100:200, 150:300] = True
+    pred = np.zeros_like(gt)
+    pred[0, 55:150, 48:152] = True
+    pred[1, 100:190, 160:300] = True
+
+    print(f"iou matrix:\n{get_mask_iou_matrix(pred, gt)}")
+    print(f"dice: {get_dice(pred, gt)}")
+    print(f"boundary f-score: {get_boundary_fscore(pred, gt)}")
+    print(f"miou: {get_image_miou(pred, gt)}")
+
+    packed_pred, width = pack_masks(pred)
+    packed_gt, _ = pack_masks(gt)
+    assert np.allclose(get_mask_iou_matrix(packed_pred, packed_gt, width), get_mask_iou_matrix(pred, gt))
+    assert np.allclose(get_boundary_fscore(packed_pred, packed_gt, width=width), get_boundary_fscore(pred, gt))
@@ -1,5 +1,14 @@
+import sys
+from pathlib import Path
+
 import torch
 
+try:
+    from tracing import traced
+except ImportError:
+    sys.path.append(str(Path(__file__).resolve().parents[1]))  # run as a script from this directory, `tracing` lives in src/
+    from tracing import traced
+
 
 def get_device(disable_mps=False) -> str:
     if torch.backends.mps.is_available() and not disable_mps:
@@ -0,0 +1,151 @@
+import functools
+import hashlib
+import io
+import json
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import torch
+from PIL import Image
+
+"""
+caches
+"""
+
+
+CACHE_DIR = Path.cwd() / "data" / "cache"
+
+
+def get_image_hash(img: Image.Image) -> str:
+    # content hash, identical pixels give identical keys regardless of file name or format
+    img = img.convert("RGB")
+    digest = hashlib.sha256()
+    digest.update(str(img.size).encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+class DiskCache:
+    # persistent key-value store for json-serializable values, safe to share between processes
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)")
+        self.conn.commit()
+
+    def encode(self, value: Any) -> Any:
+        return json.dumps(value)
+
+    def decode(self, raw: Any) -> Any:
+        return json.loads(raw)
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        return self.decode(row[0]) if row is not None else None
+
+    def get_many(self, keys: list[str]) -> dict[str, Any]:
+        out = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                out[key] = value
+        return out
+
+    def set(self, key: str, value: Any) -> None:
+        self.set_many({key: value})
+
+    def set_many(self, items: dict[str, Any]) -> None:
+        self.conn.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", [(key, self.encode(value)) for key, value in items.items()])
+        self.conn.commit()
+
+    def __contains__(self, key: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class TensorDiskCache(DiskCache):
+    # same store, values are tensors or dicts of tensors
+    def encode(self, value: Any) -> bytes:
+        if isinstance(value, dict):
+            value = {k: v.detach().cpu() for k, v in value.items()}
+        else:
+            value = value.detach().cpu()
+        buffer = io.BytesIO()
+        torch.save(value, buffer)
+        return buffer.getvalue()
+
+    def decode(self, raw: bytes) -> torch.Tensor:
+        return torch.load(io.BytesIO(raw), weights_only=True)
+
+
+class LRUCache:
+    # in-memory lru, optionally backed by a persistent store that is read on miss and written through on insert
+    def __init__(self, maxsize: int = 4096, disk: Optional[DiskCache] = None):
+        self.maxsize = maxsize
+        self.disk = disk
+        self.items: OrderedDict = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key: str) -> Optional[Any]:
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+
+        value = self.disk.get(key) if self.disk is not None else None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._insert(key, value)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self._insert(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def _insert(self, key: str, value: Any) -> None:
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.items or (self.disk is not None and key in self.disk)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+"""
+text embeddings
+"""
+
+
+@functools.cache
+def get_text_embedding_cache(model_key: str, maxsize: int = 16384) -> LRUCache:
+    filename = "".join(c if c.isalnum() or c in "-_." else "_" for c in model_key)
+    return LRUCache(maxsize=maxsize, disk=TensorDiskCache(CACHE_DIR / "text_embeddings" / f"{filename}.sqlite"))
+
+
+def get_text_embeddings(model_key: str, texts: list[str], encode: Callable[[list[str]], torch.Tensor]) -> torch.Tensor:
+    # one row per text, only texts never seen before for this model go through `encode`
+    cache = get_text_embedding_cache(model_key)
+    embeddings = {text: cache.get(text) for text in set(texts)}
+
+    missing = [text for text, embedding in embeddings.items() if embedding is None]
+    if len(missing) > 0:
+        with torch.no_grad():
+            new_embeddings = encode(missing).float().cpu()
+        for text, embedding in zip(missing, new_embeddings):
+            embedding = embedding.clone()  # don't keep the whole batch alive through a view
+            cache.set(text, embedding)
+            embeddings[text] = embedding
+
+    return torch.stack([embeddings[text] for text in texts])
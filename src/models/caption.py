@@ -1,4 +1,6 @@
+import functools
 import os
+from typing import Iterable, Iterator
 
 import requests
 import torch
@@ -7,9 +9,12 @@ from PIL import Image
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
 try:
-    from .utils import get_device
+    from .cache import CACHE_DIR, DiskCache, get_image_hash
+    from .utils import get_device, traced
 except ImportError:
-    from utils import get_device
+    from cache import CACHE_DIR, DiskCache, get_image_hash
+
+    from utils import get_device, traced
 
 
 """
@@ -17,6 +22,7 @@ models
 """
 
 
+@traced()
 def caption_llama3(img: Image.Image) -> list[str]:
     # best model for gpu
     assert torch.cuda.is_available(), "GPU not available"
@@ -44,26 +50,65 @@ def caption_llama3(img: Image.Image) -> list[str]:
     return res
 
 
-def caption_blip(img: Image.Image) -> list[str]:
-    # best model for cpu
+BLIP_MODEL_ID = "Salesforce/blip-image-captioning-large"
+
+
+@functools.cache
+@traced()
+def load_blip(device: str):
     from transformers import BlipForConditionalGeneration, BlipProcessor
 
-    device = get_device()
-    model_id = "Salesforce/blip-image-captioning-large"
-    processor = BlipProcessor.from_pretrained(model_id, clean_up_tokenization_spaces=True)
-    model = BlipForConditionalGeneration.from_pretrained(model_id).to(device)
+    processor = BlipProcessor.from_pretrained(BLIP_MODEL_ID, clean_up_tokenization_spaces=True)
+    model = BlipForConditionalGeneration.from_pretrained(BLIP_MODEL_ID).to(device)
+    model.eval()
+    return processor, model
 
-    img = img.convert("RGB")
-    inputs = processor(img, return_tensors="pt")
-    inputs = {k: v.to(device) for k, v in inputs.items()}
 
-    out = model.generate(**inputs, max_new_tokens=30)
-    res = processor.decode(out[0], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+@functools.cache
+def get_caption_cache() -> DiskCache:
+    return DiskCache(CACHE_DIR / "captions.sqlite")
 
-    assert isinstance(res, str)
+
+@traced()
+def caption_blip_batch(imgs: list[Image.Image], num_beams: int = 1, max_new_tokens: int = 30, batch_size: int = 8) -> list[str]:
+    # raw captions, persisted by image content hash and generation settings so no image is captioned twice
+    # num_beams = 1 is greedy decoding
+    cache = get_caption_cache()
+    model_key = f"{BLIP_MODEL_ID}|beams={num_beams}|max_new_tokens={max_new_tokens}"
+    keys = [f"{model_key}|{get_image_hash(img)}" for img in imgs]
+    captions = cache.get_many(keys)
+
+    missing = {key: img for key, img in zip(keys, imgs) if key not in captions}  # also dedupes repeated images
+    if len(missing) > 0:
+        device = get_device()
+        processor, model = load_blip(device)
+        missing = list(missing.items())
+
+        for i in range(0, len(missing), batch_size):
+            chunk = missing[i : i + batch_size]
+            inputs = processor(images=[img.convert("RGB") for _, img in chunk], return_tensors="pt")
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+
+            with torch.no_grad():
+                out = model.generate(**inputs, max_new_tokens=max_new_tokens, num_beams=num_beams)
+            decoded = processor.batch_decode(out, skip_special_tokens=True, clean_up_tokenization_spaces=True)  # drops right padding of shorter captions
+
+            new_captions = {key: res for (key, _), res in zip(chunk, decoded)}
+            cache.set_many(new_captions)
+            captions.update(new_captions)
+
+    res = [captions[key] for key in keys]
+    assert all(isinstance(caption, str) for caption in res)
+    return res
+
+
+def caption_blip(img: Image.Image) -> list[str]:
+    # best model for cpu
+    res = caption_blip_batch([img])[0]
     return get_noun_chunks(res)
 
 
+@traced()
 def caption_gpt2(img: Image.Image) -> list[str]:
     from transformers import pipeline
 
@@ -76,6 +121,7 @@ def caption_gpt2(img: Image.Image) -> list[str]:
     return get_noun_chunks(res)
 
 
+@traced()
 def caption_blipvqa(img: Image.Image) -> list[str]:
     from transformers import BlipForQuestionAnswering, BlipProcessor
 
@@ -101,17 +147,28 @@ utils
 """
 
 
-def get_noun_chunks(sentence: str) -> list[str]:
+@functools.cache
+def get_nlp():
     # python -m spacy download en_core_web_sm
+    # loaded once per process, noun chunks only need the tagger and parser
     import spacy
 
-    nlp = spacy.load("en_core_web_sm")
-    doc = nlp(sentence)
+    return spacy.load("en_core_web_sm", disable=["ner", "lemmatizer"])
+
+
+def get_noun_chunks(sentence: str) -> list[str]:
+    doc = get_nlp()(sentence)
     noun_chunks = [chunk.text for chunk in doc.noun_chunks]
     noun_chunks = list(set(noun_chunks))
     return noun_chunks
 
 
+def get_noun_chunks_batch(sentences: Iterable[str], n_process: int = 1, batch_size: int = 256) -> Iterator[list[str]]:
+    # streams results in input order, n_process > 1 forks spacy workers
+    for doc in get_nlp().pipe(sentences, n_process=n_process, batch_size=batch_size):
+        yield list(set(chunk.text for chunk in doc.noun_chunks))
+
+
 """
 example usage
 """
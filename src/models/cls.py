@@ -1,3 +1,5 @@
+import functools
+import math
 import os
 
 import matplotlib.pyplot as plt
@@ -9,9 +11,14 @@ from PIL import Image
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
 try:
-    from .utils import get_device
+    from .cache import get_text_embeddings
+    from .tome import apply_tome
+    from .utils import get_device, traced
 except ImportError:
-    from utils import get_device
+    from cache import get_text_embeddings
+    from tome import apply_tome
+
+    from utils import get_device, traced
 
 
 """
@@ -19,23 +26,40 @@ models
 """
 
 
-def classify_metaclip(img: Image.Image, labels: list[str]) -> list[float]:
-    # best model for cpu, gpu
+METACLIP_MODEL_ID = "facebook/metaclip-h14-fullcc2.5b"
+
+
+@functools.cache
+@traced()
+def load_metaclip(device: str):
     from transformers import AutoModel, AutoProcessor
 
+    processor = AutoProcessor.from_pretrained(METACLIP_MODEL_ID)
+    model = AutoModel.from_pretrained(METACLIP_MODEL_ID).to(device)
+    model.eval()
+    return processor, model
+
+
+@traced()
+def classify_metaclip(img: Image.Image, labels: list[str]) -> list[float]:
+    # best model for cpu, gpu
     device = get_device()
-    model_id = "facebook/metaclip-h14-fullcc2.5b"
-    processor = AutoProcessor.from_pretrained(model_id)
-    model = AutoModel.from_pretrained(model_id).to(device)
+    processor, model = load_metaclip(device)
 
-    inputs = processor(text=labels, images=img, return_tensors="pt", padding=True)
+    def encode_text(texts: list[str]) -> torch.Tensor:
+        inputs = processor(text=texts, return_tensors="pt", padding=True)
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        return model.get_text_features(**inputs)
 
-    inputs["input_ids"] = inputs["input_ids"].to(device, dtype=torch.long)
-    inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
+    inputs = processor(images=img, return_tensors="pt")
+    pixel_values = inputs["pixel_values"].to(device)
 
     with torch.no_grad():
-        outputs = model(**inputs)
-        logits_per_image = outputs.logits_per_image
+        image_features = model.get_image_features(pixel_values=pixel_values)
+        text_features = get_text_embeddings(METACLIP_MODEL_ID, labels, encode_text).to(device, dtype=image_features.dtype)  # only new labels hit the text tower
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+        logits_per_image = model.logit_scale.exp() * image_features @ text_features.T
         text_probs = logits_per_image.softmax(dim=-1)
 
     probs = text_probs[0].cpu().numpy().tolist()
@@ -43,32 +67,51 @@ def classify_metaclip(img: Image.Image, labels: list[str]) -> list[float]:
     return probs
 
 
-def classify_clip(img: Image.Image, labels: list[str]) -> list[float]:
-    # most adv robust model
+@functools.cache
+@traced()
+def load_clip(device: str, tome_r: int = 0):
+    # `apply_tome` patches in place, so every `tome_r` gets its own copy
     import clip
 
-    device = get_device()
     model, preprocess = clip.load("ViT-L/14@336px", device=device)
     model.eval()
+    if tome_r > 0:
+        model = apply_tome(model, tome_r)  # token merging, see: 1-eval_cls_tome.py for accuracy/speed tradeoff
+    return model, preprocess
+
+
+@traced()
+def classify_clip(img: Image.Image, labels: list[str], tome_r: int = 0) -> list[float]:
+    # most adv robust model
+    import clip
+
+    device = get_device()
+    model, preprocess = load_clip(device, tome_r)
 
-    text = clip.tokenize(labels).to(device)
     image = preprocess(img).unsqueeze(0).to(device)
 
     with torch.no_grad():
-        logits_per_image, logits_per_text = model(image, text)
-        probs = logits_per_image.softmax(dim=-1).cpu().numpy()
+        image_features = model.encode_image(image)
+        text_features = get_text_embeddings("openai/ViT-L/14@336px", labels, lambda texts: model.encode_text(clip.tokenize(texts).to(device))).to(device, dtype=image_features.dtype)
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+        logits_per_image = model.logit_scale.exp() * image_features @ text_features.T
+        probs = logits_per_image.float().softmax(dim=-1).cpu().numpy()
 
     probs = probs[0].tolist()
     assert all(isinstance(prob, float) for prob in probs)
     return probs
 
 
-def classify_opencoca(img: Image.Image, labels: list[str]) -> list[float]:
+@traced()
+def classify_opencoca(img: Image.Image, labels: list[str], tome_r: int = 0) -> list[float]:
     import open_clip
 
     device = get_device()
     model, _, preprocess = open_clip.create_model_and_transforms("coca_ViT-L-14", pretrained="mscoco_finetuned_laion2b_s13b_b90k", device=device)
     model.eval()
+    if tome_r > 0:
+        model = apply_tome(model, tome_r)
     tokenizer = open_clip.get_tokenizer("coca_ViT-L-14")
 
     image = preprocess(img).unsqueeze(0).to(device)
@@ -86,20 +129,27 @@ def classify_opencoca(img: Image.Image, labels: list[str]) -> list[float]:
     return probs
 
 
-def classify_eva(img: Image.Image, labels: list[str]) -> list[float]:
+@functools.cache
+@traced()
+def load_eva(device: str):
     import open_clip
 
-    device = get_device()
     model, _, preprocess = open_clip.create_model_and_transforms("EVA01-g-14", pretrained="laion400m_s11b_b41k", device=device)  # largest that can fit in memory
     model.eval()
     tokenizer = open_clip.get_tokenizer("EVA01-g-14")
+    return model, preprocess, tokenizer
+
+
+@traced()
+def classify_eva(img: Image.Image, labels: list[str]) -> list[float]:
+    device = get_device()
+    model, preprocess, tokenizer = load_eva(device)
 
     image = preprocess(img).unsqueeze(0).to(device)
-    text = tokenizer(labels).to(device)
 
     with torch.no_grad():
         image_features = model.encode_image(image)
-        text_features = model.encode_text(text)
+        text_features = get_text_embeddings("open_clip/EVA01-g-14/laion400m_s11b_b41k", labels, lambda texts: model.encode_text(tokenizer(texts).to(device))).to(device)
         image_features /= image_features.norm(dim=-1, keepdim=True)
         text_features /= text_features.norm(dim=-1, keepdim=True)
 
@@ -115,7 +165,8 @@ custom models
 """
 
 
-def classify_robustified_clip(img: Image.Image, labels: list[str]) -> list[float]:
+@traced()
+def classify_robustified_clip(img: Image.Image, labels: list[str], tome_r: int = 0) -> list[float]:
     import clip
 
     device = get_device()
@@ -128,6 +179,8 @@ def classify_robustified_clip(img: Image.Image, labels: list[str]) -> list[float
     # load the state dictionary into the model
     model.load_state_dict(state_dict)
     model.eval()
+    if tome_r > 0:
+        model = apply_tome(model, tome_r)
 
     text = clip.tokenize(labels).to(device)
     image = preprocess(img).unsqueeze(0).to(device)
@@ -141,6 +194,53 @@ def classify_robustified_clip(img: Image.Image, labels: list[str]) -> list[float
     return probs
 
 
+"""
+cascade
+"""
+
+
+CASCADE_STAGES = {
+    # cheapest first, every stage loads its model once per process (see: `load_clip`, `load_metaclip`, `load_eva`)
+    "clip": classify_clip,
+    "metaclip": classify_metaclip,
+    "eva": classify_eva,
+}
+
+
+def get_margin(probs: list[float]) -> float:
+    # difference between top-1 and top-2 probability
+    if len(probs) < 2:
+        return 1.0
+    top1, top2 = sorted(probs, reverse=True)[:2]
+    return top1 - top2
+
+
+def get_entropy(probs: list[float]) -> float:
+    # normalized to [0;1] so thresholds don't depend on the number of labels
+    if len(probs) < 2:
+        return 0.0
+    entropy = -sum(p * math.log(p) for p in probs if p > 0)
+    return entropy / math.log(len(probs))
+
+
+def is_confident(probs: list[float], min_margin: float, max_entropy: float) -> bool:
+    return get_margin(probs) >= min_margin and get_entropy(probs) <= max_entropy
+
+
+@traced()
+def classify_cascade(img: Image.Image, labels: list[str], stages: list[str] = list(CASCADE_STAGES.keys()), min_margin: float = 0.2, max_entropy: float = 0.5) -> tuple[dict[str, list[float]], str]:
+    # runs stages in order, escalates to the next one only if the current one isn't confident
+    # returns probs of every stage that ran and the name of the stage that decided
+    assert len(stages) > 0 and all(stage in CASCADE_STAGES for stage in stages)
+    results = {}
+    for stage in stages:
+        probs = CASCADE_STAGES[stage](img, labels)
+        results[stage] = probs
+        if is_confident(probs, min_margin, max_entropy):
+            break
+    return results, stage
+
+
 """
 utils
 """
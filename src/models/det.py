@@ -1,4 +1,7 @@
+import functools
 import os
+from dataclasses import dataclass
+from typing import Optional
 
 import matplotlib.pyplot as plt
 import requests
@@ -9,9 +12,12 @@ os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
 
 try:
-    from .utils import get_device
+    from .cache import LRUCache, get_image_hash, get_text_embeddings
+    from .utils import get_device, traced
 except ImportError:
-    from utils import get_device
+    from cache import LRUCache, get_image_hash, get_text_embeddings
+
+    from utils import get_device, traced
 
 
 """
@@ -19,28 +25,102 @@ models
 """
 
 
-def detect_vit(img: Image.Image, labels: list[str], threshold: float) -> tuple[list[list[float]], list[float], list[str]]:
-    # best model for cpu, gpu
+OWLVIT_MODEL_ID = "google/owlvit-large-patch14"
+
+
+@functools.cache
+@traced()
+def load_owlvit(device: str):
     from transformers import OwlViTForObjectDetection, OwlViTProcessor
 
+    processor = OwlViTProcessor.from_pretrained(OWLVIT_MODEL_ID)
+    model = OwlViTForObjectDetection.from_pretrained(OWLVIT_MODEL_ID).to(device)
+    model.eval()
+    return processor, model
+
+
+@functools.cache
+def get_owlvit_image_cache(maxsize: int = 32) -> LRUCache:
+    # ~15 MB per image for owlvit-large
+    return LRUCache(maxsize=maxsize)
+
+
+@traced()
+def embed_image_owlvit(img: Image.Image) -> dict[str, torch.Tensor]:
+    # backbone and box head, the expensive part of owlvit, computed once per image
+    cache = get_owlvit_image_cache()
+    key = get_image_hash(img)
+    embedding = cache.get(key)
+    if embedding is not None:
+        return embedding
+
     device = get_device()
-    model_id = "google/owlvit-large-patch14"
-    processor = OwlViTProcessor.from_pretrained(model_id)
-    model = OwlViTForObjectDetection.from_pretrained(model_id).to(device)
+    processor, model = load_owlvit(device)
+    pixel_values = processor(images=img, return_tensors="pt")["pixel_values"].to(device)
 
-    texts = [labels]
-    inputs = processor(text=texts, images=img, return_tensors="pt")
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    with torch.no_grad():
+        feature_map = model.image_embedder(pixel_values=pixel_values)[0]
+        batch_size, height, width, hidden_dim = feature_map.shape
+        image_feats = feature_map.reshape(batch_size, height * width, hidden_dim)
+        pred_boxes = model.box_predictor(image_feats, feature_map)  # boxes don't depend on the queries
+
+    embedding = {
+        "feature_map": feature_map,
+        "image_feats": image_feats,
+        "pred_boxes": pred_boxes,
+        "target_sizes": torch.Tensor([img.size[::-1]]).to(device),
+    }
+    cache.set(key, embedding)
+    return embedding
+
+
+def get_owlvit_text_queries(labels: list[str]) -> torch.Tensor:
+    device = get_device()
+    processor, model = load_owlvit(device)
+
+    def encode_text(texts: list[str]) -> torch.Tensor:
+        inputs = processor(text=texts, return_tensors="pt")
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        return model.owlvit.get_text_features(**inputs)  # class head normalizes, no need to do it here
+
+    return get_text_embeddings(OWLVIT_MODEL_ID, labels, encode_text)
+
+
+def get_owlvit_image_queries(query_imgs: list[Image.Image]) -> torch.Tensor:
+    # one embedding per query image: the class embedding of its most prominent box, as in `image_guided_detection`
+    device = get_device()
+    processor, model = load_owlvit(device)
 
+    query_embeds = []
+    for query_img in query_imgs:
+        embedding = embed_image_owlvit(query_img)
+        with torch.no_grad():
+            query_embed = model.embed_image_query(embedding["image_feats"], embedding["feature_map"])[0]
+        query_embeds.append(query_embed.reshape(-1))
+    return torch.stack(query_embeds)
+
+
+@traced()
+def query_owlvit(img: Image.Image, query_embeds: torch.Tensor, query_labels: list[str], threshold: float) -> tuple[list[list[float]], list[float], list[str]]:
+    # only runs the lightweight class head, image features come from the cache
+    from transformers.models.owlvit.modeling_owlvit import OwlViTObjectDetectionOutput
+
+    assert len(query_embeds) == len(query_labels)
+    device = get_device()
+    processor, model = load_owlvit(device)
+    embedding = embed_image_owlvit(img)
+
+    query_embeds = query_embeds.to(device)[None]
+    query_mask = torch.ones(query_embeds.shape[:2], dtype=torch.bool, device=device)
     with torch.no_grad():
-        outputs = model(**inputs)
+        pred_logits, _ = model.class_predictor(embedding["image_feats"], query_embeds, query_mask)
 
-    target_sizes = torch.Tensor([img.size[::-1]]).to(device)
-    results = processor.post_process_object_detection(outputs=outputs, threshold=threshold, target_sizes=target_sizes)
+    outputs = OwlViTObjectDetectionOutput(logits=pred_logits, pred_boxes=embedding["pred_boxes"])
+    results = processor.post_process_object_detection(outputs=outputs, threshold=threshold, target_sizes=embedding["target_sizes"])
 
-    results[0]["boxes"] = [elem.cpu().tolist() for elem in results[0]["boxes"]]
-    results[0]["scores"] = [elem.cpu().item() for elem in results[0]["scores"]]
-    results[0]["labels"] = [labels[elem.cpu().item()] for elem in results[0]["labels"]]
+    results[0]["boxes"] = results[0]["boxes"].cpu().tolist()
+    results[0]["scores"] = results[0]["scores"].cpu().tolist()
+    results[0]["labels"] = [query_labels[elem] for elem in results[0]["labels"].cpu().tolist()]
 
     boxes = results[0]["boxes"]
     scores = results[0]["scores"]
@@ -52,13 +132,36 @@ def detect_vit(img: Image.Image, labels: list[str], threshold: float) -> tuple[l
     return boxes, scores, labels
 
 
-def detect_groundingdino(img: Image.Image, labels: list[str], threshold: float) -> tuple[list[list[float]], list[float], list[str]]:
+@traced()
+def detect_vit(img: Image.Image, labels: list[str], threshold: float) -> tuple[list[list[float]], list[float], list[str]]:
+    # best model for cpu, gpu
+    # repeated calls on the same image only re-run the class head
+    return query_owlvit(img, get_owlvit_text_queries(labels), labels, threshold)
+
+
+@traced()
+def detect_vit_image_guided(img: Image.Image, query_imgs: list[Image.Image], threshold: float, query_labels: Optional[list[str]] = None) -> tuple[list[list[float]], list[float], list[str]]:
+    # one-shot detection with example images instead of text
+    query_labels = query_labels if query_labels is not None else [f"query_{i}" for i in range(len(query_imgs))]
+    return query_owlvit(img, get_owlvit_image_queries(query_imgs), query_labels, threshold)
+
+
+@functools.cache
+@traced()
+def load_groundingdino(device: str):
     from transformers import AutoModelForZeroShotObjectDetection, AutoProcessor
 
-    device = get_device()
     model_id = "IDEA-Research/grounding-dino-base"
     processor = AutoProcessor.from_pretrained(model_id)
     model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id).to(device)
+    model.eval()
+    return processor, model
+
+
+@traced()
+def detect_groundingdino(img: Image.Image, labels: list[str], threshold: float) -> tuple[list[list[float]], list[float], list[str]]:
+    device = get_device()
+    processor, model = load_groundingdino(device)
 
     labels_str = ".".join(labels) + "."
     inputs = processor(images=img, text=labels_str, return_tensors="pt").to(device)
@@ -66,8 +169,8 @@ def detect_groundingdino(img: Image.Image, labels: list[str], threshold: float)
         outputs = model(**inputs)
 
     results = processor.post_process_grounded_object_detection(outputs, inputs.input_ids, box_threshold=threshold, text_threshold=threshold, target_sizes=[img.size[::-1]])[0]
-    results["scores"] = [elem.item() for elem in results["scores"]]
-    results["boxes"] = [elem.tolist() for elem in results["boxes"]]
+    results["scores"] = results["scores"].cpu().tolist()
+    results["boxes"] = results["boxes"].cpu().tolist()
 
     boxes = results["boxes"]
     scores = results["scores"]
@@ -79,14 +182,10 @@ def detect_groundingdino(img: Image.Image, labels: list[str], threshold: float)
     return boxes, scores, labels
 
 
+@traced()
 def detect_detr(img: Image.Image, threshold: float) -> tuple[list[list[float]], list[float], list[str]]:
-    from transformers import AutoImageProcessor, DetrForObjectDetection
-
-    model_id = "facebook/detr-resnet-101-dc5"  # largest model
     device = get_device()
-
-    image_processor = AutoImageProcessor.from_pretrained(model_id)
-    model = DetrForObjectDetection.from_pretrained(model_id).to(device)
+    image_processor, model = load_detr(device)
 
     inputs = image_processor(images=img, return_tensors="pt")
     inputs = {k: v.to(device) for k, v in inputs.items()}
@@ -97,9 +196,9 @@ def detect_detr(img: Image.Image, threshold: float) -> tuple[list[list[float]],
     target_sizes = torch.tensor([img.size[::-1]]).to(device)
     results = image_processor.post_process_object_detection(outputs, threshold, target_sizes=target_sizes)[0]
 
-    results["boxes"] = [elem.cpu().tolist() for elem in results["boxes"]]
-    results["scores"] = [elem.cpu().item() for elem in results["scores"]]
-    results["labels"] = [model.config.id2label[elem.cpu().item()] for elem in results["labels"]]
+    results["boxes"] = results["boxes"].cpu().tolist()
+    results["scores"] = results["scores"].cpu().tolist()
+    results["labels"] = [model.config.id2label[elem] for elem in results["labels"].cpu().tolist()]
 
     # model_labels = [model.config.id2label[elem.item()] for elem in results["labels"]]
     # results["labels"] = []
@@ -124,6 +223,203 @@ def detect_detr(img: Image.Image, threshold: float) -> tuple[list[list[float]],
     return boxes, scores, labels
 
 
+"""
+batched
+"""
+
+
+@dataclass
+class Detections:
+    # struct of arrays for a whole batch, K = total detections over all images
+    boxes: torch.Tensor  # (K, 4) xyxy in pixels of the original image
+    scores: torch.Tensor  # (K,)
+    label_ids: torch.Tensor  # (K,) index into `label_names`
+    image_idx: torch.Tensor  # (K,) index of the image in the batch
+    label_names: list[str]
+    num_images: int
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def select(self, keep: torch.Tensor) -> "Detections":
+        return Detections(self.boxes[keep], self.scores[keep], self.label_ids[keep], self.image_idx[keep], self.label_names, self.num_images)
+
+    def to_lists(self) -> list[tuple[list[list[float]], list[float], list[str]]]:
+        # per image (boxes, scores, labels), same format as the single image functions
+        out = [([], [], []) for _ in range(self.num_images)]
+        boxes, scores, label_ids, image_idx = self.boxes.cpu().tolist(), self.scores.cpu().tolist(), self.label_ids.cpu().tolist(), self.image_idx.cpu().tolist()
+        for box, score, label_id, idx in zip(boxes, scores, label_ids, image_idx):
+            out[idx][0].append(box)
+            out[idx][1].append(score)
+            out[idx][2].append(self.label_names[label_id])
+        return out
+
+
+def get_target_sizes(imgs: list[Image.Image], device: str) -> torch.Tensor:
+    return torch.tensor([img.size[::-1] for img in imgs], dtype=torch.float32, device=device)  # (N, 2) as (height, width)
+
+
+def nms_detections(detections: Detections, iou_threshold: float) -> Detections:
+    # class-aware and per-image, iou_threshold >= 1 disables it
+    from torchvision.ops import batched_nms
+
+    if iou_threshold >= 1 or len(detections) == 0:
+        return detections
+    groups = detections.image_idx * len(detections.label_names) + detections.label_ids
+    keep = batched_nms(detections.boxes.float(), detections.scores.float(), groups, iou_threshold)  # sorted by score
+    return detections.select(keep)
+
+
+def postprocess_detections(probs: torch.Tensor, pred_boxes: torch.Tensor, target_sizes: torch.Tensor, threshold: float, nms_iou: float, label_names: list[str]) -> Detections:
+    # probs: (N, P, C) per-class probabilities, pred_boxes: (N, P, 4) normalized cxcywh, target_sizes: (N, 2)
+    from torchvision.ops import box_convert
+
+    scores, label_ids = probs.max(dim=-1)
+    image_idx, box_idx = torch.nonzero(scores > threshold, as_tuple=True)
+
+    height, width = target_sizes.unbind(dim=1)
+    scale = torch.stack([width, height, width, height], dim=1)[image_idx]
+    boxes = box_convert(pred_boxes[image_idx, box_idx], in_fmt="cxcywh", out_fmt="xyxy") * scale
+
+    detections = Detections(boxes, scores[image_idx, box_idx], label_ids[image_idx, box_idx], image_idx, label_names, num_images=len(probs))
+    return nms_detections(detections, nms_iou)
+
+
+@traced()
+def detect_vit_batch(imgs: list[Image.Image], labels: list[str], threshold: float, nms_iou: float = 0.5) -> Detections:
+    # one forward for all images, processor resizes every image to the same square input
+    device = get_device()
+    processor, model = load_owlvit(device)
+    query_embeds = get_owlvit_text_queries(labels).to(device)
+    pixel_values = processor(images=imgs, return_tensors="pt")["pixel_values"].to(device)
+
+    with torch.no_grad():
+        feature_map = model.image_embedder(pixel_values=pixel_values)[0]
+        batch_size, height, width, hidden_dim = feature_map.shape
+        image_feats = feature_map.reshape(batch_size, height * width, hidden_dim)
+        query_embeds = query_embeds[None].expand(batch_size, -1, -1)
+        query_mask = torch.ones(query_embeds.shape[:2], dtype=torch.bool, device=device)
+        pred_logits, _ = model.class_predictor(image_feats, query_embeds, query_mask)
+        pred_boxes = model.box_predictor(image_feats, feature_map)
+
+    return postprocess_detections(pred_logits.sigmoid(), pred_boxes, get_target_sizes(imgs, device), threshold, nms_iou, labels)
+
+
+@functools.cache
+@traced()
+def load_detr(device: str):
+    from transformers import AutoImageProcessor, DetrForObjectDetection
+
+    model_id = "facebook/detr-resnet-101-dc5"  # largest model
+    image_processor = AutoImageProcessor.from_pretrained(model_id)
+    model = DetrForObjectDetection.from_pretrained(model_id).to(device)
+    model.eval()
+    return image_processor, model
+
+
+@traced()
+def detect_detr_batch(imgs: list[Image.Image], threshold: float, nms_iou: float = 0.5) -> Detections:
+    # processor pads to the largest image in the batch, `pixel_mask` keeps the padding out of attention
+    device = get_device()
+    image_processor, model = load_detr(device)
+    inputs = image_processor(images=imgs, return_tensors="pt")
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+
+    with torch.no_grad():
+        outputs = model(**inputs)
+
+    probs = outputs.logits.softmax(dim=-1)[..., :-1]  # drop the no-object class
+    label_names = [model.config.id2label.get(i, "N/A") for i in range(probs.shape[-1])]
+    return postprocess_detections(probs, outputs.pred_boxes, get_target_sizes(imgs, device), threshold, nms_iou, label_names)
+
+
+@traced()
+def detect_groundingdino_batch(imgs: list[Image.Image], labels: list[str], threshold: float, nms_iou: float = 0.5) -> Detections:
+    device = get_device()
+    processor, model = load_groundingdino(device)
+
+    labels_str = ".".join(labels) + "."
+    inputs = processor(images=imgs, text=[labels_str] * len(imgs), return_tensors="pt").to(device)
+    with torch.no_grad():
+        outputs = model(**inputs)
+
+    # phrase decoding is token based, the processor already does it for the whole batch with tensor ops
+    target_sizes = [img.size[::-1] for img in imgs]
+    results = processor.post_process_grounded_object_detection(outputs, inputs.input_ids, box_threshold=threshold, text_threshold=threshold, target_sizes=target_sizes)
+
+    label_names = list(labels)  # phrases that don't match a label exactly are appended
+    label_ids = []
+    for result in results:
+        for phrase in result["labels"]:
+            if phrase not in label_names:
+                label_names.append(phrase)
+            label_ids.append(label_names.index(phrase))
+
+    detections = Detections(
+        boxes=torch.cat([result["boxes"] for result in results]).reshape(-1, 4),
+        scores=torch.cat([result["scores"] for result in results]),
+        label_ids=torch.tensor(label_ids, dtype=torch.long, device=device),
+        image_idx=torch.repeat_interleave(torch.arange(len(results), device=device), torch.tensor([len(result["scores"]) for result in results], device=device)),
+        label_names=label_names,
+        num_images=len(imgs),
+    )
+    return nms_detections(detections, nms_iou)
+
+
+"""
+tiled
+"""
+
+
+def get_tiles(width: int, height: int, tile_size: int, overlap: float) -> list[tuple[int, int, int, int]]:
+    # overlapping xyxy windows covering the whole image, last row/column is shifted to end at the border
+    stride = max(1, int(tile_size * (1 - overlap)))
+
+    def get_starts(length: int) -> list[int]:
+        starts = list(range(0, max(length - tile_size, 0) + 1, stride))
+        if starts[-1] + tile_size < length:
+            starts.append(length - tile_size)
+        return starts
+
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height)) for y in get_starts(height) for x in get_starts(width)]
+
+
+def is_overlapping(box1: tuple, box2: tuple) -> bool:
+    return box1[0] < box2[2] and box2[0] < box1[2] and box1[1] < box2[3] and box2[1] < box1[3]
+
+
+@traced()
+def detect_vit_tiled(img: Image.Image, labels: list[str], threshold: float, tile_size: int = 840, overlap: float = 0.25, regions: Optional[list[tuple[int, int, int, int]]] = None, nms_iou: float = 0.5, batch_size: int = 8) -> Detections:
+    # for canvases much larger than the detector input (840px for owlvit-large)
+    # regions: xyxy boxes with content, tiles that don't touch any of them are pure background and skipped
+    tiles = get_tiles(img.size[0], img.size[1], tile_size, overlap)
+    if regions is not None:
+        tiles = [tile for tile in tiles if any(is_overlapping(tile, region) for region in regions)]
+
+    detections = []
+    for i in range(0, len(tiles), batch_size):
+        chunk = tiles[i : i + batch_size]
+        chunk_detections = detect_vit_batch([img.crop(tile) for tile in chunk], labels, threshold, nms_iou=1.0)  # nms only once, in canvas coordinates
+        offsets = torch.tensor([[x0, y0, x0, y0] for x0, y0, _, _ in chunk], dtype=chunk_detections.boxes.dtype, device=chunk_detections.boxes.device)
+        chunk_detections.boxes = chunk_detections.boxes + offsets[chunk_detections.image_idx]
+        chunk_detections.image_idx = torch.zeros_like(chunk_detections.image_idx)
+        detections.append(chunk_detections)
+
+    if len(detections) == 0:
+        empty = torch.empty(0, dtype=torch.long)
+        return Detections(torch.empty(0, 4), torch.empty(0), empty, empty, labels, num_images=1)
+
+    merged = Detections(
+        boxes=torch.cat([d.boxes for d in detections]),
+        scores=torch.cat([d.scores for d in detections]),
+        label_ids=torch.cat([d.label_ids for d in detections]),
+        image_idx=torch.cat([d.image_idx for d in detections]),
+        label_names=labels,
+        num_images=1,
+    )
+    return nms_detections(merged, nms_iou)  # cross-tile duplicates from the overlaps
+
+
 """
 utils
 """
@@ -0,0 +1,169 @@
+import numpy as np
+
+"""
+compact binary masks
+
+rle: coco-style run-length encoding in column-major order, `{"size": [h, w], "counts": [bg, fg, bg, ...]}`
+packed: `np.packbits` along the width, (..., h, ceil(w / 8)) uint8, 8x smaller than bool
+
+area, bbox and iou are computed on the encoded forms, decode only for rendering.
+"""
+
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+"""
+rle
+"""
+
+
+def encode_rle(masks: np.ndarray) -> list[dict]:
+    # masks: (n, h, w) bool
+    masks = np.asarray(masks, dtype=bool)
+    n, h, w = masks.shape
+    flat = masks.transpose(0, 2, 1).reshape(n, h * w)  # column-major, like pycocotools
+
+    rles = []
+    for row in flat:
+        change = np.flatnonzero(row[1:] != row[:-1]) + 1
+        boundaries = np.concatenate([[0], change, [h * w]])
+        counts = np.diff(boundaries)
+        if row[0]:
+            counts = np.concatenate([[0], counts])  # counts always start with background
+        rles.append({"size": [h, w], "counts": counts.astype(np.int64).tolist()})
+    return rles
+
+
+def decode_rle(rles: list[dict]) -> np.ndarray:
+    # returns (n, h, w) bool
+    if len(rles) == 0:
+        return np.zeros((0, 0, 0), dtype=bool)
+    h, w = rles[0]["size"]
+    masks = np.empty((len(rles), h, w), dtype=bool)
+    for idx, rle in enumerate(rles):
+        counts = np.asarray(rle["counts"], dtype=np.int64)
+        values = np.arange(len(counts)) % 2 == 1
+        masks[idx] = np.repeat(values, counts).reshape(w, h).T
+    return masks
+
+
+def get_rle_runs(rle: dict) -> tuple[np.ndarray, np.ndarray]:
+    # foreground runs as [start, end) in column-major pixel index
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    boundaries = np.concatenate([[0], np.cumsum(counts)])
+    return boundaries[1:-1:2], boundaries[2::2]
+
+
+def get_rle_area(rles: list[dict]) -> np.ndarray:
+    return np.array([sum(rle["counts"][1::2]) for rle in rles], dtype=np.int64)
+
+
+def get_rle_bbox(rles: list[dict]) -> np.ndarray:
+    # (n, 4) xyxy with exclusive max, zeros for empty masks
+    boxes = np.zeros((len(rles), 4), dtype=np.int64)
+    for idx, rle in enumerate(rles):
+        h, _ = rle["size"]
+        starts, ends = get_rle_runs(rle)
+        if len(starts) == 0:
+            continue
+        col_start, col_end = starts // h, (ends - 1) // h
+        same_col = col_start == col_end
+        y_min = np.where(same_col, starts % h, 0).min()  # a run spanning columns touches the top
+        y_max = np.where(same_col, (ends - 1) % h, h - 1).max()
+        boxes[idx] = [col_start.min(), y_min, col_end.max() + 1, y_max + 1]
+    return boxes
+
+
+def _get_coverage(starts: np.ndarray, ends: np.ndarray, x: np.ndarray) -> np.ndarray:
+    # number of foreground pixels before index x, for sorted disjoint runs
+    cumulative = np.concatenate([[0], np.cumsum(ends - starts)])
+    k = np.searchsorted(starts, x, side="right") - 1
+    covered = cumulative[np.maximum(k, 0)] + np.clip(x - starts[np.maximum(k, 0)], 0, (ends - starts)[np.maximum(k, 0)])
+    return np.where(k >= 0, covered, 0)
+
+
+def get_rle_iou(rles_a: list[dict], rles_b: list[dict]) -> np.ndarray:
+    # (n, m) iou matrix, intersections from run boundaries without decoding
+    runs_a = [get_rle_runs(rle) for rle in rles_a]
+    runs_b = [get_rle_runs(rle) for rle in rles_b]
+    area_a, area_b = get_rle_area(rles_a), get_rle_area(rles_b)
+
+    intersection = np.zeros((len(rles_a), len(rles_b)), dtype=np.int64)
+    for i, (starts_a, ends_a) in enumerate(runs_a):
+        if len(starts_a) == 0:
+            continue
+        for j, (starts_b, ends_b) in enumerate(runs_b):
+            if len(starts_b) == 0:
+                continue
+            intersection[i, j] = (_get_coverage(starts_b, ends_b, ends_a) - _get_coverage(starts_b, ends_b, starts_a)).sum()
+
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.ones(union.shape, dtype=np.float64), where=union > 0)  # empty vs empty is a perfect match
+
+
+"""
+packed
+"""
+
+
+def pack_masks(masks: np.ndarray) -> tuple[np.ndarray, int]:
+    # returns packed masks and the original width
+    masks = np.asarray(masks, dtype=bool)
+    return np.packbits(masks, axis=-1), masks.shape[-1]
+
+
+def unpack_masks(packed: np.ndarray, width: int) -> np.ndarray:
+    return np.unpackbits(packed, axis=-1, count=width).astype(bool)
+
+
+def get_packed_area(packed: np.ndarray) -> np.ndarray:
+    # (..., h, w8) -> (...)
+    return POPCOUNT[packed].sum(axis=(-2, -1), dtype=np.int64)
+
+
+def get_packed_bbox(packed: np.ndarray, width: int) -> np.ndarray:
+    # (n, h, w8) -> (n, 4) xyxy with exclusive max, zeros for empty masks
+    rows = packed.any(axis=-1)  # (n, h)
+    cols = np.unpackbits(np.bitwise_or.reduce(packed, axis=-2), axis=-1, count=width).astype(bool)  # (n, w), only one row unpacked
+    nonempty = rows.any(axis=-1)
+
+    y_min = rows.argmax(axis=-1)
+    y_max = rows.shape[-1] - rows[:, ::-1].argmax(axis=-1)
+    x_min = cols.argmax(axis=-1)
+    x_max = cols.shape[-1] - cols[:, ::-1].argmax(axis=-1)
+    boxes = np.stack([x_min, y_min, x_max, y_max], axis=-1)
+    return np.where(nonempty[:, None], boxes, 0)
+
+
+def get_packed_iou(packed_a: np.ndarray, packed_b: np.ndarray, chunk_size: int = 16) -> np.ndarray:
+    # (n, h, w8) x (m, h, w8) -> (n, m), chunked over n to bound the (chunk, m, h, w8) intermediate
+    area_a, area_b = get_packed_area(packed_a), get_packed_area(packed_b)
+    intersection = np.zeros((len(packed_a), len(packed_b)), dtype=np.int64)
+    for i in range(0, len(packed_a), chunk_size):
+        chunk = packed_a[i : i + chunk_size]
+        intersection[i : i + chunk_size] = POPCOUNT[chunk[:, None] & packed_b[None]].sum(axis=(-2, -1), dtype=np.int64)
+
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.ones(union.shape, dtype=np.float64), where=union > 0)  # empty vs empty is a perfect match
+
+
+"""
+example usage
+"""
+
+
+if __name__ == "__main__":
+    masks = np.zeros((2, 480, 640), dtype=bool)
+    masks[0, 100:200, 50:150] = True
+    masks[1, 150:300, 100:400] = True
+
+    rles = encode_rle(masks)
+    assert (decode_rle(rles) == masks).all()
+    print(f"rle area: {get_rle_area(rles)}, bbox: {get_rle_bbox(rles).tolist()}")
+    print(f"rle iou:\n{get_rle_iou(rles, rles)}")
+
+    packed, width = pack_masks(masks)
+    assert (unpack_masks(packed, width) == masks).all()
+    print(f"packed {masks.nbytes} -> {packed.nbytes} bytes, area: {get_packed_area(packed)}, bbox: {get_packed_bbox(packed, width).tolist()}")
+    print(f"packed iou:\n{get_packed_iou(packed, packed)}")
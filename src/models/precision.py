@@ -0,0 +1,73 @@
+import io
+
+import torch
+
+try:
+    from .utils import get_device
+except ImportError:
+    from utils import get_device
+
+
+"""
+precision modes
+"""
+
+
+PRECISIONS = ["fp32", "bf16", "int8"]
+
+
+def set_precision(model: torch.nn.Module, precision: str) -> torch.nn.Module:
+    # opt-in post-training precision reduction, applied after loading the fp32 checkpoint
+    assert precision in PRECISIONS, f"unknown precision: {precision}"
+    model.eval()
+
+    if precision == "fp32":
+        return model.float()
+
+    elif precision == "bf16":
+        # bf16 weights, matmuls accumulate in fp32 (mkldnn on cpu, tensor cores on cuda)
+        return model.to(torch.bfloat16)
+
+    elif precision == "int8":
+        # dynamic quantization: int8 weights, activations quantized on the fly per batch
+        # only supported on cpu, only touches nn.Linear (attention out_proj in nn.MultiheadAttention is skipped by torch)
+        model = model.to("cpu").float()
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def get_input_dtype(model: torch.nn.Module) -> torch.dtype:
+    # dtype that image tensors must be cast to before `encode_image`
+    for param in model.parameters():
+        if param.is_floating_point():
+            return param.dtype
+    return torch.float32
+
+
+def get_precision_device(precision: str) -> str:
+    if precision == "int8":
+        return "cpu"
+    return get_device(disable_mps=precision == "bf16")  # no bf16 on mps
+
+
+def get_model_size_mb(model: torch.nn.Module) -> float:
+    # serialize state dict to also count packed int8 weights, which aren't `parameters()`
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1024**2
+
+
+"""
+example usage
+"""
+
+
+if __name__ == "__main__":
+    import open_clip
+
+    model, _, preprocess = open_clip.create_model_and_transforms("RN50", pretrained="openai", device="cpu")
+    print(f"fp32: {get_model_size_mb(model):.2f} MB")
+
+    for precision in ["bf16", "int8"]:
+        model, _, preprocess = open_clip.create_model_and_transforms("RN50", pretrained="openai", device="cpu")
+        model = set_precision(model, precision)
+        print(f"{precision}: {get_model_size_mb(model):.2f} MB ({get_input_dtype(model)})")
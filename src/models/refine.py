@@ -0,0 +1,149 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+try:
+    from .mask_encoding import unpack_masks
+    from .utils import traced
+except ImportError:
+    from mask_encoding import unpack_masks
+
+    from utils import traced
+
+
+"""
+mask refinement
+"""
+
+
+def mask_to_polygon(mask: np.ndarray) -> Optional[np.ndarray]:
+    # vertices of the largest external contour, None for empty masks
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        return None
+    largest_contour = max(contours, key=cv2.contourArea)
+    return largest_contour.reshape(-1, 2)
+
+
+def polygon_to_mask(polygon: np.ndarray, image_shape: tuple[int, int]) -> np.ndarray:
+    # polygon = (x, y) coordinates of the vertices
+    # image_shape = (height, width) of the mask
+    mask = np.zeros(image_shape, dtype=np.uint8)
+    cv2.fillPoly(mask, [polygon.astype(np.int32)], color=(1,))
+    return mask
+
+
+def refine_mask(mask: np.ndarray) -> np.ndarray:
+    # keeps only the largest connected region, filled, as 0/1 uint8
+    polygon = mask_to_polygon(mask)
+    if polygon is None:
+        return np.zeros(mask.shape, dtype=np.uint8)
+    return polygon_to_mask(polygon, mask.shape)
+
+
+def to_binary_masks(masks: torch.Tensor | list[torch.Tensor]) -> np.ndarray:
+    # sam returns (n, 3, h, w), one mask per hypothesis: a pixel is kept if any hypothesis contains it
+    if isinstance(masks, list):
+        if len(masks) == 0:
+            return np.zeros((0, 0, 0), dtype=np.uint8)
+        masks = torch.stack(masks)
+    masks = masks.cpu()
+    if masks.dim() == 4:
+        masks = masks.any(dim=1)
+    elif masks.dim() != 3:
+        return np.zeros((0, 0, 0), dtype=np.uint8)
+    return masks.numpy().astype(np.uint8)
+
+
+@traced()
+def refine_masks(masks: torch.Tensor | list[torch.Tensor], num_workers: int = 1) -> list[np.ndarray]:
+    # num_workers > 1 spreads masks over a process pool, worth it for many high-resolution masks
+    binary_masks = list(to_binary_masks(masks))
+    if num_workers <= 1 or len(binary_masks) < 2 * num_workers:
+        return [refine_mask(mask) for mask in binary_masks]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        return list(pool.map(refine_mask, binary_masks, chunksize=max(1, len(binary_masks) // num_workers)))
+
+
+"""
+rendering
+"""
+
+
+@traced()
+def annotate_image(image: Image.Image, boxes: list[list[float]], scores: list[float], labels: list[str], masks: list[np.ndarray]) -> np.ndarray:
+    # masks must already be refined, returns rgb array
+    boxes = [[math.floor(val) for val in box] for box in boxes]
+    image_cv2 = cv2.cvtColor(np.array(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+
+    for label, score, (xmin, ymin, xmax, ymax), mask in zip(labels, scores, boxes, masks):
+        color = np.random.randint(0, 256, size=3)
+
+        # bounding box
+        cv2.rectangle(image_cv2, (xmin, ymin), (xmax, ymax), color.tolist(), 2)
+        cv2.putText(image_cv2, f"{label}: {score:.2f}", (xmin, ymin - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color.tolist(), 2)
+
+        # mask
+        mask_uint8 = (mask * 255).astype(np.uint8)
+        contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cv2.drawContours(image_cv2, contours, -1, color.tolist(), 2)
+
+    return cv2.cvtColor(image_cv2, cv2.COLOR_BGR2RGB)
+
+
+def load_seg_result(file_path: Path) -> dict:
+    # decodes a `0-eval_hcaptcha_seg.py` output file
+    from safetensors.torch import load_file
+
+    def decode_int32_to_string(tensor):
+        return "".join(chr(i) for i in tensor.tolist())
+
+    data_dict = load_file(file_path)
+
+    out = {}
+    for key, tensor in data_dict.items():
+        if key == "image":
+            out[key] = Image.fromarray((tensor.permute(1, 2, 0).numpy() * 255).astype(np.uint8))
+        elif key == "captions" or key == "detection_labels":
+            out[key] = decode_int32_to_string(tensor).split("|")
+        elif key == "classification_probs" or key == "detection_scores" or key == "detection_boxes":
+            out[key] = tensor.tolist()
+        elif key == "segmentation_masks":
+            out[key] = tensor
+
+    if "segmentation_masks_packed" in data_dict:
+        # decoded only here, right before rendering
+        shape = data_dict["segmentation_masks_shape"].tolist()
+        out["segmentation_masks"] = torch.from_numpy(unpack_masks(data_dict["segmentation_masks_packed"].numpy(), shape[-1]).reshape(shape))
+    return out
+
+
+@traced()
+def render_seg_result(file_path: Path) -> Optional[Path]:
+    # writes `<stem>.png` next to the input, skips files that were already rendered
+    outpath = file_path.with_suffix(".png")
+    if outpath.exists():
+        return None
+
+    ret = load_seg_result(file_path)
+    masks = refine_masks(ret["segmentation_masks"])
+    ann_img = annotate_image(ret["image"], ret["detection_boxes"], ret["detection_scores"], ret["detection_labels"], masks)
+    Image.fromarray(ann_img).save(outpath)
+    return outpath
+
+
+def render_seg_dir(datapath: Path, num_workers: Optional[int] = None) -> list[Path]:
+    # one file per task, every worker loads, refines and renders independently
+    files = sorted(datapath.glob("*.safetensors"))
+    num_workers = num_workers if num_workers is not None else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        rendered = list(pool.map(render_seg_result, files))
+    return [path for path in rendered if path is not None]
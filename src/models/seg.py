@@ -1,7 +1,6 @@
-import math
+import functools
 import os
 
-import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import requests
@@ -12,12 +11,16 @@ os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
 
 try:
+    from .cache import CACHE_DIR, LRUCache, TensorDiskCache, get_image_hash, get_text_embeddings
     from .det import detect_vit
-    from .utils import get_device
+    from .refine import annotate_image, refine_masks
+    from .utils import get_device, traced
 except ImportError:
+    from cache import CACHE_DIR, LRUCache, TensorDiskCache, get_image_hash, get_text_embeddings
     from det import detect_vit
+    from refine import annotate_image, refine_masks
 
-    from utils import get_device
+    from utils import get_device, traced
 
 
 """
@@ -25,6 +28,7 @@ models
 """
 
 
+@traced()
 def segment_sam2(image: Image.Image, query: list[list[float]]) -> list[torch.Tensor]:
     # best model for gpu
 
@@ -35,38 +39,118 @@ def segment_sam2(image: Image.Image, query: list[list[float]]) -> list[torch.Ten
     raise NotImplementedError("not implemented")
 
 
-def segment_sam1(image: Image.Image, query: list[list[float]]) -> list[torch.Tensor]:
+SAM_MODEL_ID = "facebook/sam-vit-base"
+
+
+@functools.cache
+@traced()
+def load_sam(device: str):
+    from transformers import AutoModelForMaskGeneration, AutoProcessor
+
+    segmentator = AutoModelForMaskGeneration.from_pretrained(SAM_MODEL_ID).to(device)
+    segmentator.eval()
+    processor = AutoProcessor.from_pretrained(SAM_MODEL_ID)
+    return processor, segmentator
+
+
+@functools.cache
+def get_sam_embedding_cache(maxsize: int = 16, persist: bool = False) -> LRUCache:
+    # ~4 MB per image for sam-vit-base, persist to reuse embeddings across runs
+    disk = TensorDiskCache(CACHE_DIR / "sam_embeddings.sqlite") if persist else None
+    return LRUCache(maxsize=maxsize, disk=disk)
+
+
+@traced()
+def embed_image_sam(image: Image.Image, persist: bool = False) -> dict[str, torch.Tensor]:
+    # vit image encoder, the expensive part of sam, computed once per image
+    cache = get_sam_embedding_cache(persist=persist)
+    key = f"{SAM_MODEL_ID}|{get_image_hash(image)}"
+    embedding = cache.get(key)
+    if embedding is not None:
+        return embedding
+
+    device = get_device(disable_mps=True)
+    processor, segmentator = load_sam(device)
+    inputs = processor(images=image, return_tensors="pt").to(device)
+    with torch.no_grad():
+        image_embeddings = segmentator.get_image_embeddings(inputs.pixel_values)
+
+    embedding = {
+        "image_embeddings": image_embeddings,
+        "original_sizes": inputs.original_sizes,
+        "reshaped_input_sizes": inputs.reshaped_input_sizes,
+    }
+    cache.set(key, embedding)
+    return embedding
+
+
+@traced()
+def segment_sam1(image: Image.Image, query: list[list[float]], persist: bool = False) -> list[torch.Tensor]:
     # best model for cpu
+    # repeated calls on the same image only run the prompt encoder and mask decoder
     if len(query) == 0:
         return []
     assert all(len(box) == 4 for box in query)
-    from transformers import AutoModelForMaskGeneration, AutoProcessor
 
     device = get_device(disable_mps=True)
-    segmenter_id = "facebook/sam-vit-base"
-    segmentator = AutoModelForMaskGeneration.from_pretrained(segmenter_id).to(device)
-    processor = AutoProcessor.from_pretrained(segmenter_id)
-    inputs = processor(images=image, input_boxes=[query], return_tensors="pt").to(device)
+    processor, segmentator = load_sam(device)
+    embedding = {k: v.to(device) for k, v in embed_image_sam(image, persist).items()}
+
+    # same box rescaling as the processor: longest side resized to the encoder input
+    scale = (embedding["reshaped_input_sizes"][0] / embedding["original_sizes"][0]).float()  # (h, w)
+    input_boxes = torch.tensor([query], dtype=torch.float32, device=device) * torch.stack([scale[1], scale[0], scale[1], scale[0]])
+
     with torch.no_grad():
-        outputs = segmentator(**inputs)
-    masks = processor.post_process_masks(masks=outputs.pred_masks, original_sizes=inputs.original_sizes, reshaped_input_sizes=inputs.reshaped_input_sizes)[0]
+        outputs = segmentator(image_embeddings=embedding["image_embeddings"], input_boxes=input_boxes)
+    masks = processor.post_process_masks(masks=outputs.pred_masks, original_sizes=embedding["original_sizes"], reshaped_input_sizes=embedding["reshaped_input_sizes"])[0]
 
     assert all(isinstance(mask, torch.Tensor) for mask in masks)
     assert all(mask.dtype == torch.bool for mask in masks)
     return masks
 
 
-def segment_clipseg(img: Image.Image, text_queries: list[str]) -> list[torch.Tensor]:
+CLIPSEG_MODEL_ID = "CIDAS/clipseg-rd64-refined"
+
+
+@functools.cache
+@traced()
+def load_clipseg(device: str):
     from transformers import AutoProcessor, CLIPSegForImageSegmentation
 
-    processor = AutoProcessor.from_pretrained("CIDAS/clipseg-rd64-refined")
-    model = CLIPSegForImageSegmentation.from_pretrained("CIDAS/clipseg-rd64-refined")
+    processor = AutoProcessor.from_pretrained(CLIPSEG_MODEL_ID)
+    model = CLIPSegForImageSegmentation.from_pretrained(CLIPSEG_MODEL_ID).to(device)
+    model.eval()
+    return processor, model
+
+
+@traced()
+def segment_clipseg_batch(imgs: list[Image.Image], text_queries: list[str]) -> torch.Tensor:
+    # returns (images, queries, height, width) probabilities
+    # every image goes through the vision backbone once, only the light decoder runs per (image, query) pair
+    device = get_device()
+    processor, model = load_clipseg(device)
+
+    def encode_text(texts: list[str]) -> torch.Tensor:
+        inputs = processor.tokenizer(texts, padding=True, return_tensors="pt")
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        return model.get_conditional_embeddings(batch_size=len(texts), input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])
+
+    pixel_values = processor.image_processor(images=imgs, return_tensors="pt")["pixel_values"].to(device)
+    num_imgs, num_queries = len(imgs), len(text_queries)
 
-    inputs = processor(text=text_queries, images=[img] * len(text_queries), padding=True, return_tensors="pt")
     with torch.no_grad():
-        outputs = model(**inputs)
-    logits = outputs.logits
-    masks = torch.sigmoid(logits)
+        # same as `model.forward`, split so that image and text sides are computed once each
+        vision_outputs = model.clip.vision_model(pixel_values=pixel_values, output_hidden_states=True)
+        activations = [vision_outputs.hidden_states[i + 1].repeat_interleave(num_queries, dim=0) for i in model.extract_layers]
+        conditional_embeddings = get_text_embeddings(CLIPSEG_MODEL_ID, text_queries, encode_text).to(device).repeat(num_imgs, 1)
+        logits = model.decoder(activations, conditional_embeddings).logits
+
+    masks = torch.sigmoid(logits).reshape(num_imgs, num_queries, *logits.shape[-2:])
+    return masks
+
+
+def segment_clipseg(img: Image.Image, text_queries: list[str]) -> list[torch.Tensor]:
+    masks = segment_clipseg_batch([img], text_queries)[0]
 
     assert all(isinstance(mask, torch.Tensor) for mask in masks)
     assert all(mask.dtype == torch.float32 for mask in masks)
@@ -106,55 +190,7 @@ def plot_segmentation_prob(img: Image.Image, labels: list[str], masks: list[torc
 
 
 def plot_segmentation_detection(image: Image.Image, boxes: list[list[float]], scores: list[float], labels: list[str], masks: list[torch.Tensor]):
-    def _refine_masks(masks: torch.BoolTensor) -> list[np.ndarray]:
-        def mask_to_polygon(mask: np.ndarray) -> list[list[int]]:
-            contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            largest_contour = max(contours, key=cv2.contourArea)
-            polygon = largest_contour.reshape(-1, 2).tolist()  # extract vertices of the contour
-            return polygon
-
-        def polygon_to_mask(polygon: list[tuple[int, int]], image_shape: tuple[int, int]) -> np.ndarray:
-            # polygon = (x, y) coordinates of the vertices
-            # image_shape = (height, width) of the mask
-
-            mask = np.zeros(image_shape, dtype=np.uint8)
-            pts = np.array(polygon, dtype=np.int32)  # point array
-            cv2.fillPoly(mask, [pts], color=(255,))
-            return mask
-
-        masks = masks.cpu().float()
-        masks = masks.permute(0, 2, 3, 1)
-        masks = masks.mean(axis=-1)
-        masks = (masks > 0).int()
-        masks = masks.numpy().astype(np.uint8)
-        masks = list(masks)
-
-        for idx, mask in enumerate(masks):
-            shape = mask.shape
-            polygon = mask_to_polygon(mask)
-            mask = polygon_to_mask(polygon, shape)
-            masks[idx] = mask
-
-        return masks
-
-    boxes = [[math.floor(val) for val in box] for box in boxes]
-    masks = _refine_masks(masks)
-
-    image_cv2 = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-
-    for label, score, (xmin, ymin, xmax, ymax), mask in zip(labels, scores, boxes, masks):
-        color = np.random.randint(0, 256, size=3)
-
-        # bounding box
-        cv2.rectangle(image_cv2, (xmin, ymin), (xmax, ymax), color.tolist(), 2)
-        cv2.putText(image_cv2, f"{label}: {score:.2f}", (xmin, ymin - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color.tolist(), 2)
-
-        # mask
-        mask_uint8 = (mask * 255).astype(np.uint8)
-        contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cv2.drawContours(image_cv2, contours, -1, color.tolist(), 2)
-
-    annotated_image = cv2.cvtColor(image_cv2, cv2.COLOR_BGR2RGB)
+    annotated_image = annotate_image(image, boxes, scores, labels, refine_masks(masks))
     plt.imshow(annotated_image)
     plt.axis("off")
     plt.show()
@@ -0,0 +1,140 @@
+import functools
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable
+
+import torch
+from filelock import FileLock
+
+try:
+    from .precision import set_precision
+    from .utils import traced
+except ImportError:
+    from precision import set_precision
+
+    from utils import traced
+
+
+"""
+shared weights
+
+the first process to take the file lock exports a model's state dict (and the checkpoint's preprocessing config) once to tmpfs (`/dev/shm`),
+every process (including the first) then builds the model with meta parameters, maps that file with `torch.load(mmap=True)`
+and assigns the mapped tensors as parameters.
+pages live in the page cache, so N processes cost roughly one copy of the weights.
+mappings are private (copy-on-write), a worker writing to a parameter never corrupts the shared file.
+"""
+
+
+SHM_DIR = Path("/dev/shm") / "advx-bench" if Path("/dev/shm").exists() else Path(tempfile.gettempdir()) / "advx-bench"
+
+
+def get_shared_path(model_name: str, pretrained: str, precision: str = "fp32") -> Path:
+    return SHM_DIR / f"{model_name}--{pretrained}--{precision}.pt".replace("/", "_")
+
+
+def export_shared(path: Path, load: Callable[[], tuple[torch.nn.Module, dict]]) -> Path:
+    # idempotent, safe to call from many processes at once: only the first one to take the lock runs `load` and writes the file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with FileLock(str(path) + ".lock"):
+        if path.exists():
+            return path
+        model, preprocess_cfg = load()
+        state_dict = model.state_dict()
+        buffers = {name: buffer for name, buffer in model.named_buffers() if name not in state_dict}  # non-persistent, e.g. attention masks
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        torch.save({"state_dict": state_dict, "buffers": buffers, "preprocess_cfg": preprocess_cfg}, tmp_path)
+        tmp_path.rename(path)  # atomic, readers never see a partial file
+    return path
+
+
+def load_shared(path: Path) -> dict:
+    # tensors are views into the mapped file, nothing is copied
+    shared = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    assert {"state_dict", "buffers", "preprocess_cfg"} <= shared.keys(), f"stale shared file, run `clear_shared()`: {path}"
+    return shared
+
+
+def attach_shared(model: torch.nn.Module, shared: dict) -> torch.nn.Module:
+    # replaces the (meta or materialized) parameters and buffers of an already constructed model with views into the shared file
+    model.load_state_dict(shared["state_dict"], assign=True)
+    for name, buffer in shared["buffers"].items():
+        module_name, _, buffer_name = name.rpartition(".")
+        model.get_submodule(module_name).register_buffer(buffer_name, buffer, persistent=False)
+    model.requires_grad_(False)
+    model.eval()
+    return model
+
+
+def create_empty_open_clip(model_name: str) -> torch.nn.Module:
+    # parameters and buffers on the meta device, constructing the model allocates no weight memory
+    import open_clip
+
+    try:
+        with torch.device("meta"):
+            return open_clip.create_model(model_name, pretrained=None, device="meta")
+    except NotImplementedError:
+        # init code that reads tensor values (e.g. `linspace(...).tolist()` in older timm convnexts) can't run on meta,
+        # such a model is built on cpu once and its random weights are dropped again by `attach_shared`
+        return open_clip.create_model(model_name, pretrained=None, device="cpu")
+
+
+@traced()
+def load_shared_open_clip(model_name: str, pretrained: str, precision: str = "fp32"):
+    import open_clip
+    from open_clip.transform import PreprocessCfg, image_transform_v2
+
+    assert precision in ["fp32", "bf16"], "dynamic int8 weights are packed and can't be memory-mapped"
+    path = get_shared_path(model_name, pretrained, precision)
+
+    def load() -> tuple[torch.nn.Module, dict]:
+        # the first process pays the full pretrained load once, the preprocessing config of the checkpoint is stored with the weights
+        model = open_clip.create_model(model_name, pretrained=pretrained, device="cpu")
+        return set_precision(model, precision), dict(model.visual.preprocess_cfg)
+
+    shared = load_shared(export_shared(path, load))
+
+    # every process, including the first, builds an empty model and attaches it to the mapped file
+    model = set_precision(create_empty_open_clip(model_name), precision)
+    model = attach_shared(model, shared)
+    preprocess = image_transform_v2(PreprocessCfg(**shared["preprocess_cfg"]), is_train=False)  # same transform as the non-shared load
+    return model, preprocess
+
+
+@functools.cache
+@traced()
+def load_open_clip(model_name: str, pretrained: str, precision: str = "fp32", shared: bool = False):
+    # memoized per process, a forked worker inherits every model its parent already loaded (copy-on-write, see: runner.py)
+    import open_clip
+
+    if shared:
+        return load_shared_open_clip(model_name, pretrained, precision)
+
+    model, _, preprocess = open_clip.create_model_and_transforms(model_name, pretrained=pretrained, device="cpu")
+    model = set_precision(model, precision)
+    return model, preprocess
+
+
+def clear_shared() -> None:
+    for path in SHM_DIR.glob("*.pt"):
+        path.unlink(missing_ok=True)
+
+
+"""
+example usage
+"""
+
+
+if __name__ == "__main__":
+    # run once before launching workers to pre-populate `/dev/shm`, then start N copies of the sweep
+    MODELS = [
+        ("ViT-H-14-378-quickgelu", "dfn5b"),
+        ("EVA02-E-14-plus", "laion2b_s9b_b144k"),
+        ("EVA01-g-14-plus", "merged2b_s11b_b114k"),
+        ("convnext_xxlarge", "laion2b_s34b_b82k_augreg_soup"),
+        ("RN50x64", "openai"),
+    ]
+    for model_name, pretrained in MODELS:
+        model, preprocess = load_shared_open_clip(model_name, pretrained)
+        print(f"shared: {get_shared_path(model_name, pretrained)}")
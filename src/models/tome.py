@@ -0,0 +1,166 @@
+import math
+import types
+from typing import Callable, Optional, Union
+
+import torch
+import torch.nn.functional as F
+
+"""
+token merging
+
+see: https://arxiv.org/abs/2210.09461
+see: https://github.com/facebookresearch/ToMe
+"""
+
+
+def bipartite_soft_matching(metric: torch.Tensor, r: int, class_token: bool = True) -> Callable:
+    # metric: (batch, tokens, channels), returns a function that merges `r` tokens of any (batch, tokens, channels) tensor
+    protected = 1 if class_token else 0
+    t = metric.shape[1]
+    r = min(r, (t - protected) // 2)
+    if r <= 0:
+        return lambda x, mode="mean": x
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[..., ::2, :], metric[..., 1::2, :]  # alternating split into src and dst sets
+        scores = a @ b.transpose(-1, -2)
+        if class_token:
+            scores[..., 0, :] = -math.inf  # never merge the class token
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]  # unmerged src tokens
+        src_idx = edge_idx[..., :r, :]  # merged src tokens
+        dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
+        if class_token:
+            unm_idx = unm_idx.sort(dim=1)[0]  # keep class token at index 0
+
+    def merge(x: torch.Tensor, mode: str = "mean") -> torch.Tensor:
+        src, dst = x[..., ::2, :], x[..., 1::2, :]
+        n, t1, c = src.shape
+        unm = src.gather(dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = src.gather(dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    return merge
+
+
+def merge_wavg(merge: Callable, x: torch.Tensor, size: Optional[torch.Tensor] = None) -> tuple[torch.Tensor, torch.Tensor]:
+    # size-weighted average, `size` tracks how many patches each token represents
+    if size is None:
+        size = torch.ones_like(x[..., 0, None])
+    x = merge(x * size, mode="sum")
+    size = merge(size, mode="sum")
+    return x / size, size
+
+
+def get_tome_schedule(num_layers: int, r: int, schedule: str = "constant") -> list[int]:
+    # r = tokens merged per layer
+    if schedule == "constant":
+        return [r] * num_layers
+    elif schedule == "decreasing":
+        # merge 2r in the first layer, 0 in the last, same total as constant
+        return [int(round(2 * r * (1 - i / max(num_layers - 1, 1)))) for i in range(num_layers)]
+    raise ValueError(f"unknown schedule: {schedule}")
+
+
+"""
+patching
+"""
+
+
+def _tome_attention(attn: torch.nn.MultiheadAttention, x: torch.Tensor, size: Optional[torch.Tensor]) -> tuple[torch.Tensor, torch.Tensor]:
+    # same math as `nn.MultiheadAttention`, plus proportional attention and keys as merge metric
+    B, N, C = x.shape
+    H = attn.num_heads
+    qkv = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).reshape(B, N, 3, H, C // H).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv[0], qkv[1], qkv[2]
+
+    bias = None
+    if size is not None:
+        bias = size.log()[:, None, None, :, 0].to(q.dtype)  # (batch, 1, 1, tokens)
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=bias)
+    out = out.transpose(1, 2).reshape(B, N, C)
+    return attn.out_proj(out), k.mean(dim=1)
+
+
+def _tome_forward(self, x: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+    # replaces `ResidualAttentionBlock.forward` of openai/clip and open_clip
+    ls_1 = getattr(self, "ls_1", torch.nn.Identity())
+    ls_2 = getattr(self, "ls_2", torch.nn.Identity())
+
+    if not self._tome_batch_first:
+        x = x.transpose(0, 1)  # LND -> NLD
+
+    size = self._tome_state["size"]
+    attn_out, metric = _tome_attention(self.attn, self.ln_1(x), size)
+    x = x + ls_1(attn_out)
+
+    if self._tome_r > 0:
+        merge = bipartite_soft_matching(metric, self._tome_r, class_token=True)
+        x, size = merge_wavg(merge, x, size)
+        self._tome_state["size"] = size
+
+    x = x + ls_2(self.mlp(self.ln_2(x)))
+
+    if not self._tome_batch_first:
+        x = x.transpose(0, 1)  # NLD -> LND
+    return x
+
+
+def apply_tome(model: torch.nn.Module, r: Union[int, list[int]], schedule: str = "constant") -> torch.nn.Module:
+    # patches the vit image tower of an openai/clip or open_clip model in place
+    # `r` is either tokens merged per layer (expanded with `schedule`) or an explicit per-layer list
+    # only `forward` is swapped, so parameter names and `state_dict()` stay unchanged
+    visual = model.visual if hasattr(model, "visual") else model
+    transformer = getattr(visual, "transformer", None)
+    assert transformer is not None and hasattr(transformer, "resblocks"), "only vit image towers are supported"
+
+    blocks = list(transformer.resblocks)
+    rs = r if isinstance(r, list) else get_tome_schedule(len(blocks), r, schedule)
+    assert len(rs) == len(blocks), f"expected {len(blocks)} reduction values, got {len(rs)}"
+
+    state = {"size": None}  # shared across blocks, reset before every forward of the image tower
+    batch_first = getattr(transformer, "batch_first", False)
+    for block, block_r in zip(blocks, rs):
+        block._tome_r = block_r
+        block._tome_batch_first = batch_first
+        block._tome_state = state
+        block.forward = types.MethodType(_tome_forward, block)
+
+    def reset_state(module, args):
+        state["size"] = None
+
+    if hasattr(visual, "_tome_hook"):
+        visual._tome_hook.remove()
+    visual._tome_hook = visual.register_forward_pre_hook(reset_state)
+    return model
+
+
+def get_token_count(num_tokens: int, rs: list[int]) -> list[int]:
+    # token count after each layer, to inspect a schedule before running it
+    counts = []
+    for r in rs:
+        num_tokens -= min(r, (num_tokens - 1) // 2)
+        counts.append(num_tokens)
+    return counts
+
+
+"""
+example usage
+"""
+
+
+if __name__ == "__main__":
+    import clip
+
+    model, preprocess = clip.load("ViT-L/14@336px", device="cpu")
+    rs = get_tome_schedule(len(model.visual.transformer.resblocks), r=16)
+    print(f"tokens per layer: {get_token_count(577, rs)}")
+
+    model = apply_tome(model, rs)
+    x = torch.randn(2, 3, 336, 336)
+    with torch.no_grad():
+        print(model.encode_image(x).shape)
@@ -1,9 +1,17 @@
 import random
 import secrets
+import sys
+from pathlib import Path
 
 import numpy as np
 import torch
 
+try:
+    from tracing import traced
+except ImportError:
+    sys.path.append(str(Path(__file__).resolve().parents[1]))  # run as a script from this directory, `tracing` lives in src/
+    from tracing import traced
+
 
 def set_seed(seed: int = -1) -> None:
     if seed == -1:
@@ -0,0 +1,168 @@
+"""
+fork-server runner: imports heavy dependencies and loads models once, then forks copy-on-write workers that run a sweep script.
+a crashed worker is re-forked from the warm supervisor, the script's csv skip logic resumes where it left off.
+
+the models to pre-warm and their precision are read from the script's source (its open_clip loader calls and `CONFIG`), never executed.
+more than one worker is only allowed for scripts that split their sweep with `utils.get_worker_shard()`,
+otherwise every worker would run the full sweep and append duplicate rows to the same csv.
+
+usage:
+
+$ python3 src/runner.py src/1-eval_cls_mask_density_v2.py --workers 2
+$ make runner filepath=src/1-eval_cls_mask_density_v2.py workers=2
+"""
+
+import argparse
+import ast
+import os
+import runpy
+import sys
+import time
+import traceback
+from datetime import datetime
+
+# calls with literal (model_name, pretrained) as their first two args, see: 1-eval_cls_mask_density_v2.py
+OPEN_CLIP_LOADERS = {"load_model", "load_open_clip"}
+
+
+def log(msg: str) -> None:
+    print(f"{datetime.now()}: [runner {os.getpid()}] {msg}", flush=True)
+
+
+def get_call_name(node: ast.Call) -> str:
+    return node.func.id if isinstance(node.func, ast.Name) else node.func.attr if isinstance(node.func, ast.Attribute) else ""
+
+
+def get_script_config(tree: ast.Module) -> dict:
+    # literal values of the module level `CONFIG` dict, entries like `Path.cwd() / ...` are left out
+    config = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == "CONFIG" for target in node.targets) and isinstance(node.value, ast.Dict):
+            for key, value in zip(node.value.keys, node.value.values):
+                try:
+                    config[ast.literal_eval(key)] = ast.literal_eval(value)
+                except ValueError:
+                    continue
+    return config
+
+
+def get_script_models(tree: ast.Module) -> list[tuple[str, str]]:
+    models = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and get_call_name(node) in OPEN_CLIP_LOADERS and len(node.args) >= 2:
+            model_name, pretrained = node.args[:2]
+            if isinstance(model_name, ast.Constant) and isinstance(model_name.value, str) and isinstance(pretrained, ast.Constant) and isinstance(pretrained.value, str):
+                models.append((model_name.value, pretrained.value))
+    return list(dict.fromkeys(models))
+
+
+def is_sharded(tree: ast.Module) -> bool:
+    # the script splits its sweep across workers, see: `utils.get_worker_shard`
+    return any(isinstance(node, ast.Call) and get_call_name(node) == "get_worker_shard" for node in ast.walk(tree))
+
+
+def warm_up(preload: list[tuple[str, str]], precision: str, shared: bool) -> None:
+    import open_clip  # noqa: F401
+    import torch
+    import transformers  # noqa: F401
+
+    from models.shared import load_open_clip
+
+    # single-threaded in the supervisor: an openmp thread pool that exists at fork time can deadlock the children
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    for model_name, pretrained in preload:
+        load_open_clip(model_name, pretrained, precision, shared)  # same positional args and values as the script, so the memo key matches
+        log(f"pre-warmed {model_name} ({precision})")
+    os.environ["ADVX_NUM_THREADS"] = str(num_threads)
+
+
+def run_worker(filepath: str, worker_id: int, num_workers: int) -> None:
+    # only ever returns through `os._exit`, never unwinds into the supervisor's loop
+    exit_code = 0
+    try:
+        import torch
+
+        import tracing
+
+        tracing.reset()  # drop the supervisor's warm-up spans inherited through fork
+        torch.set_num_threads(int(os.environ.get("ADVX_NUM_THREADS", os.cpu_count())))
+        os.environ["ADVX_WORKER_ID"] = str(worker_id)
+        os.environ["ADVX_NUM_WORKERS"] = str(num_workers)
+        sys.argv = [filepath]
+        runpy.run_path(filepath, run_name="__main__")
+    except SystemExit as e:
+        # same as the interpreter: `sys.exit()` succeeds, `sys.exit("message")` prints the message and fails
+        if e.code is not None and not isinstance(e.code, int):
+            print(e.code, file=sys.stderr)
+        exit_code = 0 if e.code is None else (e.code if isinstance(e.code, int) else 1)
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        import tracing
+
+        tracing.report()  # `os._exit` skips atexit handlers
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+def fork_worker(filepath: str, worker_id: int, num_workers: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        run_worker(filepath, worker_id, num_workers)
+    log(f"forked worker {worker_id} with PID {pid}")
+    return pid
+
+
+def supervise(filepath: str, num_workers: int, max_restarts: int, backoff: float) -> int:
+    workers = {fork_worker(filepath, worker_id, num_workers): worker_id for worker_id in range(num_workers)}
+    restarts = {worker_id: 0 for worker_id in range(num_workers)}
+    failed = False
+
+    while workers:
+        pid, status = os.wait()
+        worker_id = workers.pop(pid)
+        exit_code = os.waitstatus_to_exitcode(status)
+
+        if exit_code == 0:
+            log(f"worker {worker_id} finished")
+            continue
+
+        log(f"worker {worker_id} died with exit code {exit_code}")
+        if restarts[worker_id] >= max_restarts:
+            log(f"worker {worker_id} exceeded {max_restarts} restarts, giving up")
+            failed = True
+            continue
+
+        restarts[worker_id] += 1
+        time.sleep(backoff)
+        workers[fork_worker(filepath, worker_id, num_workers)] = worker_id
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fork-server runner for eval sweeps")
+    parser.add_argument("filepath", type=str, help="sweep script to run in each worker")
+    parser.add_argument("--workers", type=int, default=1, help="number of forked workers, each runs a shard of the sweep (scripts using `get_worker_shard` only)")
+    parser.add_argument("--no-preload", action="store_true", help="only pre-import dependencies")
+    parser.add_argument("--max-restarts", type=int, default=100)
+    parser.add_argument("--backoff", type=float, default=5.0, help="seconds to wait before restarting a worker")
+    args = parser.parse_args()
+
+    assert os.path.exists(args.filepath), f"file not found: {args.filepath}"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.filepath)))
+
+    with open(args.filepath) as f:
+        tree = ast.parse(f.read(), filename=args.filepath)
+    assert args.workers == 1 or is_sharded(tree), f"{args.filepath} doesn't shard its sweep with `get_worker_shard()`, every worker would run all of it, use --workers 1"
+    config = get_script_config(tree)
+    preload = [] if args.no_preload else get_script_models(tree)
+
+    time_start = time.time()
+    warm_up(preload, config.get("precision", "fp32"), config.get("shared", False))
+    log(f"supervisor ready in {time.time() - time_start:.1f}s")
+
+    sys.exit(supervise(args.filepath, args.workers, args.max_restarts, args.backoff))
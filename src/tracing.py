@@ -0,0 +1,158 @@
+"""
+stage-level tracing: `with trace("stage"):` around a block or `@traced()` on a function records wall-clock spans.
+disabled by default, a disabled span is a single flag check. enable with `ADVX_TRACE=1` (or `enable()`),
+then the per-stage summary is printed and a chrome trace (chrome://tracing, https://ui.perfetto.dev) is written on exit.
+
+usage:
+
+$ ADVX_TRACE=1 python3 src/1-eval_cls_mask_density_v2.py
+$ ADVX_TRACE=1 ADVX_TRACE_PATH=data/trace/v2.json python3 src/runner.py src/1-eval_cls_mask_density_v2.py --workers 2
+"""
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+TRACE_DIR = Path.cwd() / "data" / "trace"
+MAX_EVENTS = 1_000_000  # chrome events kept per process, durations for the summary are always kept
+
+_enabled = os.environ.get("ADVX_TRACE", "0") == "1"
+_events: list[tuple[str, int, int, int]] = []  # (name, start ns, duration ns, thread id)
+_durations: dict[str, list[int]] = defaultdict(list)
+_lock = threading.Lock()
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def reset() -> None:
+    with _lock:
+        _events.clear()
+        _durations.clear()
+
+
+def _record(name: str, start: int, duration: int) -> None:
+    with _lock:
+        _durations[name].append(duration)
+        if len(_events) < MAX_EVENTS:
+            _events.append((name, start, duration, threading.get_ident()))
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0
+
+    def __enter__(self) -> "_Span":
+        if _enabled:
+            self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if _enabled and self.start:
+            _record(self.name, self.start, time.perf_counter_ns() - self.start)
+
+
+_NOOP_SPAN = contextlib.nullcontext()
+
+
+def trace(name: str):
+    # a shared no-op context when disabled, nothing is allocated
+    return _Span(name) if _enabled else _NOOP_SPAN
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    # span name defaults to `module.function`
+    def decorator(func: Callable) -> Callable:
+        span_name = name or f"{func.__module__.split('.')[-1]}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(span_name, start, time.perf_counter_ns() - start)
+
+        return wrapper
+
+    return decorator
+
+
+"""
+reporting
+"""
+
+
+def get_summary() -> dict[str, dict[str, float]]:
+    # per stage: count, total, mean, p50, p95 (seconds), sorted by total time
+    with _lock:
+        durations = {name: np.array(values, dtype=np.float64) / 1e9 for name, values in _durations.items()}
+    summary = {
+        name: {
+            "count": len(values),
+            "total": float(values.sum()),
+            "mean": float(values.mean()),
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+        }
+        for name, values in durations.items()
+    }
+    return dict(sorted(summary.items(), key=lambda item: item[1]["total"], reverse=True))
+
+
+def get_summary_table() -> str:
+    summary = get_summary()
+    width = max([len(name) for name in summary] + [5])
+    lines = [f"{'stage':<{width}}  {'count':>8}  {'total s':>10}  {'mean ms':>10}  {'p50 ms':>10}  {'p95 ms':>10}"]
+    for name, stats in summary.items():
+        lines.append(f"{name:<{width}}  {stats['count']:>8}  {stats['total']:>10.2f}  {stats['mean'] * 1e3:>10.2f}  {stats['p50'] * 1e3:>10.2f}  {stats['p95'] * 1e3:>10.2f}")
+    return "\n".join(lines)
+
+
+def export_chrome_trace(path: Path) -> Path:
+    # complete events ("ph": "X"), timestamps in microseconds
+    with _lock:
+        events = list(_events)
+    pid = os.getpid()
+    trace_events = [{"name": name, "ph": "X", "ts": start / 1e3, "dur": duration / 1e3, "pid": pid, "tid": tid} for name, start, duration, tid in events]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"traceEvents": trace_events, "displayTimeUnit": "ms"}))
+    return path
+
+
+def report() -> None:
+    # summary table to stdout and one chrome trace per process, runs at exit when anything was recorded
+    if not _durations:
+        return
+    path = Path(os.environ.get("ADVX_TRACE_PATH", TRACE_DIR / "trace.json"))
+    path = path.with_name(f"{path.stem}-{os.getpid()}{path.suffix}")  # forked workers never overwrite each other
+    print(get_summary_table(), flush=True)
+    print(f"chrome trace: {export_chrome_trace(path)}", flush=True)
+
+
+atexit.register(report)
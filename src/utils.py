@@ -1,9 +1,12 @@
+import csv
 import os
 import random
 import secrets
+from pathlib import Path
 
 import numpy as np
 import torch
+from filelock import FileLock
 
 
 def set_seed(seed: int = -1) -> None:
@@ -39,3 +42,17 @@ def set_env(seed: int = -1) -> None:
         torch.cuda.empty_cache()
         torch.cuda.reset_peak_memory_stats()
         torch.cuda.reset_accumulated_memory_stats()
+
+
+def get_worker_shard() -> tuple[int, int]:
+    # (worker id, worker count), set by runner.py when a sweep is split across forked workers
+    return int(os.environ.get("ADVX_WORKER_ID", 0)), int(os.environ.get("ADVX_NUM_WORKERS", 1))
+
+
+def append_csv_row(path: Path, row: dict) -> None:
+    # header check and append under one file lock, several workers may append to the same csv (see: runner.py)
+    with FileLock(str(path) + ".lock"), open(path, mode="a") as f:
+        writer = csv.DictWriter(f, fieldnames=row.keys())
+        if path.stat().st_size == 0:
+            writer.writeheader()
+        writer.writerow(row)